@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+import argparse
+parser = argparse.ArgumentParser(description=
+'''Covid-19-Classification Benchmark
+
+Measures latency percentiles, throughput and peak RSS of
+each pipeline stage (segmentation, classification, Grad-CAM
+and LIME) per image resolution and batch size.
+
+By default, small synthetic models with the shapes and layer
+names of the real models and synthetic X-Ray images are used,
+so the benchmark runs offline on any CPU. Pass -c and -s to
+benchmark the real models instead.
+
+Results are written as JSON. With --baseline, they are compared
+with a previous result and the exit code is 1 on regressions.
+''',
+formatter_class=argparse.RawTextHelpFormatter
+)
+parser.add_argument(
+    '-c',
+    '--model-path',
+    dest='model_path',
+    help='path to classification model, or an export of it\nfor classification and LIME, defaults to a synthetic model'
+)
+parser.add_argument(
+    '-s',
+    '--segmentation-model-path',
+    dest='segmentation_model_path',
+    help='path to segmentation model, defaults to a synthetic model'
+)
+parser.add_argument(
+    '--stages',
+    nargs='+',
+    choices=['segmentation', 'classification', 'gradcam', 'lime'],
+    default=['segmentation', 'classification', 'gradcam', 'lime'],
+    dest='stages',
+    help='pipeline stages to benchmark'
+)
+parser.add_argument(
+    '--batch-sizes',
+    nargs='+',
+    type=int,
+    default=[1, 4, 16],
+    dest='batch_sizes',
+    help='number of images processed at once'
+)
+parser.add_argument(
+    '--resolutions',
+    nargs='+',
+    type=int,
+    default=[1024, 2048],
+    dest='resolutions',
+    help='side lengths of the synthetic X-Ray images'
+)
+parser.add_argument(
+    '--repeats',
+    type=int,
+    default=5,
+    dest='repeats',
+    help='measured runs per stage and batch size'
+)
+parser.add_argument(
+    '--lime-samples',
+    type=int,
+    default=20,
+    dest='lime_samples',
+    help='number of LIME perturbations per image'
+)
+parser.add_argument(
+    '--output',
+    default='benchmark.json',
+    dest='output',
+    help='path of the JSON result'
+)
+parser.add_argument(
+    '--baseline',
+    dest='baseline',
+    help='path of a previous JSON result to compare with'
+)
+parser.add_argument(
+    '--tolerance',
+    type=float,
+    default=0.1,
+    dest='tolerance',
+    help='relative change of a metric which counts as regression'
+)
+args = parser.parse_args()
+
+import json
+import os
+import logging
+import platform
+import sys
+import tempfile
+
+# silence tensorflow
+logging.getLogger('tensorflow').setLevel(logging.ERROR)
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import tensorflow as tf
+tf.get_logger().setLevel('ERROR')
+
+from benchmarking.measurement import compare_with_baseline, measure
+from benchmarking.synthetic_images import write_synthetic_xrays
+from benchmarking.synthetic_models import (classification_model,
+                                           segmentation_model)
+from classification.classifier import Classfier
+from explanation.grad_cam_explainer import GradCAMExplainer
+from explanation.lime_explainer import LimeExplainer
+from inference.backends import load_backend
+from segmentation.lung_segmenter import LungSegmenter
+from segmentation.mask_processing import masked_file_paths
+
+work_dir = tempfile.TemporaryDirectory()
+
+if args.model_path is not None:
+  inference_model = load_backend(args.model_path)
+  model = getattr(inference_model, 'model', None)
+else:
+  model = inference_model = classification_model()
+segmentation_model_path = args.segmentation_model_path
+if segmentation_model_path is None:
+  segmentation_model_path = os.path.join(work_dir.name, 'segmentation_model.h5')
+  segmentation_model().save(segmentation_model_path)
+
+max_batch_size = max(args.batch_sizes)
+lung_segmenter = LungSegmenter(segmentation_model_path)
+classifier = Classfier(inference_model, ['COVID-19', 'NO FINDING'], batch_size=max_batch_size)
+gradcam_explainer = None
+if 'gradcam' in args.stages:
+  if not isinstance(model, tf.keras.Model):
+    parser.error('Grad-CAM needs a Keras classification model')
+  gradcam_explainer = GradCAMExplainer(
+      model,
+      inner_model=model.get_layer('NASNet'),
+      batch_size=max_batch_size
+  )
+# the superpixel cache would turn repeated explanations into cache hits
+lime_explainer = LimeExplainer(
+    inference_model,
+    kernel_width=4,
+    feature_selection='lasso_path',
+    num_samples=args.lime_samples,
+    segmentation_cache_bytes=0
+)
+
+def stage_runs(file_paths):
+  # masked images are computed once, so that later stages
+  # are measured without the segmentation
+  segmentations = lung_segmenter.segment_list(file_paths, save_masks=False)
+  masked_images = [segmentation.masked_image for segmentation in segmentations]
+  display_images = [segmentation.display_image for segmentation in segmentations]
+  explanation_paths = [masked_file_paths(file_path)[0] for file_path in file_paths]
+  return {
+    'segmentation': lambda: lung_segmenter.segment_list(file_paths, save_masks=False),
+    'classification': lambda: classifier.classify_arrays(masked_images),
+    'gradcam': lambda: gradcam_explainer.explain_arrays(
+        masked_images, explanation_paths, display_images),
+    'lime': lambda: [
+        lime_explainer.explain_array(masked_image, explanation_path, display_image)
+        for masked_image, explanation_path, display_image
+        in zip(masked_images, explanation_paths, display_images)
+    ]
+  }
+
+results = []
+for resolution in args.resolutions:
+  file_paths = write_synthetic_xrays(
+      os.path.join(work_dir.name, str(resolution)), max_batch_size, resolution)
+  for batch_size in args.batch_sizes:
+    runs = stage_runs(file_paths[:batch_size])
+    for stage in args.stages:
+      measurement = measure(runs[stage], batch_size, args.repeats)
+      measurement = dict(stage=stage, resolution=resolution, **measurement)
+      print(json.dumps(measurement), file=sys.stderr, flush=True)
+      results.append(measurement)
+work_dir.cleanup()
+
+report = {
+  'environment': {
+    'python': platform.python_version(),
+    'tensorflow': tf.__version__,
+    'machine': platform.machine(),
+    'cpu_count': os.cpu_count(),
+    'synthetic_models': args.model_path is None
+  },
+  'results': results
+}
+regressions = []
+if args.baseline is not None:
+  with open(args.baseline) as baseline_file:
+    baseline = json.load(baseline_file)
+  regressions = compare_with_baseline(results, baseline['results'], args.tolerance)
+  report['regressions'] = regressions
+
+with open(args.output, 'w') as output_file:
+  json.dump(report, output_file, indent=2)
+print(json.dumps(regressions if args.baseline is not None else results, indent=2))
+sys.exit(1 if regressions else 0)
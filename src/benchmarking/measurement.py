@@ -0,0 +1,116 @@
+"""Latency, throughput and memory measurements of benchmark runs."""
+
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+
+
+def resident_set_size():
+    """Return the current resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # peak of the whole process lifetime, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakRSSSampler():
+    """
+    Samples the resident set size of the process on a background
+    thread while it is used as context manager.
+
+    Attributes
+    ----------
+    interval: float
+        time in seconds between two samples
+    peak_bytes: int
+        highest resident set size sampled so far
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_bytes = 0
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def __enter__(self):
+        self.peak_bytes = resident_set_size()
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *exception_info):
+        self.__stopped.set()
+        self.__thread.join()
+        self.peak_bytes = max(self.peak_bytes, resident_set_size())
+
+    def __sample(self):
+        """Sample until the sampler is stopped."""
+        while not self.__stopped.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, resident_set_size())
+
+
+def measure(run, batch_size, repeats=5, warm_up=1):
+    """Return latency, throughput and peak RSS of a stage.
+
+    run processes a single batch of batch_size images. It is called
+    warm_up times without measuring and then repeats times.
+    """
+    for _ in range(warm_up):
+        run()
+    latencies = []
+    with PeakRSSSampler() as sampler:
+        for _ in range(repeats):
+            started = time.perf_counter()
+            run()
+            latencies.append(time.perf_counter() - started)
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'batch_size': batch_size,
+        'repeats': repeats,
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'throughput_images_per_s': float(batch_size * 1000 / latencies.mean()),
+        'peak_rss_mb': sampler.peak_bytes / (1024 * 1024)
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance=0.1):
+    """Return the regressions of results compared with baseline.
+
+    Both are lists of measurements with stage, resolution and batch_size.
+    A measurement regresses if its median latency or peak RSS grew or its
+    throughput shrank by more than tolerance relative to the baseline.
+    """
+    def key(measurement):
+        return (measurement['stage'], measurement['resolution'], measurement['batch_size'])
+
+    baseline = {key(measurement): measurement for measurement in baseline}
+    regressions = []
+    for measurement in results:
+        reference = baseline.get(key(measurement))
+        if reference is None:
+            continue
+        for metric, higher_is_better in (
+                ('p50_ms', False),
+                ('throughput_images_per_s', True),
+                ('peak_rss_mb', False)):
+            change = measurement[metric] / reference[metric] - 1
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append({
+                    'stage': measurement['stage'],
+                    'resolution': measurement['resolution'],
+                    'batch_size': measurement['batch_size'],
+                    'metric': metric,
+                    'baseline': reference[metric],
+                    'value': measurement[metric],
+                    'change': change
+                })
+    return regressions
@@ -0,0 +1,42 @@
+"""Small Keras models shaped like the classification model and the U-Net.
+
+The models have the input and output shapes of the real models and the
+classification model nests its convolutions in a sub-model called
+"NASNet" like the real one does, so that all pipeline stages including
+Grad-CAM run unchanged. Their weights are random, so they only serve
+to measure the overhead around the models and run fully offline.
+"""
+
+import tensorflow as tf
+from tensorflow.keras import layers
+
+
+def classification_model(image_size=(331, 331), filters=8, seed=0):
+    """Return a model mapping RGB images to a single sigmoid output."""
+    tf.random.set_seed(seed)
+    inner_input = layers.Input(shape=image_size + (3,))
+    features = layers.Conv2D(filters, 3, strides=2, activation='relu')(inner_input)
+    features = layers.Conv2D(filters * 2, 3, strides=2, activation='relu')(features)
+    features = layers.Conv2D(filters * 4, 3, strides=2, activation='relu')(features)
+    inner_model = tf.keras.Model(inner_input, features, name='NASNet')
+
+    inputs = layers.Input(shape=image_size + (3,))
+    outputs = inner_model(inputs)
+    outputs = layers.GlobalAveragePooling2D()(outputs)
+    outputs = layers.Dense(16, activation='relu')(outputs)
+    outputs = layers.Dropout(0.3)(outputs)
+    outputs = layers.Dense(1, activation='sigmoid')(outputs)
+    return tf.keras.Model(inputs, outputs)
+
+
+def segmentation_model(input_dimension=(256, 256), filters=8, seed=0):
+    """Return a model mapping grayscale images to masks of the same size."""
+    tf.random.set_seed(seed)
+    inputs = layers.Input(shape=input_dimension + (1,))
+    down = layers.Conv2D(filters, 3, padding='same', activation='relu')(inputs)
+    bottleneck = layers.MaxPooling2D()(down)
+    bottleneck = layers.Conv2D(filters * 2, 3, padding='same', activation='relu')(bottleneck)
+    up = layers.UpSampling2D()(bottleneck)
+    up = layers.Concatenate()([up, down])
+    outputs = layers.Conv2D(1, 1, activation='sigmoid')(up)
+    return tf.keras.Model(inputs, outputs)
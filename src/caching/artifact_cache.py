@@ -0,0 +1,188 @@
+"""ArtifactCache, which shares intermediate results between requests."""
+
+import threading
+from collections import OrderedDict
+
+
+class _Computation():
+    """Result of a computation other threads can wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exception = None
+
+    def wait(self):
+        """Return the value once computed, or raise its exception."""
+        self.done.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class ArtifactCache():
+    """
+    Thread-safe least recently used cache with a memory budget.
+
+    Concurrent requests for the same key wait for a single
+    computation instead of computing the value themselves.
+
+    Attributes
+    ----------
+    max_bytes: int
+        memory budget of the cache. Least recently used entries
+        are evicted once the budget is exceeded
+    sizeof: callable
+        function which returns the size of a value in bytes
+    hits: int
+        number of requested keys which were cached or
+        being computed by another thread
+    misses: int
+        number of requested keys which had to be computed
+    """
+
+    def __init__(self, max_bytes, sizeof=lambda value: value.nbytes):
+        if max_bytes < 0:
+            raise ValueError('max_bytes cannot be negative!')
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__computations = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def get(self, key, default=None):
+        """Return the cached value of key or default."""
+        with self.__lock:
+            if key not in self.__entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return self.__entries[key][0]
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value of key.
+
+        If key is not cached, compute(key) is called once
+        and its result is cached.
+        """
+        return self.get_or_compute_many(
+            [key], lambda keys: [compute(keys[0])])[0]
+
+    def get_or_compute_many(self, keys, compute_many):
+        """Return the cached values of keys.
+
+        compute_many is called once with all keys which are neither
+        cached nor being computed by another thread. It has to return
+        their values in the same order, otherwise ValueError is raised.
+        If it fails for several keys, it is called for each key alone,
+        so that only the keys which fail raise to the caller and the
+        threads waiting for them. Keys which are being computed by
+        another thread are waited for.
+        """
+        values = {}
+        claimed = {}
+        waiting = {}
+        with self.__lock:
+            for key in keys:
+                if key in values or key in claimed or key in waiting:
+                    continue
+                if key in self.__entries:
+                    self.__entries.move_to_end(key)
+                    values[key] = self.__entries[key][0]
+                elif key in self.__computations:
+                    waiting[key] = self.__computations[key]
+                else:
+                    claimed[key] = self.__computations[key] = _Computation()
+            self.hits += len(values) + len(waiting)
+            self.misses += len(claimed)
+
+        if claimed:
+            self.__compute(claimed, compute_many)
+            for key, computation in claimed.items():
+                values[key] = computation.value
+
+        for key, computation in waiting.items():
+            values[key] = computation.wait()
+        return [values[key] for key in keys]
+
+    def invalidate(self, key):
+        """Remove key from the cache."""
+        with self.__lock:
+            if key in self.__entries:
+                self.size -= self.__entries.pop(key)[1]
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+
+    def __compute(self, claimed, compute_many):
+        """Compute the claimed keys and complete their computations."""
+        try:
+            computed = list(compute_many(list(claimed)))
+            if len(computed) != len(claimed):
+                raise ValueError('compute_many returned {} values for {} keys!'.format(
+                    len(computed), len(claimed)))
+        except Exception as exception:
+            if len(claimed) == 1:
+                self.__fail(claimed, exception)
+                raise
+            # compute the keys one by one, so that a single
+            # faulty key does not fail the other keys
+            failed = None
+            try:
+                for key, computation in claimed.items():
+                    try:
+                        self.__compute({key: computation}, compute_many)
+                    except Exception as key_exception:
+                        if failed is None:
+                            failed = key_exception
+            except BaseException as exception:
+                self.__fail({
+                    key: computation for key, computation in claimed.items()
+                    if not computation.done.is_set()
+                }, exception)
+                raise
+            if failed is not None:
+                raise failed
+            return
+        except BaseException as exception:
+            self.__fail(claimed, exception)
+            raise
+        with self.__lock:
+            for (key, computation), value in zip(claimed.items(), computed):
+                del self.__computations[key]
+                self.__insert(key, value)
+                computation.value = value
+                computation.done.set()
+
+    def __fail(self, claimed, exception):
+        """Pass exception to the threads waiting for the claimed keys."""
+        with self.__lock:
+            for key, computation in claimed.items():
+                del self.__computations[key]
+                computation.exception = exception
+                computation.done.set()
+
+    def __insert(self, key, value):
+        """Insert value and evict least recently used entries if necessary."""
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            # the value would evict everything else
+            return
+        if key in self.__entries:
+            self.size -= self.__entries.pop(key)[1]
+        self.__entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self.__entries.popitem(last=False)
+            self.size -= evicted_size
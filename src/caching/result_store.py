@@ -0,0 +1,121 @@
+"""ResultStore, which persists results by the content of their input image."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    """Return the sha256 hex digest of the content of a file."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_fingerprint(*model_file_paths):
+    """Return a fingerprint identifying the content of all given model files.
+
+    A directory, e.g. a SavedModel, is identified by the
+    relative paths and the content of the files in it.
+    """
+    digest = hashlib.sha256()
+    for model_file_path in model_file_paths:
+        if not os.path.isdir(model_file_path):
+            digest.update(file_digest(model_file_path).encode('ascii'))
+            continue
+        for directory, directories, file_names in os.walk(model_file_path):
+            directories.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(directory, file_name)
+                digest.update(os.path.relpath(file_path, model_file_path).encode('utf-8'))
+                digest.update(file_digest(file_path).encode('ascii'))
+    return digest.hexdigest()
+
+
+class ResultStore():
+    """
+    Persistent index from the content hash of an input image
+    to the results of the commands run on it.
+
+    Results are stored together with the fingerprint of the models which
+    produced them. Results of other models are ignored and removed when
+    the store is opened, so that changing a model invalidates them.
+
+    Attributes
+    ----------
+    database_path: string
+        path of the SQLite database file
+    model_fingerprint: string
+        fingerprint of the models in use, see model_fingerprint
+    hits: int
+        number of lookups which found a stored result
+    misses: int
+        number of lookups which found no stored result
+    """
+
+    def __init__(self, database_path, model_fingerprint):
+        self.database_path = database_path
+        self.model_fingerprint = model_fingerprint
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(
+            database_path, check_same_thread=False)
+        with self.__lock, self.__connection:
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                '  content_hash TEXT NOT NULL,'
+                '  command TEXT NOT NULL,'
+                '  model_fingerprint TEXT NOT NULL,'
+                '  result TEXT NOT NULL,'
+                '  created_at REAL NOT NULL,'
+                '  PRIMARY KEY (content_hash, command)'
+                ')'
+            )
+            self.__connection.execute(
+                'DELETE FROM results WHERE model_fingerprint != ?',
+                (self.model_fingerprint,)
+            )
+
+    def get(self, content_hash, command, model_fingerprint=None):
+        """Return the stored result of command for the image or None.
+
+        Results of other models than the ones of model_fingerprint,
+        which defaults to the one of the store, are ignored.
+        """
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT result FROM results'
+                ' WHERE content_hash = ? AND command = ? AND model_fingerprint = ?',
+                (content_hash, command, model_fingerprint or self.model_fingerprint)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if row is None else row[0]
+
+    def put(self, content_hash, command, result, model_fingerprint=None):
+        """Store the result of command for the image.
+
+        The result is stored for the models of model_fingerprint,
+        which defaults to the one of the store.
+        """
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO results'
+                ' (content_hash, command, model_fingerprint, result, created_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (content_hash, command, model_fingerprint or self.model_fingerprint,
+                 result, time.time())
+            )
+
+    def close(self):
+        """Close the database connection."""
+        with self.__lock:
+            self.__connection.close()
@@ -1,12 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
 from os import path
 
 import numpy as np
 from tensorflow.image import per_image_standardization
 from tensorflow.keras.metrics import (AUC, CategoricalAccuracy, Precision,
                                       Recall)
-from tensorflow.keras.preprocessing import image
 from tensorflow_addons.metrics import F1Score
 
+from classification.image_loading import load_image, resize_image
+from monitoring.metrics import stage_timer, timed
+
 
 class Classfier():
     """
@@ -16,14 +19,29 @@ class Classfier():
     Attributes
     ----------
     model : tensorflow.keras.Model
-      classification model
+      classification model or an inference backend running
+      an export of it, see inference.backends
     classes: list
         list of output classes
+    batch_size: int
+        maximum number of images passed to the model at once
+    num_workers: int
+        number of threads used to decode images,
+        defaults to the ThreadPoolExecutor default
+    executor: concurrent.futures.ThreadPoolExecutor
+        threads used instead of num_workers new ones, e.g. to share
+        them between model versions, optional
+    metrics: monitoring.metrics.Metrics
+        receives the duration of each classification stage, optional
     """
-    def __init__(self, model, classes):
+    def __init__(self, model, classes, batch_size=32, num_workers=None, executor=None,
+                 metrics=None):
         self.model = model
         self.image_size = (331, 331)
         self.classes = classes
+        self.batch_size = batch_size
+        self.executor = executor if executor is not None else ThreadPoolExecutor(num_workers)
+        self.metrics = metrics
 
     def classify(self, image_path):
         '''
@@ -31,6 +49,82 @@ class Classfier():
         :return: dict containing classification probabilities
             for each class
         '''
+        return self.classify_batch([image_path])[0]
+
+    def classify_batch(self, image_paths):
+        '''
+        Creates classifications for each image specified in image_paths.
+        Images are decoded in parallel and classified in chunks of
+        batch_size images, while the next chunk is already being decoded.
+        :param image_paths: List of image paths
+        :return: List of classifications
+        '''
+        chunks = [
+            image_paths[start:start + self.batch_size]
+            for start in range(0, len(image_paths), self.batch_size)
+        ]
+        classifications = []
+        pending_images = self.__decode(chunks[0]) if chunks else []
+        for chunk_index in range(len(chunks)):
+            images = np.stack([
+                pending_image.result()
+                for pending_image in pending_images
+            ])
+            if chunk_index + 1 < len(chunks):
+                pending_images = self.__decode(chunks[chunk_index + 1])
+            classifications.extend(self.__predict(images))
+        return classifications
+
+    def classify_arrays(self, images):
+        '''
+        Creates classifications for each decoded image in images.
+        Same as classify_batch, but takes the pixels of the images
+        instead of their paths, e.g. the masked images of
+        LungSegmenter.segment_list, which avoids encoding them to
+        files and decoding them again.
+        :param images: List of grayscale or RGB image arrays of any size
+        :return: List of classifications
+        '''
+        classifications = []
+        resize = timed(self.metrics, 'classification_resize', resize_image)
+        for start in range(0, len(images), self.batch_size):
+            classifications.extend(self.__predict(np.stack([
+                resize(img, self.image_size)
+                for img in images[start:start + self.batch_size]
+            ])))
+        return classifications
+
+    def __predict(self, images):
+        '''
+        Classifies a stack of images of shape image_size + (3,)
+        :return: List of classifications
+        '''
+        with stage_timer(self.metrics, 'classification_model'):
+            images = per_image_standardization(images)
+            predictions = np.asarray(self.model.predict_on_batch(images))
+        return [
+            self.to_class_probabilities(prediction)
+            for prediction in predictions
+        ]
+
+    def __decode(self, image_paths):
+        '''
+        Starts decoding the images specified in image_paths
+        :return: List of futures of the decoded images
+        '''
+        return [
+            self.executor.submit(
+                timed(self.metrics, 'classification_decode', self.__load_image),
+                image_path
+            )
+            for image_path in image_paths
+        ]
+
+    def __load_image(self, image_path):
+        '''
+        Loads image specified in image_path
+        :return: image array of shape image_size + (3,)
+        '''
         if image_path is None:
             raise FileNotFoundError('image_path cannot be None!')
         if image_path == '':
@@ -39,34 +133,26 @@ class Classfier():
         if not path.exists(image_path):
             raise FileNotFoundError(
                 '{} cannot be found!'.format(image_path))
-        img = image.load_img(image_path,target_size = self.image_size)
-        img = image.img_to_array(img)
-        
-        img = np.expand_dims(img, axis = 0)
-        img = per_image_standardization(img)
-        prediction = self.model.predict([img])
-        if len(prediction[0]) > 1:
+        return load_image(image_path, self.image_size)
+
+    def to_class_probabilities(self, prediction):
+        '''
+        Maps a single model prediction to the output classes, e.g.
+        the predictions of GradCAMExplainer.explain_and_predict_arrays
+        :return: dict containing classification probabilities
+            for each class
+        '''
+        if len(prediction) > 1:
             return {
-                v: prediction[0][k].astype(float)
+                v: prediction[k].astype(float)
                 for k, v in enumerate(self.classes)
             }
         else:
             return {
                 v: (
-                    prediction[0][0].astype(float)
+                    prediction[0].astype(float)
                     if v != "COVID-19"
-                    else 1 - prediction[0][0].astype(float)
+                    else 1 - prediction[0].astype(float)
                 )
                 for k, v in enumerate(self.classes)
             }
-
-    def classify_batch(self, image_paths):
-        '''
-        Creates classifications for each image specified in image_paths.
-        :param image_paths: List of image paths
-        :return: List of classifications
-        '''
-        return [
-            self.classify(image_path) 
-            for image_path in image_paths
-        ]
@@ -0,0 +1,36 @@
+"""Conversion of X-Ray images to the input of the classification model.
+
+load_image decodes an image file the way the model has been trained,
+resize_image applies the same conversion to an image which has been
+decoded already, so that images can be passed between the stages of
+the pipeline without encoding them to PNG and decoding them again.
+"""
+
+import numpy as np
+from tensorflow.keras.preprocessing import image
+
+
+def load_image(image_path, image_size, dtype='float32'):
+    """Return the image as RGB array of shape image_size + (3,)."""
+    img = image.load_img(image_path, target_size=image_size)
+    return image.img_to_array(img, dtype=dtype)
+
+
+def resize_image(decoded_image, image_size, dtype='float32'):
+    """Return the decoded image as RGB array of shape image_size + (3,).
+
+    Same as load_image for an array holding the pixels of the image file:
+    grayscale images are repeated along the channel axis and the image is
+    resized with the nearest neighbour interpolation of PIL.
+    """
+    decoded_image = np.asarray(decoded_image)
+    height, width = image_size
+    # PIL samples the source pixel under the center of each target pixel
+    rows = np.floor(
+        (np.arange(height) + 0.5) * decoded_image.shape[0] / height).astype(int)
+    columns = np.floor(
+        (np.arange(width) + 0.5) * decoded_image.shape[1] / width).astype(int)
+    resized = decoded_image[rows[:, np.newaxis], columns[np.newaxis, :]]
+    if resized.ndim == 2:
+        resized = np.repeat(resized[..., np.newaxis], 3, axis=-1)
+    return resized[..., :3].astype(dtype)
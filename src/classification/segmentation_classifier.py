@@ -11,10 +11,16 @@ class SegmentationClassifier:
     ----------
     lung_segmenter: lung segmenter instance 
     classfier: classifier instance
+    batch_size: maximum number of images segmented at once
+    save_masks: whether the masks and masked images are saved
+        next to the X-Ray images. The masked images are passed
+        to the classifier in memory either way
     """
-    def __init__(self, lung_segmenter, classfier):
+    def __init__(self, lung_segmenter, classfier, batch_size=32, save_masks=False):
         self.lung_segmenter = lung_segmenter
         self.classfier = classfier
+        self.batch_size = batch_size
+        self.save_masks = save_masks
 
 
     def classify(self, image_path):
@@ -32,16 +38,31 @@ class SegmentationClassifier:
             raise FileNotFoundError(
                 '{} cannot be found!'.format(image_path))
 
-        masked_image_path = self.lung_segmenter.mask(image_path)
-        return self.classfier.classify(masked_image_path)
+        return self.classify_batch([image_path])[0]
 
     def classify_batch(self, image_paths):
         '''
         Creates classifications for each image specified in image_paths.
+        Images are segmented and classified in chunks of batch_size
+        images, each chunk in a single pass of each model.
         :param image_paths: List of image paths
         :return: List of classifications
         '''
-        return [
-            self.classify(image_path) 
-            for image_path in image_paths
-        ]
+        for image_path in image_paths:
+            if image_path is None:
+                raise FileNotFoundError('image_path cannot be None!')
+            if image_path == '':
+                raise FileNotFoundError(
+                    'image_path cannot be an empty String!')
+            if not path.exists(image_path):
+                raise FileNotFoundError(
+                    '{} cannot be found!'.format(image_path))
+
+        classifications = []
+        for start in range(0, len(image_paths), self.batch_size):
+            segmentations = self.lung_segmenter.segment_list(
+                image_paths[start:start + self.batch_size], self.save_masks)
+            classifications.extend(self.classfier.classify_arrays([
+                segmentation.masked_image for segmentation in segmentations
+            ]))
+        return classifications
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
@@ -7,10 +8,11 @@ from skimage.io import imsave
 from tensorflow.image import per_image_standardization
 from tensorflow.keras.metrics import (AUC, CategoricalAccuracy, Precision,
                                       Recall)
-from tensorflow.keras.preprocessing import image
-from tensorflow.keras.preprocessing.image import img_to_array
 from tensorflow_addons.metrics import F1Score
 
+from classification.image_loading import load_image, resize_image
+from monitoring.metrics import stage_timer, timed
+
 
 class GradCAMExplainer():
     """
@@ -21,10 +23,25 @@ class GradCAMExplainer():
     ----------
     model: tensorflow.keras.Model
       classification model
+    inner_model: tensorflow.keras.Model
+      nested model containing the final conv. layer. The layers
+      of model following inner_model are applied in order
     layer_name: string
       name of final conv. layer
     explanation_prefix: string:
       prefix to prepend to heatmap overlayed image filename
+    classIdx: int
+      index of the explained class. If None, the predicted class is explained
+    batch_size: int
+      maximum number of images explained in one forward and backward pass
+    num_workers: int
+      number of threads used to decode, visualize and save images,
+      defaults to the ThreadPoolExecutor default
+    executor: concurrent.futures.ThreadPoolExecutor
+      threads used instead of num_workers new ones, e.g. to share
+      them between model versions, optional
+    metrics: monitoring.metrics.Metrics
+      receives the duration of each explanation stage, optional
     """
     def __init__(
         self,
@@ -33,7 +50,11 @@ class GradCAMExplainer():
         layer_name=None,
         explanation_prefix='explanation_',
         eps=1e-8,
-        classIdx=None
+        classIdx=None,
+        batch_size=16,
+        num_workers=None,
+        executor=None,
+        metrics=None
         ):
 
         self.model = model
@@ -47,6 +68,34 @@ class GradCAMExplainer():
         if self.layer_name is None:
             self.layer_name = self.__find_target_layer()
         self.explanation_prefix = explanation_prefix
+        self.batch_size = batch_size
+        self.executor = executor if executor is not None else ThreadPoolExecutor(num_workers)
+        self.metrics = metrics
+        # construct our gradient model by supplying (1) the inputs
+        # to our pre-trained model, (2) the output of the (presumably)
+        # final 4D layer in the network, and (3) the output of the
+        # softmax activations from the model
+        self.gradModel = tf.keras.models.Model(
+            inputs=[
+                self.inner_model.inputs
+            ],
+            outputs=[
+                self.inner_model.get_layer(self.layer_name).output,
+                self.inner_model.output
+            ]
+        )
+        self.headModel = self.__build_head_model()
+        # trace the heatmap computation once for any batch size
+        self.compute_cam = tf.function(
+            self.__compute_cam,
+            input_signature=[
+                tf.TensorSpec(
+                    shape=(None,) + self.image_size + (3,),
+                    dtype=tf.float32
+                ),
+                tf.TensorSpec(shape=(), dtype=tf.int32)
+            ]
+        )
 
     def explain(self, image_path, display_image_path=None):
         """Return the file path of the explain X-Ray image classification.
@@ -62,30 +111,132 @@ class GradCAMExplainer():
             heatmap. Useful, when the image used for classification has
             already been modified in previous stages (e.g. segmentation)
         """
-        orig_img = image.load_img(image_path, target_size = self.image_size)
-        orig_img = np.asarray(orig_img, dtype=np.float64)
-        
-        orig_img = np.expand_dims(orig_img, axis = 0)
-        
-        standardized_img = per_image_standardization(orig_img)
+        return self.explain_batch([(image_path, display_image_path)])[0]
 
-        # predict
-        classIdx = np.argmax(self.model.predict([standardized_img]))
+    def explain_batch(self, image_paths):
+        """
+        Creates explainations for each image specified in image_paths.
+        The heatmaps of up to batch_size images are computed in a single
+        forward and backward pass, visualizations are saved in parallel.
+        :param image_paths: List of image paths. If tuple, second string
+            sets display_image_path
+        :return: List of paths of explained images
+        """
+        image_paths = [
+            image_path if isinstance(image_path, tuple) else (image_path, None)
+            for image_path in image_paths
+        ]
+        filenames = []
+        for start in range(0, len(image_paths), self.batch_size):
+            chunk = image_paths[start:start + self.batch_size]
+            orig_imgs = np.stack(list(self.executor.map(
+                timed(self.metrics, 'gradcam_decode',
+                      lambda image_path: self.__load_image(image_path[0])),
+                chunk
+            )))
+            filenames.extend(self.__explain(
+                orig_imgs,
+                [image_path for image_path, _ in chunk],
+                [display_image_path for _, display_image_path in chunk]
+            )[0])
+        return filenames
 
-        orig_img = np.squeeze(orig_img, axis=0)
-        orig_img = img_to_array(orig_img)
-        
-        # create explanation
-        heatmap = self.__compute_heatmap(standardized_img, eps=self.eps, classIdx=classIdx)
+    def explain_arrays(self, images, image_paths, display_images=None):
+        """
+        Creates explainations for each decoded image in images.
+        Same as explain_batch, but takes the pixels of the images
+        instead of their paths, e.g. the masked images of
+        LungSegmenter.segment_list, which avoids encoding them to
+        files and decoding them again.
+        :param images: List of grayscale or RGB image arrays of any size
+        :param image_paths: List of image paths, which determine the
+            file names of the explained images
+        :param display_images: List of image arrays to underlay the
+            heatmaps, None to underlay the explained images
+        :return: List of paths of explained images
+        """
+        return self.explain_and_predict_arrays(images, image_paths, display_images)[0]
+
+    def explain_and_predict_arrays(self, images, image_paths, display_images=None):
+        """
+        Same as explain_arrays, but also returns the predictions of
+        the classification model. They are taken from the forward pass
+        of the explanations, so images which are both classified and
+        explained pass through the model only once, see
+        Classfier.to_class_probabilities to map them to the classes.
+        :return: tuple(List of paths of explained images,
+            List of predictions)
+        """
+        if display_images is None:
+            display_images = [None] * len(images)
+        filenames = []
+        predictions = []
+        for start in range(0, len(images), self.batch_size):
+            end = start + self.batch_size
+            with stage_timer(self.metrics, 'gradcam_resize'):
+                orig_imgs = np.stack([
+                    resize_image(img, self.image_size, dtype='float64')
+                    for img in images[start:end]
+                ])
+            chunk_filenames, chunk_predictions = self.__explain(
+                orig_imgs, image_paths[start:end], display_images[start:end])
+            filenames.extend(chunk_filenames)
+            predictions.extend(chunk_predictions)
+        return filenames, predictions
+
+    def __explain(self, orig_imgs, image_paths, display_images):
+        '''
+        Explains a stack of images in a single forward and backward pass
+        and saves the visualizations in parallel
+        :param display_images: image paths or image arrays to
+            underlay the heatmaps, or None
+        :return: tuple(List of paths of explained images,
+            predictions of the classification model)
+        '''
+        with stage_timer(self.metrics, 'gradcam_model'):
+            standardized_imgs = per_image_standardization(orig_imgs)
+
+            # create explanations, the class index is taken from the same
+            # forward pass which produces the gradients, if classIdx is None
+            cams, _, predictions = self.compute_cam(
+                tf.cast(standardized_imgs, tf.float32),
+                tf.constant(
+                    -1 if self.classIdx is None else self.classIdx,
+                    dtype=tf.int32
+                )
+            )
+            cams = cams.numpy()
+            predictions = predictions.numpy()
+
+        return list(self.executor.map(
+            timed(self.metrics, 'gradcam_visualization', self.__visualize),
+            image_paths,
+            display_images,
+            orig_imgs,
+            cams
+        )), list(predictions)
+
+    def __load_image(self, image_path):
+        '''
+        Loads image specified in image_path
+        :return: image array of shape image_size + (3,)
+        '''
+        return load_image(image_path, self.image_size, dtype='float64')
+
+    def __visualize(self, image_path, display_image, orig_img, cam):
+        '''
+        Overlays the class activation map on the image and saves it
+        :return: path of explained image
+        '''
+        heatmap = self.__compute_heatmap(cam, eps=self.eps)
         heatmap = cv2.resize(heatmap, self.image_size)
         heatmap = cv2.resize(heatmap, orig_img.shape[1::-1])
 
-        if display_image_path is not None:
-            # use different image to underlay heatmap
-            orig_img = image.load_img(display_image_path, target_size = self.image_size)
-            orig_img = np.asarray(orig_img, dtype=np.float64)
-            orig_img = np.expand_dims(orig_img, axis = 0)
-            orig_img = np.squeeze(orig_img, axis=0)
+        # use different image to underlay heatmap
+        if isinstance(display_image, str):
+            orig_img = self.__load_image(display_image)
+        elif display_image is not None:
+            orig_img = resize_image(display_image, self.image_size, dtype='float64')
         
         # overlay heatmap
         _, visualization = self.__overlay_heatmap(
@@ -103,23 +254,11 @@ class GradCAMExplainer():
         img_filename = self.explanation_prefix + os.path.basename(image_path)
         if dir_path is not None:
             if not os.path.exists(dir_path):
-                os.makedirs(dir_path)
+                os.makedirs(dir_path, exist_ok=True)
         filename = os.path.join(dir_path, img_filename)
         imsave(filename, visualization)
         return filename
 
-    def explain_batch(self, image_paths):
-        """
-        Creates explainations for each image specified in image_paths.
-        :param image_paths: List of image paths. If tuple, second string
-            sets display_image_path
-        :return: List of paths of explained images
-        """
-        return [
-            self.explain(image_path[0], image_path[1]) if isinstance(image_path, tuple) else self.explain(image_path)
-            for image_path in image_paths
-        ]
-
     def __overlay_heatmap(self, heatmap, image, alpha=0.5, colormap=cv2.COLORMAP_VIRIDIS):
         '''
         Overlays heatmap
@@ -132,33 +271,48 @@ class GradCAMExplainer():
         # return a 2-tuple of the color mapped heatmap and the output,
         # overlaid image
         return (heatmap, output)
-    def __compute_heatmap(self, image, eps=1e-8, classIdx=None):
+    def __compute_heatmap(self, cam, eps=1e-8):
         '''
-        Computes heatmap of given image
+        Computes heatmap of a class activation map
         :return: heatmap
         '''
-        # construct our gradient model by supplying (1) the inputs
-        # to our pre-trained model, (2) the output of the (presumably)
-        # final 4D layer in the network, and (3) the output of the
-        # softmax activations from the model
-        gradModel = tf.keras.models.Model(
-            inputs=[
-                self.inner_model.inputs
-            ],
-            outputs=[
-                self.inner_model.get_layer(self.layer_name).output,
-                self.inner_model.output
-            ]
-        )                                   
-        
+        # resize the class activation map to match
+        # the input image dimensions
+        heatmap = cv2.resize(cam, self.image_size)
+        # normalize the heatmap such that all values lie in the range
+        # [0, 1], scale the resulting values to the range [0, 255],
+        # and then convert to an unsigned 8-bit integer
+        numer = heatmap - np.min(heatmap)
+        denom = (heatmap.max() - heatmap.min()) + eps
+        heatmap = numer / denom
+        heatmap = (heatmap * 255).astype("uint8")
+        # return the resulting heatmap to the calling function
+        return heatmap
+
+    def __compute_cam(self, images, classIdx):
+        '''
+        Computes the class activation maps of a batch of images
+        :param images: standardized images
+        :param classIdx: index of the explained class or -1
+            to explain the predicted class of each image
+        :return: tuple(class activation maps, explained class indices,
+            predictions of the classification model)
+        '''
         # record operations for automatic differentiation
         with tf.GradientTape() as tape:
-            # cast the image tensor to a float-32 data type, pass the
-            # image through the gradient model, and grab the loss
-            # associated with the specific class index
-            inputs = tf.cast(image, tf.float32)
-            (convOutputs, predictions) = gradModel(inputs)
-            loss = predictions[:, classIdx]
+            # pass the images through the gradient model, and
+            # grab the loss associated with the specific class index
+            (convOutputs, innerPredictions) = self.gradModel(images, training=False)
+            predictions = innerPredictions
+            if self.headModel is not None:
+                predictions = self.headModel(innerPredictions, training=False)
+            classIdxs = tf.where(
+                classIdx < 0,
+                tf.argmax(tf.reshape(predictions, (tf.shape(predictions)[0], -1)),
+                          axis=-1, output_type=tf.int32),
+                tf.fill(tf.shape(predictions)[:1], classIdx)
+            )
+            loss = tf.gather(innerPredictions, classIdxs, axis=1, batch_dims=1)
         # use automatic differentiation to compute the gradients
         grads = tape.gradient(loss, convOutputs)
 
@@ -166,32 +320,29 @@ class GradCAMExplainer():
         castConvOutputs = tf.cast(convOutputs > 0, "float32")
         castGrads = tf.cast(grads > 0, "float32")
         guidedGrads = castConvOutputs * castGrads * grads
-        # the convolution and guided gradients have a batch dimension
-        # (which we don't need) so let's grab the volume itself and
-        # discard the batch
-        convOutputs = convOutputs[0]
-        guidedGrads = guidedGrads[0]
 
-            # compute the average of the gradient values, and using them
+        # compute the average of the gradient values, and using them
         # as weights, compute the ponderation of the filters with
         # respect to the weights
-        weights = tf.reduce_mean(guidedGrads, axis=(0, 1))
+        weights = tf.reduce_mean(guidedGrads, axis=(1, 2), keepdims=True)
         cam = tf.reduce_sum(tf.multiply(weights, convOutputs), axis=-1)
+        return cam, classIdxs, predictions
 
-        # grab the spatial dimensions of the input image and resize
-        # the output class activation map to match the input image
-        # dimensions
-        (w, h) = (image.shape[2], image.shape[1])
-        heatmap = cv2.resize(cam.numpy(), (w, h))
-        # normalize the heatmap such that all values lie in the range
-        # [0, 1], scale the resulting values to the range [0, 255],
-        # and then convert to an unsigned 8-bit integer
-        numer = heatmap - np.min(heatmap)
-        denom = (heatmap.max() - heatmap.min()) + eps
-        heatmap = numer / denom
-        heatmap = (heatmap * 255).astype("uint8")
-        # return the resulting heatmap to the calling function
-        return heatmap
+    def __build_head_model(self):
+        '''
+        Builds the model mapping the output of the inner model
+        to the output of the classification model
+        :return: head model or None if inner model is the classification model
+        '''
+        if self.inner_model is self.model:
+            return None
+        layers = self.model.layers
+        head_layers = layers[layers.index(self.inner_model) + 1:]
+        head_input = tf.keras.layers.Input(shape=self.inner_model.output_shape[1:])
+        head_output = head_input
+        for layer in head_layers:
+            head_output = layer(head_output)
+        return tf.keras.models.Model(inputs=head_input, outputs=head_output)
 
     def __find_target_layer(self):
         '''
@@ -1,13 +1,20 @@
+import logging
 import os
+import time
 
 import numpy as np
-from lime.lime_image import *
+from lime.lime_image import ImageExplanation, LimeImageExplainer
 from skimage.io import imsave
 from skimage.segmentation import mark_boundaries
+from sklearn.metrics import pairwise_distances
 from tensorflow.image import per_image_standardization
-from tensorflow.keras.preprocessing import image
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 
+from classification.image_loading import load_image, resize_image
+from explanation.superpixel_segmenter import SuperpixelSegmenter
+
+logger = logging.getLogger(__name__)
+
 
 class LimeExplainer():
   """
@@ -16,7 +23,8 @@ class LimeExplainer():
   Attributes
   ----------
   model : tensorflow.keras.Model
-      classification model
+      classification model or an inference backend running
+      an export of it, see inference.backends
   kernel_width: float
       kernel width for the exponential kernel
   feature_selection: string
@@ -28,6 +36,23 @@ class LimeExplainer():
       size of the neighborhood to learn the linear model
   explanation_prefix: string:
       prefix to prepend to heatmap overlayed image filename
+  batch_size: int
+      maximum number of perturbations passed to the model at once
+  max_perturbation_bytes: int
+      maximum size in bytes of the perturbations held in memory at once,
+      limits batch_size for large images
+  segmentation_algorithm: string
+      superpixel algorithm. can be
+                'quickshift', 'slic', 'felzenszwalb' or 'grid'
+  segmentation_params: dict
+      parameters of the superpixel algorithm. Defaults to kernel_size,
+      max_dist, ratio and sigma for quickshift
+  segmentation_cache_bytes: int
+      memory budget for cached superpixel labels
+  timings: dict
+      duration in seconds of each stage of the last explanation
+  metrics: monitoring.metrics.Metrics
+      receives the duration of each explanation stage, optional
   """
 
   def __init__(
@@ -41,7 +66,13 @@ class LimeExplainer():
         kernel_size=2.5,
         max_dist=50,
         ratio=0.1,
-        sigma=0.15
+        sigma=0.15,
+        batch_size=32,
+        max_perturbation_bytes=256 * 1024 * 1024,
+        segmentation_algorithm='quickshift',
+        segmentation_params=None,
+        segmentation_cache_bytes=64 * 1024 * 1024,
+        metrics=None
     ):
     
     self.model = model
@@ -59,6 +90,23 @@ class LimeExplainer():
     self.max_dist = max_dist
     self.ratio = ratio
     self.sigma = sigma
+    self.batch_size = batch_size
+    self.max_perturbation_bytes = max_perturbation_bytes
+    if segmentation_params is None and segmentation_algorithm == 'quickshift':
+      # Parameters set to limit size of superpixels and promote border smoothness
+      segmentation_params = {
+        'kernel_size': self.kernel_size,
+        'max_dist': self.max_dist,
+        'ratio': self.ratio,
+        'sigma': self.sigma
+      }
+    self.segmentation_fn = SuperpixelSegmenter(
+      segmentation_algorithm,
+      segmentation_params,
+      cache_bytes=segmentation_cache_bytes
+    )
+    self.timings = {}
+    self.metrics = metrics
 
   def explain(self, image_path, display_image_path=None):
     """Return the file path of the explain X-Ray image classification.
@@ -74,11 +122,45 @@ class LimeExplainer():
         heatmap. Useful, when the image used for classification has
         already been modified in previous stages (e.g. segmentation)
     """
-    orig_img = image.load_img(image_path, target_size = self.image_size)
-    orig_img = np.asarray(orig_img, dtype=np.float64)
-    orig_img = np.expand_dims(orig_img, axis = 0)
-    standardized_img = per_image_standardization(orig_img)
+    started = time.perf_counter()
+    orig_img = load_image(image_path, self.image_size, dtype='float64')
+    display_image = None
+    if display_image_path is not None:
+      display_image = load_image(display_image_path, self.image_size, dtype='float64')
+    return self.__explain(orig_img, image_path, display_image, started)
+
+  def explain_array(self, img, image_path, display_image=None):
+    """Return the file path of the explain X-Ray image classification.
+
+    Same as explain, but takes the pixels of the image instead of its
+    path, e.g. the masked image of LungSegmenter.segment, which avoids
+    encoding it to a file and decoding it again.
+
+    Args:
+      img: grayscale or RGB image array of any size
+      image_path: path of the image, determines the file name
+        of the explained image
+      display_image: if set, image array to underlay heatmap
+    """
+    started = time.perf_counter()
+    orig_img = resize_image(img, self.image_size, dtype='float64')
+    if display_image is not None:
+      display_image = resize_image(display_image, self.image_size, dtype='float64')
+    return self.__explain(orig_img, image_path, display_image, started)
+
+  def __explain(self, orig_img, image_path, display_image, started):
+    """
+    Explains a decoded image and saves the visualization.
+    :param orig_img: image array of shape image_size + (3,)
+    :param image_path: path of the image, determines the file name
+    :param display_image: image array to underlay heatmap or None
+    :param started: time at which decoding the image started
+    :return: path of explained image
+    """
+    timings = {}
+    standardized_img = per_image_standardization(np.expand_dims(orig_img, axis=0))
     standardized_img = np.squeeze(standardized_img, axis=0)
+    timings['decode'] = time.perf_counter() - started
 
     # create explanation
     explanation = self.__predict_and_explain(
@@ -86,17 +168,15 @@ class LimeExplainer():
       self.model,
       self.exp, 
       self.num_features,
-      self.num_samples
+      self.num_samples,
+      timings=timings
     )
 
-    if display_image_path is not None:
+    started = time.perf_counter()
+
+    if display_image is not None:
         # use different image to underlay heatmap
-        orig_img = image.load_img(display_image_path, target_size = self.image_size)
-        orig_img = np.asarray(orig_img, dtype=np.float64)
-        orig_img = np.expand_dims(orig_img, axis = 0)
-        orig_img = np.squeeze(orig_img, axis=0)
-    else:
-        orig_img = np.squeeze(orig_img, axis=0)
+        orig_img = display_image
 
     # overlay heatmap
     visualization = self.__visualize_explanation(
@@ -113,6 +193,12 @@ class LimeExplainer():
           os.makedirs(dir_path)
       filename = os.path.join(dir_path, img_filename)
       imsave(filename, visualization)
+    timings['visualization'] = time.perf_counter() - started
+    self.timings = timings
+    if self.metrics is not None:
+      for stage, seconds in timings.items():
+        self.metrics.observe('lime_' + stage, seconds)
+    logger.debug('LIME stage timings for %s: %s', image_path, timings)
     return filename
   
 
@@ -136,55 +222,115 @@ class LimeExplainer():
     :param model: A Keras model
     :return: A numpy array comprising a list of class probabilities for each prediction
     """
-    y = model.predict(x)  # Run prediction on the perturbations
+    y = np.asarray(model.predict_on_batch(x))  # Run prediction on the perturbations
     if y.shape[1] == 1:
         probs = np.concatenate([1.0 - y, y], axis=1)  # Compute class probabilities from the output of the model
     else:
         probs = y
     return probs
 
-  def __predict_and_explain(self, x, model, exp, num_features, num_samples):
+  def __predict_and_explain(self, x, model, exp, num_features, num_samples, top_labels=5, timings=None):
     """
     Use the model to predict a single example and apply LIME to generate an explanation.
+    Perturbations are generated and predicted in batches of at most batch_size
+    images and max_perturbation_bytes bytes.
     :param x: Preprocessed image to predict
     :param model: The trained neural network model
     :param exp: A LimeImageExplainer object
     :param num_features: # of features to use in explanation
     :param num_samples: # of times to perturb the example to be explained
+    :param top_labels: # of labels with highest prediction probability to explain
+    :param timings: dict, receives the duration in seconds of each stage
     :return: explanation
     """
+    if timings is None:
+      timings = {}
+    started = time.perf_counter()
+    x = np.asarray(x)
+    segments = self.segmentation_fn(x.astype(np.float64))
+    x = x.astype(np.float32)
+    timings['segmentation'] = time.perf_counter() - started
+    fudged_image = self.__fudge_image(x, segments)
+
+    # Sample which superpixels are kept in each perturbation, the first
+    # sample keeps all superpixels and thus is the example itself
+    num_superpixels = segments.max() + 1
+    data = exp.random_state.randint(0, 2, num_samples * num_superpixels).reshape(
+      (num_samples, num_superpixels))
+    data[0, :] = 1
+
+    # each perturbation holds the image and the boolean mask of kept pixels
+    batch_size = max(1, min(
+      self.batch_size,
+      self.max_perturbation_bytes // (x.nbytes + segments.size)
+    ))
+    timings['perturbation'] = 0.0
+    timings['prediction'] = 0.0
+    labels = []
+    for start in range(0, num_samples, batch_size):
+      started = time.perf_counter()
+      perturbations = self.__perturb(x, fudged_image, segments, data[start:start + batch_size])
+      timings['perturbation'] += time.perf_counter() - started
+      started = time.perf_counter()
+      labels.append(self.__predict_instance(perturbations, model))
+      timings['prediction'] += time.perf_counter() - started
+    labels = np.concatenate(labels)
 
-    def predict(x):
-      """
-      Helper function for LIME explainer. Runs model prediction on perturbations of the example.
-      :param x: List of perturbed examples from an example
-      :return: A numpy array constituting a list of class probabilities for each predicted perturbation
-      """
-      return self.__predict_instance(x, model)
-
-    # Algorithm for superpixel segmentation. Parameters set to limit size of superpixels and promote border smoothness
-    segmentation_fn = SegmentationAlgorithm(
-        'quickshift',
-        kernel_size=self.kernel_size,
-        max_dist=self.max_dist,
-        ratio=self.ratio,
-        sigma=self.sigma
-    )
     # Generate explanation for the example
-    x = np.asarray(x)
-    explanation = exp.explain_instance(
-        x.astype(np.float64),
-        predict,
-        num_features=num_features,
-        num_samples=num_samples,
-        segmentation_fn=segmentation_fn
-    )
-    probs = self.__predict_instance(
-        np.expand_dims(x, axis=0),
-        model
-    )
+    started = time.perf_counter()
+    distances = pairwise_distances(
+      data,
+      data[0].reshape(1, -1),
+      metric='cosine'
+    ).ravel()
+    explanation = ImageExplanation(x, segments)
+    top = np.argsort(labels[0])[-top_labels:]
+    explanation.top_labels = list(reversed(top))
+    for label in top:
+      (
+        explanation.intercept[label],
+        explanation.local_exp[label],
+        explanation.score[label],
+        explanation.local_pred[label]
+      ) = exp.base.explain_instance_with_data(
+        data,
+        labels,
+        distances,
+        label,
+        num_features,
+        feature_selection=exp.feature_selection
+      )
+    timings['regression'] = time.perf_counter() - started
     return explanation
 
+  def __fudge_image(self, x, segments):
+    """
+    Replaces each superpixel by its mean color.
+    :param x: Image to fudge
+    :param segments: Superpixel label of each pixel
+    :return: fudged image
+    """
+    labels = segments.ravel()
+    counts = np.bincount(labels)
+    means = np.stack([
+      np.bincount(labels, weights=x[..., channel].ravel(), minlength=counts.shape[0])
+      for channel in range(x.shape[-1])
+    ], axis=-1) / np.maximum(counts, 1)[:, np.newaxis]
+    return means[segments].astype(np.float32)
+
+  def __perturb(self, x, fudged_image, segments, data):
+    """
+    Creates perturbations of an image by replacing superpixels with their fudged version.
+    :param x: Image to perturb
+    :param fudged_image: Image with each superpixel replaced by its mean color
+    :param segments: Superpixel label of each pixel
+    :param data: Binary matrix, whether a superpixel is kept in a perturbation
+    :return: float32 array of perturbed images
+    """
+    # indexed as bool, an int64 mask would be 8 times the size
+    keep = data.astype(bool)[:, segments][..., np.newaxis]
+    return np.where(keep, x, fudged_image)
+
   def __visualize_explanation(self, orig_img, explanation):
     """
     Visualize an explanation for the prediction of a single X-ray image.
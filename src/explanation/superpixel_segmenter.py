@@ -0,0 +1,70 @@
+import hashlib
+import json
+
+import numpy as np
+from lime.wrappers.scikit_image import SegmentationAlgorithm
+
+from caching.artifact_cache import ArtifactCache
+
+
+class SuperpixelSegmenter():
+  """
+  Segments images into superpixels and caches the resulting labels.
+
+  Attributes
+  ----------
+  algorithm: string
+      superpixel algorithm. can be
+                'quickshift', 'slic', 'felzenszwalb' or 'grid'
+  params: dict
+      parameters of the algorithm. 'grid' accepts grid_size, the number
+      of cells per image side, the others accept the parameters of the
+      corresponding skimage.segmentation function
+  cache_bytes: int
+      memory budget of the superpixel label cache
+  """
+
+  ALGORITHMS = ('quickshift', 'slic', 'felzenszwalb', 'grid')
+
+  def __init__(self, algorithm='quickshift', params=None, cache_bytes=64 * 1024 * 1024):
+    if algorithm not in self.ALGORITHMS:
+      raise ValueError('algorithm must be one of {}!'.format(', '.join(self.ALGORITHMS)))
+    self.algorithm = algorithm
+    self.params = dict(params or {})
+    if algorithm == 'grid':
+      self.segmentation_fn = self.__grid
+    else:
+      self.segmentation_fn = SegmentationAlgorithm(algorithm, **self.params)
+    self.cache = ArtifactCache(cache_bytes)
+    self.__params_key = json.dumps(
+      [self.algorithm, sorted(self.params.items())],
+      default=str
+    )
+
+  def __call__(self, image):
+    """
+    Returns the superpixel labels of an image.
+    Labels are cached per image content and segmentation parameters.
+    :param image: Image to segment
+    :return: array of superpixel labels in the shape of the image
+    """
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha1(image.tobytes())
+    digest.update(str((image.shape, image.dtype.str)).encode('ascii'))
+    digest.update(self.__params_key.encode('utf-8'))
+    return self.cache.get_or_compute(
+      digest.hexdigest(),
+      lambda _: self.segmentation_fn(image)
+    )
+
+  def __grid(self, image):
+    """
+    Segments an image into a regular grid of grid_size x grid_size cells.
+    :param image: Image to segment
+    :return: array of superpixel labels in the shape of the image
+    """
+    grid_size = self.params.get('grid_size', 16)
+    height, width = image.shape[:2]
+    rows = np.arange(height) * grid_size // height
+    columns = np.arange(width) * grid_size // width
+    return rows[:, np.newaxis] * grid_size + columns[np.newaxis, :]
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+import argparse
+parser = argparse.ArgumentParser(description=
+'''Covid-19-Classification Model Export
+
+Exports the classification and/or the segmentation model
+to an optimized inference backend, either TFLite with
+optional float16 or int8 quantization or a SavedModel
+compiled with XLA. The exported models can be passed
+to server.py with --inference-model-path and -s.
+
+Each export is compared with the original model on the
+images of a held-out CSV (e.g. test_set.csv of the training
+notebook). A JSON report is printed and the exit code is 1
+if an export does not reach the required parity.
+''',
+formatter_class=argparse.RawTextHelpFormatter
+)
+parser.add_argument(
+    '-c',
+    '--model-path',
+    dest='model_path',
+    help='path to classification model'
+)
+parser.add_argument(
+    '-s',
+    '--segmentation-model-path',
+    dest='segmentation_model_path',
+    help='path to segmentation model'
+)
+parser.add_argument(
+    '--output-dir-path',
+    required=True,
+    dest='output_dir_path',
+    help='directory to which the exported models are written'
+)
+parser.add_argument(
+    '--format',
+    choices=['tflite', 'saved_model'],
+    default='tflite',
+    dest='format',
+    help='inference backend to export to'
+)
+parser.add_argument(
+    '--quantization',
+    choices=['none', 'float16', 'int8'],
+    default='float16',
+    dest='quantization',
+    help='quantization of TFLite exports'
+)
+parser.add_argument(
+    '--disable-xla',
+    action='store_true',
+    dest='disable_xla',
+    help='do not compile SavedModel exports with XLA'
+)
+parser.add_argument(
+    '--held-out-csv-path',
+    required=True,
+    dest='held_out_csv_path',
+    help='CSV of held-out images for the parity check'
+)
+parser.add_argument(
+    '--calibration-csv-path',
+    dest='calibration_csv_path',
+    help='CSV of images to calibrate int8 quantization,\ndefaults to the held-out CSV'
+)
+parser.add_argument(
+    '--file-path-column',
+    default='filename',
+    dest='file_path_column',
+    help='column of the X-Ray images, which are segmented'
+)
+parser.add_argument(
+    '--masked-file-path-column',
+    default='masked_filename',
+    dest='masked_file_path_column',
+    help='column of the masked X-Ray images, which are classified'
+)
+parser.add_argument(
+    '--label-column',
+    default='label',
+    dest='label_column',
+    help='column of the true classes'
+)
+parser.add_argument(
+    '--num-images',
+    type=int,
+    default=200,
+    dest='num_images',
+    help='maximum number of images used for calibration\nand for the parity check'
+)
+parser.add_argument(
+    '--max-accuracy-drop',
+    type=float,
+    default=0.01,
+    dest='max_accuracy_drop',
+    help='maximum accuracy the exported classification model\nmay lose on the held-out images'
+)
+parser.add_argument(
+    '--min-mask-iou',
+    type=float,
+    default=0.95,
+    dest='min_mask_iou',
+    help='minimum mean IoU of the masks of the exported\nand the original segmentation model'
+)
+args = parser.parse_args()
+if args.model_path is None and args.segmentation_model_path is None:
+  parser.error('at least one of -c and -s is required')
+
+import json
+import os
+import logging
+import sys
+
+# silence tensorflow
+logging.getLogger('tensorflow').setLevel(logging.ERROR)
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import pandas as pd
+import tensorflow as tf
+tf.get_logger().setLevel('ERROR')
+
+from inference.backends import KerasBackend, load_backend
+from inference.exporting import (classification_parity, classifier_inputs,
+                                 export_saved_model, export_tflite,
+                                 segmentation_parity, segmenter_inputs)
+
+os.makedirs(args.output_dir_path, exist_ok=True)
+held_out = pd.read_csv(args.held_out_csv_path).head(args.num_images)
+calibration = held_out
+if args.calibration_csv_path is not None:
+  calibration = pd.read_csv(args.calibration_csv_path).head(args.num_images)
+
+def export(model, name, representative_images):
+  if args.format == 'saved_model':
+    suffix = '_xla' if not args.disable_xla else ''
+    return export_saved_model(
+        model,
+        os.path.join(args.output_dir_path, name + suffix),
+        jit_compile=not args.disable_xla
+    )
+  representative_images = list(representative_images()) \
+      if args.quantization == 'int8' else None
+  return export_tflite(
+      model,
+      os.path.join(args.output_dir_path, '{}_{}.tflite'.format(name, args.quantization)),
+      args.quantization,
+      representative_images
+  )
+
+def model_name(model_path):
+  return os.path.splitext(os.path.basename(model_path.rstrip(os.sep)))[0]
+
+report = {}
+passed = True
+
+if args.model_path is not None:
+  reference = load_backend(args.model_path)
+  if not isinstance(reference, KerasBackend):
+    parser.error('-c has to be a Keras model')
+  image_size = reference.input_shape[1:3]
+  export_path = export(
+      reference.model,
+      model_name(args.model_path),
+      lambda: classifier_inputs(calibration[args.masked_file_path_column], image_size)
+  )
+  # classes are indexed in alphabetical order, like flow_from_dataframe does
+  classes = sorted(held_out[args.label_column].unique())
+  parity = classification_parity(
+      reference,
+      load_backend(export_path),
+      classifier_inputs(held_out[args.masked_file_path_column], image_size),
+      [classes.index(label) for label in held_out[args.label_column]]
+  )
+  parity['export_path'] = export_path
+  parity['passed'] = parity['candidate_accuracy'] >= \
+      parity['reference_accuracy'] - args.max_accuracy_drop
+  passed = passed and parity['passed']
+  report['classification'] = parity
+
+if args.segmentation_model_path is not None:
+  reference = load_backend(args.segmentation_model_path)
+  if not isinstance(reference, KerasBackend):
+    parser.error('-s has to be a Keras model')
+  input_dimension = reference.input_shape[1:3]
+  export_path = export(
+      reference.model,
+      model_name(args.segmentation_model_path),
+      lambda: segmenter_inputs(calibration[args.file_path_column], input_dimension)
+  )
+  parity = segmentation_parity(
+      reference,
+      load_backend(export_path),
+      segmenter_inputs(held_out[args.file_path_column], input_dimension)
+  )
+  parity['export_path'] = export_path
+  parity['passed'] = parity['mean_iou'] >= args.min_mask_iou
+  passed = passed and parity['passed']
+  report['segmentation'] = parity
+
+print(json.dumps(report, indent=2))
+sys.exit(0 if passed else 1)
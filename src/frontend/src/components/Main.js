@@ -69,7 +69,7 @@ export default function Main () {
     console.log(file.preview)
     axios({
       method: 'post',
-      url: '/v1/classifier',
+      url: '/v1/classifier?explain=gradcam',
       headers: {
         'Content-Type': file.file.type
       },
@@ -12,6 +12,13 @@ parser.add_argument('-s', '--segmentation-model-path', {
   help: 'path to segmentation model',
   required: true
 })
+parser.add_argument('--models-dir-path', {
+  help: 'directory of versioned classification models, see train.py'
+})
+parser.add_argument('--model-watch-interval', {
+  help: 'seconds between two checks for a new model version,\n0 only reloads on POST /v1/models/reload',
+  default: 10
+})
 parser.add_argument('--cache-dir-path', {
   help: 'path to cache dir',
   required: true
@@ -60,20 +67,29 @@ if (!args.disable_api_cache) {
 
 const { spawn } = require('child_process')
 const path = require('path')
-const serverProcess = spawn('python', [
+const serverArgs = [
   path.join(__dirname, 'server.py'),
   '-c',
   args.model_path,
   '-s',
   args.segmentation_model_path,
   '--cache-dir-path',
-  args.cache_dir_path
-])
+  args.cache_dir_path,
+  '--model-watch-interval',
+  String(args.model_watch_interval)
+]
+if (args.models_dir_path) {
+  serverArgs.push('--models-dir-path', args.models_dir_path)
+}
+const serverProcess = spawn('python', serverArgs)
 
 process.on('exit', (code) => {
   serverProcess.kill()
 })
 
+// startup timings of the python worker, set once it is ready
+let readiness = null
+
 const hooks = {}
 const execute = (method, imageId) => {
   const id = md5(method + imageId)
@@ -82,6 +98,7 @@ const execute = (method, imageId) => {
   }
   hooks[id].promise = new Promise((resolve, reject) => {
     hooks[id].resolve = resolve
+    hooks[id].reject = reject
     console.log(method + ' ' + imageId)
     serverProcess.stdin.write(method + ' ' + imageId + '\n')
   })
@@ -91,19 +108,39 @@ const execute = (method, imageId) => {
 serverProcess.stdout.on('data', data => {
   data.toString().trim().split('\n').forEach(e => {
     e = e.trim()
-    const method = e.split(' ')[0]
-    const imageId = e.split(' ')[1]
+    if (e.startsWith('ready ')) {
+      readiness = JSON.parse(e.substr('ready '.length))
+      console.log('worker ready', readiness)
+      return
+    }
+    // replies of commands end with a tab and the model version
+    const [reply, modelVersion] = e.split('\t')
+    const method = reply.split(' ')[0]
+    const imageId = reply.split(' ')[1]
     const id = md5(method + imageId)
-    const result = e.substr(e.indexOf(' ', e.indexOf(' ') + 1) + 1)
+    const result = reply.substr(reply.indexOf(' ', reply.indexOf(' ') + 1) + 1)
 
-    console.log([method, imageId, result])
+    console.log([method, imageId, result, modelVersion])
     if (id.length > 0 && hooks[id] !== undefined) {
-      hooks[id].resolve(result)
+      if (result.startsWith('{"error"')) {
+        hooks[id].reject(new Error(JSON.parse(result).error))
+      } else {
+        hooks[id].resolve({ result, modelVersion })
+      }
       hooks[id].isResolved = true
     }
   })
 })
 
+// paths of the Grad-CAM explanations of uploads with ?explain=gradcam,
+// so that they are served without another model pass
+const explanations = new Map()
+const maxExplanations = 1024
+
+const sendError = res => err => {
+  res.status(503).send({ error: err.message })
+}
+
 const app = require('express')()
 const bodyParser = require('body-parser');
 ['png', 'jpg', 'jpeg'].forEach(e => {
@@ -114,16 +151,49 @@ const bodyParser = require('body-parser');
 })
 app.use(bodyParser.json())
 
+app.get('/v1/stats', (req, res) => {
+  execute('stats', uuidv4()).then(({ result }) => {
+    res.send(JSON.parse(result))
+  }).catch(sendError(res))
+})
+
+// loads the latest model version and replies once it serves new requests
+app.post('/v1/models/reload', (req, res) => {
+  execute('reload', uuidv4()).then(({ result }) => {
+    res.send(JSON.parse(result))
+  }).catch(sendError(res))
+})
+
+app.get('/v1/ready', (req, res) => {
+  if (readiness !== null) {
+    res.send(readiness)
+  } else {
+    res.status(503).send({ error: 'worker is starting' })
+  }
+})
+
 app.post('/v1/classifier', uploadCache, (req, res) => {
   const id = uuidv4()
   const data = req.body
   fs.writeFile(path.join(args.cache_dir_path, id + '.png'), data, err => {
     if (!err) {
       console.log('classifing', id)
-      execute('classify', id).then(result => {
+      // ?explain=gradcam also computes the Grad-CAM explanation in the
+      // same model pass, GET /v1/explainer/gradcam/:id then serves it
+      const explain = req.query.explain === 'gradcam'
+      execute(explain ? 'classify_and_explain' : 'classify', id).then(({ result, modelVersion }) => {
+        result = JSON.parse(result)
+        if (explain) {
+          explanations.set(id, { path: result.explanation, modelVersion })
+          if (explanations.size > maxExplanations) {
+            explanations.delete(explanations.keys().next().value)
+          }
+          result = result.classification
+        }
         res.send({
           id: id,
-          class_probabilities: JSON.parse(result),
+          class_probabilities: result,
+          model_version: modelVersion,
           _links: {
             self: {
               href: '/v1/classifier/' + id
@@ -136,17 +206,18 @@ app.post('/v1/classifier', uploadCache, (req, res) => {
             }
           }
         })
-      })
+      }).catch(sendError(res))
     }
   })
 })
 
 app.get('/v1/classifier/:id', cache, (req, res) => {
   const id = req.params.id
-  execute('classify', id).then(result => {
+  execute('classify', id).then(({ result, modelVersion }) => {
     res.send({
       id: id,
       class_probabilities: JSON.parse(result),
+      model_version: modelVersion,
       _links: {
         self: {
           href: '/v1/classifier/' + id
@@ -159,22 +230,30 @@ app.get('/v1/classifier/:id', cache, (req, res) => {
         }
       }
     })
-  })
+  }).catch(sendError(res))
 })
 
 app.get('/v1/explainer/gradcam/:id', cache, (req, res) => {
   const id = req.params.id
   console.log('explaining_gradcam', id)
-  execute('explain_gradcam', id).then(result => {
+  if (explanations.has(id)) {
+    const { path: explanationPath, modelVersion } = explanations.get(id)
+    res.set('X-Model-Version', modelVersion)
+    res.sendFile(path.join(process.cwd(), explanationPath))
+    return
+  }
+  execute('explain_gradcam', id).then(({ result, modelVersion }) => {
+    res.set('X-Model-Version', modelVersion)
     res.sendFile(path.join(process.cwd(), result))
-  })
+  }).catch(sendError(res))
 })
 app.get('/v1/explainer/lime/:id', cache, (req, res) => {
   const id = req.params.id
   console.log('explaining_lime', id)
-  execute('explain_lime', id).then(result => {
+  execute('explain_lime', id).then(({ result, modelVersion }) => {
+    res.set('X-Model-Version', modelVersion)
     res.sendFile(path.join(process.cwd(), result))
-  })
+  }).catch(sendError(res))
 })
 
 if (!fs.existsSync(path.join(args.training_dir_path, 'queue.json'))) {
@@ -0,0 +1,127 @@
+"""Inference backends, which run exported models on the CPU.
+
+All backends provide predict_on_batch and input_shape like a
+tensorflow.keras.Model, so that they can be passed to Classfier,
+LungSegmenter and LimeExplainer in place of the Keras model.
+GradCAMExplainer needs gradients and thus always uses the Keras model.
+"""
+
+import threading
+from os import path
+
+import numpy as np
+import tensorflow as tf
+# import metrics. Models can not be loaded without this
+from tensorflow.keras.metrics import (AUC, CategoricalAccuracy, Precision,
+                                      Recall)
+from tensorflow.keras.models import load_model
+from tensorflow_addons.metrics import F1Score
+
+
+class KerasBackend():
+    """
+    Runs a tensorflow.keras.Model.
+
+    Attributes
+    ----------
+    model: tensorflow.keras.Model
+        model to run
+    input_shape: tuple
+        input shape of the model, including the batch dimension
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.input_shape = tuple(model.input_shape)
+
+    def predict_on_batch(self, images):
+        """Return the predictions of the model for a batch of images."""
+        return np.asarray(self.model.predict_on_batch(images))
+
+
+class TFLiteBackend():
+    """
+    Runs a TFLite model, e.g. a float16 or int8 quantized export
+    of a Keras model, see inference.exporting.export_tflite.
+
+    The interpreter is resized to the size of each batch and
+    runs a single batch at a time.
+
+    Attributes
+    ----------
+    model_path: string
+        path of the .tflite file
+    num_threads: int
+        number of threads of the interpreter,
+        defaults to the TFLite default
+    input_shape: tuple
+        input shape of the model, including the batch dimension
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.interpreter = tf.lite.Interpreter(
+            model_path=model_path, num_threads=num_threads)
+        self.__input = self.interpreter.get_input_details()[0]
+        self.__output = self.interpreter.get_output_details()[0]
+        self.input_shape = (None,) + tuple(self.__input['shape'][1:])
+        self.__batch_size = None
+        self.__lock = threading.Lock()
+
+    def predict_on_batch(self, images):
+        """Return the predictions of the model for a batch of images."""
+        images = np.asarray(images, dtype=np.float32)
+        with self.__lock:
+            if images.shape[0] != self.__batch_size:
+                self.interpreter.resize_tensor_input(
+                    self.__input['index'], images.shape)
+                self.interpreter.allocate_tensors()
+                self.__batch_size = images.shape[0]
+            self.interpreter.set_tensor(self.__input['index'], images)
+            self.interpreter.invoke()
+            return np.copy(self.interpreter.get_tensor(self.__output['index']))
+
+
+class SavedModelBackend():
+    """
+    Runs the serving signature of a SavedModel, e.g. an XLA compiled
+    export of a Keras model, see inference.exporting.export_saved_model.
+
+    Attributes
+    ----------
+    model_path: string
+        path of the SavedModel directory
+    input_shape: tuple
+        input shape of the model, including the batch dimension
+    """
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.model = tf.saved_model.load(model_path)
+        self.__predict = self.model.signatures['serving_default']
+        (self.__input_name, input_spec), = \
+            self.__predict.structured_input_signature[1].items()
+        self.input_shape = tuple(input_spec.shape.as_list())
+
+    def predict_on_batch(self, images):
+        """Return the predictions of the model for a batch of images."""
+        outputs = self.__predict(**{
+            self.__input_name: tf.convert_to_tensor(images, dtype=tf.float32)
+        })
+        return next(iter(outputs.values())).numpy()
+
+
+def load_backend(model_path, num_threads=None):
+    """Return the backend which runs the model stored at model_path.
+
+    .tflite files are run by a TFLiteBackend, SavedModel directories by
+    a SavedModelBackend and all other files are loaded as Keras model.
+    num_threads only applies to TFLite models.
+    """
+    if model_path.endswith('.tflite'):
+        return TFLiteBackend(model_path, num_threads)
+    if path.isdir(model_path) and \
+            path.exists(path.join(model_path, 'saved_model.pb')):
+        return SavedModelBackend(model_path)
+    return KerasBackend(load_model(model_path))
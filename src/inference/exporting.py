@@ -0,0 +1,163 @@
+"""Export of Keras models to optimized inference backends.
+
+Besides the export itself, this module checks that an exported model
+predicts the same as the original Keras model on held-out images.
+"""
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.image import per_image_standardization
+
+from classification.image_loading import load_image
+from segmentation.mask_processing import read_and_downsize_image
+
+QUANTIZATIONS = ('none', 'float16', 'int8')
+
+
+def export_tflite(model, output_path, quantization='float16', representative_images=None):
+    """Return the path of the TFLite export of a Keras model.
+
+    'float16' stores the weights as float16, 'int8' quantizes weights
+    and activations to int8 and requires representative_images, a
+    sequence of preprocessed input images used to calibrate the
+    activation ranges. Inputs and outputs stay float32 either way.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError('quantization must be one of {}!'.format(QUANTIZATIONS))
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if representative_images is None or len(representative_images) == 0:
+            raise ValueError('int8 quantization requires representative_images!')
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: (
+            [np.asarray(representative_image, dtype=np.float32)[np.newaxis]]
+            for representative_image in representative_images
+        )
+        # operations without int8 kernel fall back to float
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+            tf.lite.OpsSet.TFLITE_BUILTINS
+        ]
+    with open(output_path, 'wb') as file:
+        file.write(converter.convert())
+    return output_path
+
+
+def export_saved_model(model, output_path, jit_compile=True):
+    """Return the path of the SavedModel export of a Keras model.
+
+    The serving signature accepts batches of any size and is
+    compiled with XLA if jit_compile is True.
+    """
+    serve = tf.function(
+        lambda images: model(images, training=False),
+        input_signature=[tf.TensorSpec(
+            shape=(None,) + tuple(model.input_shape[1:]),
+            dtype=tf.float32,
+            name='images'
+        )],
+        jit_compile=jit_compile
+    )
+    tf.saved_model.save(model, output_path, signatures={'serving_default': serve})
+    return output_path
+
+
+def classifier_inputs(file_paths, image_size=(331, 331)):
+    """Yield the standardized classifier input of each image."""
+    for file_path in file_paths:
+        image = load_image(file_path, image_size)
+        yield np.asarray(per_image_standardization(image))
+
+
+def segmenter_inputs(file_paths, input_dimension=(256, 256)):
+    """Yield the standardized U-Net input of each X-Ray image."""
+    for file_path in file_paths:
+        image = read_and_downsize_image(file_path, input_dimension)
+        yield np.asarray(per_image_standardization(image[..., np.newaxis]))
+
+
+def batches(images, batch_size):
+    """Yield stacks of at most batch_size images."""
+    batch = []
+    for image in images:
+        batch.append(image)
+        if len(batch) == batch_size:
+            yield np.stack(batch)
+            batch = []
+    if batch:
+        yield np.stack(batch)
+
+
+def classification_parity(reference, candidate, images, labels=None, batch_size=16):
+    """Return how closely the candidate backend matches the reference.
+
+    images are preprocessed classifier inputs, labels are the indices of
+    the true classes, e.g. 1 for 'NO FINDING' of a binary model. The
+    returned dict holds the absolute differences of the predictions,
+    the share of images classified alike and, if labels are given,
+    the accuracy of both backends.
+    """
+    reference_classes, candidate_classes = [], []
+    max_abs_diff, abs_diff_sum, num_outputs = 0.0, 0.0, 0
+    for batch in batches(images, batch_size):
+        reference_predictions = np.asarray(reference.predict_on_batch(batch))
+        candidate_predictions = np.asarray(candidate.predict_on_batch(batch))
+        abs_diff = np.abs(reference_predictions - candidate_predictions)
+        max_abs_diff = max(max_abs_diff, float(abs_diff.max()))
+        abs_diff_sum += float(abs_diff.sum())
+        num_outputs += abs_diff.size
+        reference_classes.extend(_predicted_classes(reference_predictions))
+        candidate_classes.extend(_predicted_classes(candidate_predictions))
+    reference_classes = np.asarray(reference_classes)
+    candidate_classes = np.asarray(candidate_classes)
+    parity = {
+        'num_images': len(reference_classes),
+        'max_abs_diff': max_abs_diff,
+        'mean_abs_diff': abs_diff_sum / max(num_outputs, 1),
+        'agreement': float(np.mean(reference_classes == candidate_classes))
+    }
+    if labels is not None:
+        labels = np.asarray(labels)
+        parity['reference_accuracy'] = float(np.mean(reference_classes == labels))
+        parity['candidate_accuracy'] = float(np.mean(candidate_classes == labels))
+    return parity
+
+
+def segmentation_parity(reference, candidate, images, threshold=0.5, batch_size=16):
+    """Return how closely the candidate backend matches the reference.
+
+    images are preprocessed U-Net inputs. The returned dict holds the
+    absolute differences of the predictions and the mean intersection
+    over union of the masks binarized at threshold.
+    """
+    ious = []
+    max_abs_diff, abs_diff_sum, num_outputs = 0.0, 0.0, 0
+    for batch in batches(images, batch_size):
+        reference_predictions = np.asarray(reference.predict_on_batch(batch))
+        candidate_predictions = np.asarray(candidate.predict_on_batch(batch))
+        abs_diff = np.abs(reference_predictions - candidate_predictions)
+        max_abs_diff = max(max_abs_diff, float(abs_diff.max()))
+        abs_diff_sum += float(abs_diff.sum())
+        num_outputs += abs_diff.size
+        for reference_mask, candidate_mask in zip(
+                reference_predictions > threshold,
+                candidate_predictions > threshold):
+            union = np.logical_or(reference_mask, candidate_mask).sum()
+            intersection = np.logical_and(reference_mask, candidate_mask).sum()
+            ious.append(intersection / union if union else 1.0)
+    return {
+        'num_images': len(ious),
+        'max_abs_diff': max_abs_diff,
+        'mean_abs_diff': abs_diff_sum / max(num_outputs, 1),
+        'mean_iou': float(np.mean(ious)) if ious else 1.0
+    }
+
+
+def _predicted_classes(predictions):
+    """Return the predicted class index of each prediction."""
+    if predictions.shape[-1] == 1:
+        return (predictions[:, 0] > 0.5).astype(int)
+    return np.argmax(predictions, axis=-1)
@@ -0,0 +1,276 @@
+"""Metrics, which collects stage durations, counters and gauges.
+
+Recording a duration takes two clock reads and a short critical
+section, so the instrumentation can stay enabled in production.
+"""
+
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+
+def stage_timer(metrics, stage):
+    """Return a context manager which records the duration of stage.
+
+    Does nothing if metrics is None, so that components
+    can be used without instrumentation.
+    """
+    if metrics is None:
+        return nullcontext()
+    return metrics.timer(stage)
+
+
+def timed(metrics, stage, function):
+    """Return function, recording the duration of each call as stage."""
+    if metrics is None:
+        return function
+
+    def timed_function(*args, **kwargs):
+        with metrics.timer(stage):
+            return function(*args, **kwargs)
+    return timed_function
+
+
+class Histogram():
+    """
+    Distribution of observed durations in fixed buckets.
+
+    Attributes
+    ----------
+    buckets: tuple
+        sorted upper bounds of the buckets in seconds
+    counts: list
+        number of observations per bucket, the last one
+        counts the observations above all bounds
+    count: int
+        number of observations
+    sum: float
+        sum of all observations in seconds
+    max: float
+        largest observation in seconds
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """Add an observation."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding quantile q."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class _Timer():
+    """Context manager which records its duration as a stage."""
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+
+
+class Metrics():
+    """
+    Thread-safe registry of stage durations, counters and gauges.
+
+    Attributes
+    ----------
+    buckets: tuple
+        upper bounds in seconds of the histogram buckets
+    labels: dict
+        labels added to every exported sample, e.g. the replica
+    prefix: string
+        prefix of the exported metric names
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, labels=None, prefix='covid'):
+        self.buckets = tuple(buckets)
+        self.labels = dict(labels or {})
+        self.prefix = prefix
+        self.started = time.time()
+        self.__histograms = {}
+        self.__counters = {}
+        self.__gauges = {}
+        self.__lock = threading.Lock()
+
+    def timer(self, stage):
+        """Return a context manager which records the duration of stage."""
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        """Record a duration of stage in seconds."""
+        with self.__lock:
+            histogram = self.__histograms.get(stage)
+            if histogram is None:
+                histogram = self.__histograms[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1, **labels):
+        """Increase the counter name with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + amount
+
+    def gauge(self, name, function, **labels):
+        """Register a gauge, whose value is read from function when exported."""
+        with self.__lock:
+            self.__gauges[(name, tuple(sorted(labels.items())))] = function
+
+    def snapshot(self):
+        """Return all metrics as JSON serializable dict."""
+        with self.__lock:
+            histograms = {
+                stage: (histogram.count, histogram.sum, histogram.max,
+                        [histogram.quantile(q) for q in (0.5, 0.9, 0.99)])
+                for stage, histogram in self.__histograms.items()
+            }
+            counters = dict(self.__counters)
+            gauges = dict(self.__gauges)
+        return {
+            'uptime_seconds': time.time() - self.started,
+            'stages': {
+                stage: {
+                    'count': count,
+                    'mean_ms': 1000 * total / count,
+                    'p50_ms': 1000 * p50,
+                    'p90_ms': 1000 * p90,
+                    'p99_ms': 1000 * p99,
+                    'max_ms': 1000 * maximum
+                }
+                for stage, (count, total, maximum, (p50, p90, p99))
+                in sorted(histograms.items())
+            },
+            'counters': self.__group(counters),
+            'gauges': self.__group({
+                key: function() for key, function in gauges.items()
+            })
+        }
+
+    def prometheus_text(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self.__lock:
+            histograms = {
+                stage: (list(histogram.counts), histogram.count, histogram.sum)
+                for stage, histogram in self.__histograms.items()
+            }
+            counters = dict(self.__counters)
+            gauges = dict(self.__gauges)
+
+        lines = []
+        name = '{}_stage_duration_seconds'.format(self.prefix)
+        lines.append('# TYPE {} histogram'.format(name))
+        for stage, (counts, count, total) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    name, self.__labels(stage=stage, le=bound), cumulative))
+            lines.append('{}_sum{} {}'.format(name, self.__labels(stage=stage), total))
+            lines.append('{}_count{} {}'.format(name, self.__labels(stage=stage), count))
+        for metric_type, samples in (('counter', counters), ('gauge', {
+                key: function() for key, function in gauges.items()})):
+            for metric_name in sorted({metric_name for metric_name, _ in samples}):
+                name = '{}_{}'.format(self.prefix, metric_name)
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                for (sample_name, labels), value in sorted(samples.items()):
+                    if sample_name == metric_name:
+                        lines.append('{}{} {}'.format(
+                            name, self.__labels(**dict(labels)), value))
+        return '\n'.join(lines) + '\n'
+
+    def __labels(self, **labels):
+        """Return the Prometheus label set of a sample."""
+        labels = dict(self.labels, **labels)
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(key, value) for key, value in labels.items()) + '}'
+
+    @staticmethod
+    def __group(samples):
+        """Return samples grouped by name, keyed by their labels."""
+        grouped = {}
+        for (name, labels), value in sorted(samples.items()):
+            label_key = ','.join(
+                '{}={}'.format(label, label_value) for label, label_value in labels)
+            grouped.setdefault(name, {})[label_key] = value
+        return grouped
+
+
+class PrometheusFileWriter():
+    """
+    Periodically writes metrics to a file in the Prometheus text
+    format, e.g. for the textfile collector of the node exporter.
+    The file is replaced atomically, so readers never see a partial file.
+
+    Attributes
+    ----------
+    metrics: Metrics
+        metrics to write
+    file_path: string
+        path of the written file
+    interval: float
+        time in seconds between two writes
+    """
+
+    def __init__(self, metrics, file_path, interval=15.0):
+        self.metrics = metrics
+        self.file_path = file_path
+        self.interval = interval
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def write(self):
+        """Write the current metrics."""
+        temporary_file_path = '{}.{}.tmp'.format(self.file_path, os.getpid())
+        with open(temporary_file_path, 'w') as file:
+            file.write(self.metrics.prometheus_text())
+        os.replace(temporary_file_path, self.file_path)
+
+    def close(self):
+        """Stop writing after a last write."""
+        self.__stopped.set()
+        self.__thread.join()
+        self.write()
+
+    def __run(self):
+        """Write the metrics every interval seconds until closed."""
+        while not self.__stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as error:
+                print('could not write metrics: {}'.format(error),
+                      file=sys.stderr, flush=True)
@@ -0,0 +1,73 @@
+"""RequestProfiler, which captures profiles of single requests."""
+
+import cProfile
+import os
+import pstats
+import threading
+import time
+import uuid
+
+import tensorflow as tf
+
+
+class RequestProfiler():
+    """
+    Runs single requests under cProfile and the TensorFlow profiler
+    and writes their profiles into a directory per request.
+
+    cProfile covers the thread running the request, work done on thread
+    pools shows up as waiting for their results. The TensorFlow profile
+    covers all TensorFlow operations and can be opened in TensorBoard.
+    Only one request is profiled at a time, because the TensorFlow
+    profiler cannot run concurrently.
+
+    Attributes
+    ----------
+    profiles_dir_path: string
+        directory into which the profiles are written
+    tensorflow: bool
+        whether to run the TensorFlow profiler
+    num_stats: int
+        number of functions listed in the cProfile summary
+    """
+
+    def __init__(self, profiles_dir_path, tensorflow=True, num_stats=50):
+        self.profiles_dir_path = profiles_dir_path
+        self.tensorflow = tensorflow
+        self.num_stats = num_stats
+        self.__lock = threading.Lock()
+
+    def profile(self, name, function, *args):
+        """Return the result of function(*args) and the paths of its profiles.
+
+        The profiles are written even if function raises an exception.
+        """
+        profile_dir_path = os.path.join(
+            self.profiles_dir_path,
+            '{}_{}_{}'.format(time.strftime('%Y%m%d-%H%M%S'), name, uuid.uuid4().hex[:8])
+        )
+        os.makedirs(profile_dir_path, exist_ok=True)
+        paths = {
+            'cprofile': os.path.join(profile_dir_path, 'cprofile.prof'),
+            'cprofile_summary': os.path.join(profile_dir_path, 'cprofile.txt')
+        }
+        if self.tensorflow:
+            paths['tensorflow'] = os.path.join(profile_dir_path, 'tensorflow')
+
+        profiler = cProfile.Profile()
+        with self.__lock:
+            if self.tensorflow:
+                tf.profiler.experimental.start(paths['tensorflow'])
+            profiler.enable()
+            try:
+                result = function(*args)
+            finally:
+                profiler.disable()
+                if self.tensorflow:
+                    tf.profiler.experimental.stop()
+                profiler.dump_stats(paths['cprofile'])
+                with open(paths['cprofile_summary'], 'w') as summary:
+                    pstats.Stats(profiler, stream=summary) \
+                        .sort_stats('cumulative') \
+                        .print_stats(self.num_stats)
+        return result, paths
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+import argparse
+parser = argparse.ArgumentParser(description=
+'''Covid-19-Classification Dataset Preprocessing
+
+Pads the X-Ray images of a CSV (e.g. the dataset of the
+training notebook) to squares and masks their lungs with the
+segmentation model, using the same code as the server.
+The raw images are not modified, all outputs are written to
+OUTPUT_DIR_PATH and the CSV is written with two new columns,
+prepared_FILE_PATH_COLUMN and masked_FILE_PATH_COLUMN.
+
+A manifest of content hashes in OUTPUT_DIR_PATH records
+which images are up to date, so a rerun after adding images
+only processes the new ones.
+''',
+formatter_class=argparse.RawTextHelpFormatter
+)
+parser.add_argument(
+    '-s',
+    '--segmentation-model-path',
+    required=True,
+    dest='segmentation_model_path',
+    help='path to segmentation model'
+)
+parser.add_argument(
+    '--input-csv-path',
+    required=True,
+    dest='input_csv_path',
+    help='CSV with a column of raw X-Ray image paths'
+)
+parser.add_argument(
+    '--output-csv-path',
+    required=True,
+    dest='output_csv_path',
+    help='path of the CSV with the preprocessed image paths'
+)
+parser.add_argument(
+    '--output-dir-path',
+    required=True,
+    dest='output_dir_path',
+    help='directory of the preprocessed images and the manifest'
+)
+parser.add_argument(
+    '--file-path-column',
+    default='filename',
+    dest='file_path_column',
+    help='column of the raw X-Ray image paths'
+)
+parser.add_argument(
+    '--image-size',
+    type=int,
+    default=331,
+    dest='image_size',
+    help='side length of the padded images'
+)
+parser.add_argument(
+    '--disable-padding',
+    action='store_true',
+    dest='disable_padding',
+    help='mask the images in their original size'
+)
+parser.add_argument(
+    '--mask-binarization-treshold',
+    type=float,
+    dest='mask_binarization_treshold',
+    help='threshold of the mask predictions, defaults to\nthe one of the server'
+)
+parser.add_argument(
+    '--batch-size',
+    type=int,
+    default=32,
+    dest='batch_size',
+    help='number of images masked in a single U-Net pass'
+)
+parser.add_argument(
+    '--processes',
+    type=int,
+    dest='processes',
+    help='number of worker processes, defaults to the number of CPUs'
+)
+args = parser.parse_args()
+
+import json
+import os
+import logging
+
+# silence tensorflow
+logging.getLogger('tensorflow').setLevel(logging.ERROR)
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import pandas as pd
+import tensorflow as tf
+tf.get_logger().setLevel('ERROR')
+
+from preprocessing.dataset_preprocessing import load_manifest, preprocess_dataframe
+from segmentation.lung_segmenter import LungSegmenter
+
+segmenter_parameters = {}
+if args.mask_binarization_treshold is not None:
+  segmenter_parameters['mask_binarization_treshold'] = args.mask_binarization_treshold
+lung_segmenter = LungSegmenter(args.segmentation_model_path, **segmenter_parameters)
+
+dataframe = pd.read_csv(args.input_csv_path)
+dataframe = preprocess_dataframe(
+    dataframe,
+    args.output_dir_path,
+    lung_segmenter,
+    args.file_path_column,
+    image_size=None if args.disable_padding else args.image_size,
+    batch_size=args.batch_size,
+    num_processes=args.processes
+)
+dataframe.to_csv(args.output_csv_path, index=False)
+print(json.dumps({
+  'images': len(dataframe),
+  'manifest_entries': len(load_manifest(args.output_dir_path)),
+  'output_csv_path': args.output_csv_path
+}, indent=2))
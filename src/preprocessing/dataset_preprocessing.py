@@ -0,0 +1,171 @@
+"""Incremental preprocessing of the X-Ray images of the training dataset.
+
+Replaces the resizing and masking loops of training.ipynb. Raw images
+are never modified: the padded images, masks and masked images are
+written to an output directory, named after the content hash of the
+raw image. A manifest in the output directory records the configuration
+each image has been processed with, so that a rerun only processes new
+or changed images and images whose configuration changed.
+
+Masks are created by a LungSegmenter, i.e. by the same code and with
+the same parameters as the masks of the server.
+
+The functions in this module do not depend on tensorflow, so that
+they can be run in worker processes without loading the U-Net.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from caching.result_store import file_digest, model_fingerprint
+from segmentation.mask_processing import init_worker, masked_file_paths
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+
+def pad_image(img, image_size):
+    """Return the image resized to fit into a black square of image_size.
+
+    Keeps the aspect ratio like resize_with_pad of training.ipynb.
+    """
+    ratio = float(image_size) / max(img.size)
+    new_size = tuple([int(x * ratio) for x in img.size])
+    img = img.resize(new_size, Image.LANCZOS)
+    padded_img = Image.new('RGB', (image_size, image_size))
+    padded_img.paste(img, ((image_size - new_size[0]) // 2,
+                           (image_size - new_size[1]) // 2))
+    return padded_img
+
+
+def prepare_image(file_path, prepared_file_path, image_size=None):
+    """Save the image as RGB PNG to prepared_file_path.
+
+    Pads the image to a square of image_size, unless it is None.
+    """
+    with Image.open(file_path) as img:
+        img = pad_image(img, image_size) if image_size else img.convert('RGB')
+        img.save(prepared_file_path)
+    return prepared_file_path
+
+
+def config_fingerprint(lung_segmenter, image_size):
+    """Return a fingerprint of everything the outputs of an image depend on."""
+    config = dict(
+        lung_segmenter.config(),
+        image_size=image_size,
+        model=model_fingerprint(lung_segmenter.model_file_path)
+    )
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_manifest(output_dir_path):
+    """Return the manifest of output_dir_path, which maps content hashes to outputs."""
+    manifest_path = os.path.join(output_dir_path, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(output_dir_path, manifest):
+    """Atomically save the manifest of output_dir_path."""
+    manifest_path = os.path.join(output_dir_path, MANIFEST_FILE_NAME)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def preprocess(file_paths,
+               output_dir_path,
+               lung_segmenter,
+               image_size=331,
+               batch_size=32,
+               num_processes=None,
+               chunk_size=1024):
+    """Return the prepared and the masked file path of each raw X-Ray image.
+
+    Images whose outputs are up to date are skipped. The others are padded
+    (unless image_size is None) and hashed in num_processes worker processes
+    and masked by lung_segmenter.mask_files in chunks of chunk_size images,
+    which runs in the same worker processes.
+    The manifest is saved after each chunk, so an interrupted run only
+    loses the progress of its last chunk.
+    """
+    os.makedirs(output_dir_path, exist_ok=True)
+    fingerprint = config_fingerprint(lung_segmenter, image_size)
+    manifest = load_manifest(output_dir_path)
+
+    def output_file_paths(content_hash):
+        prepared_file_path = os.path.join(output_dir_path, content_hash + '.png')
+        return (prepared_file_path,) + masked_file_paths(prepared_file_path)
+
+    def up_to_date(content_hash):
+        entry = manifest.get(content_hash)
+        return entry is not None and entry['config'] == fingerprint \
+            and all(map(os.path.exists, output_file_paths(content_hash)))
+
+    with ProcessPoolExecutor(num_processes, initializer=init_worker) as executor:
+        content_hashes = list(executor.map(file_digest, file_paths, chunksize=16))
+        # identical images are processed once
+        stale = {}
+        for file_path, content_hash in zip(file_paths, content_hashes):
+            if not up_to_date(content_hash):
+                stale.setdefault(content_hash, file_path)
+        stale = list(stale.items())
+
+        for start in range(0, len(stale), chunk_size):
+            chunk = stale[start:start + chunk_size]
+            for content_hash, _ in chunk:
+                # outputs of another configuration are replaced
+                for output_file_path in output_file_paths(content_hash):
+                    if os.path.exists(output_file_path):
+                        os.remove(output_file_path)
+            prepared_file_paths = list(executor.map(
+                prepare_image,
+                [file_path for _, file_path in chunk],
+                [output_file_paths(content_hash)[0] for content_hash, _ in chunk],
+                [image_size] * len(chunk)
+            ))
+            lung_segmenter.mask_files(prepared_file_paths, batch_size, executor=executor)
+            for content_hash, file_path in chunk:
+                manifest[content_hash] = {
+                    'config': fingerprint,
+                    'source': os.path.abspath(file_path)
+                }
+            save_manifest(output_dir_path, manifest)
+
+    return [output_file_paths(content_hash)[:2] for content_hash in content_hashes]
+
+
+def preprocess_dataframe(dataframe,
+                         output_dir_path,
+                         lung_segmenter,
+                         file_path_column_name='filename',
+                         **kwargs):
+    """Return a copy of dataframe with the paths of the preprocessed images.
+
+    The copy has two new columns, prepared_{file_path_column_name} and
+    masked_{file_path_column_name}, see preprocess for the kwargs.
+    """
+    if file_path_column_name not in dataframe:
+        raise AttributeError(
+            'dataframe has no column {}!'.format(file_path_column_name))
+    output_file_paths = preprocess(
+        list(dataframe[file_path_column_name]),
+        output_dir_path,
+        lung_segmenter,
+        **kwargs
+    )
+    dataframe = dataframe.copy()
+    prepared_file_paths, masked_image_file_paths = zip(*output_file_paths) \
+        if output_file_paths else ((), ())
+    position = dataframe.columns.get_loc(file_path_column_name) + 1
+    dataframe.insert(position, 'prepared_{}'.format(file_path_column_name),
+                     list(prepared_file_paths))
+    dataframe.insert(position + 1, 'masked_{}'.format(file_path_column_name),
+                     list(masked_image_file_paths))
+    return dataframe
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+import argparse
+parser = argparse.ArgumentParser(description=
+'''Covid-19-Classification Bulk Scoring
+
+Segments and classifies all X-Ray images of a directory
+or a CSV manifest (e.g. test_set.csv of the training
+notebook), e.g. to re-score an archive after a model update.
+
+Images are streamed in batches: the next batches are
+decoded and segmented while the current one is classified,
+so memory use does not grow with the number of images.
+Results are written incrementally to a CSV file or to a
+directory of Parquet files. The progress is checkpointed, a
+rerun with the same arguments resumes an interrupted run.
+''',
+formatter_class=argparse.RawTextHelpFormatter
+)
+parser.add_argument(
+    '-c',
+    '--model-path',
+    required=True,
+    dest='model_path',
+    help='path to classification model, or an export of it'
+)
+parser.add_argument(
+    '-s',
+    '--segmentation-model-path',
+    required=True,
+    dest='segmentation_model_path',
+    help='path to segmentation model'
+)
+source = parser.add_mutually_exclusive_group(required=True)
+source.add_argument(
+    '--input-dir-path',
+    dest='input_dir_path',
+    help='directory of X-Ray images, which is searched recursively'
+)
+source.add_argument(
+    '--input-csv-path',
+    dest='input_csv_path',
+    help='CSV manifest with a column of X-Ray image paths'
+)
+parser.add_argument(
+    '--file-path-column',
+    default='filename',
+    dest='file_path_column',
+    help='column of the X-Ray image paths in the CSV manifest'
+)
+parser.add_argument(
+    '--output-path',
+    required=True,
+    dest='output_path',
+    help='path of the result CSV file or Parquet directory'
+)
+parser.add_argument(
+    '--output-format',
+    choices=['csv', 'parquet'],
+    default='csv',
+    dest='output_format',
+    help='format of the results, Parquet needs pyarrow'
+)
+parser.add_argument(
+    '--checkpoint-path',
+    dest='checkpoint_path',
+    help='path of the checkpoint, defaults to\nOUTPUT_PATH.checkpoint.json'
+)
+parser.add_argument(
+    '--checkpoint-interval',
+    type=int,
+    default=1024,
+    dest='checkpoint_interval',
+    help='number of images between two checkpoints'
+)
+parser.add_argument(
+    '--restart',
+    action='store_true',
+    dest='restart',
+    help='ignore the checkpoint and score all images again'
+)
+parser.add_argument(
+    '--batch-size',
+    type=int,
+    default=32,
+    dest='batch_size',
+    help='number of images segmented and classified at once'
+)
+parser.add_argument(
+    '--prefetch-batches',
+    type=int,
+    default=2,
+    dest='prefetch_batches',
+    help='number of batches segmented ahead of the classification'
+)
+parser.add_argument(
+    '--decode-workers',
+    type=int,
+    dest='decode_workers',
+    help='number of threads decoding images'
+)
+args = parser.parse_args()
+
+import json
+import os
+import logging
+import sys
+import time
+from itertools import islice
+
+# silence tensorflow
+logging.getLogger('tensorflow').setLevel(logging.ERROR)
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import tensorflow as tf
+tf.get_logger().setLevel('ERROR')
+
+from caching.result_store import model_fingerprint
+from classification.classifier import Classfier
+from inference.backends import load_backend
+from scoring.bulk_scoring import (CSVResultWriter, ParquetResultWriter,
+                                  batched, directory_file_paths,
+                                  load_checkpoint, manifest_file_paths,
+                                  save_checkpoint, score_batches)
+from segmentation.lung_segmenter import LungSegmenter
+
+classes = ['COVID-19', 'NO FINDING']
+columns = ['file_path'] + classes + ['prediction', 'error']
+checkpoint_path = args.checkpoint_path or args.output_path.rstrip(os.sep) + '.checkpoint.json'
+
+# a checkpoint is only resumed by the same run
+run = {
+  'input': os.path.abspath(args.input_dir_path or args.input_csv_path),
+  'file_path_column': args.file_path_column if args.input_csv_path else None,
+  'output': os.path.abspath(args.output_path),
+  'output_format': args.output_format,
+  'models': model_fingerprint(args.model_path, args.segmentation_model_path)
+}
+processed, last_file_path, writer_state = 0, None, None
+if not args.restart:
+  try:
+    processed, last_file_path, writer_state = load_checkpoint(checkpoint_path, run)
+  except ValueError as error:
+    parser.error('{}, pass --restart to score from the start'.format(error))
+
+lung_segmenter = LungSegmenter(
+    args.segmentation_model_path,
+    num_workers=args.decode_workers
+)
+classifier = Classfier(
+    load_backend(args.model_path),
+    classes,
+    batch_size=args.batch_size
+)
+
+# images scored before the checkpoint are skipped
+if args.input_dir_path is not None and last_file_path is not None:
+  # by path, images added to or removed from the directory
+  # since the checkpoint do not shift the resume point
+  file_paths = directory_file_paths(args.input_dir_path, after=last_file_path)
+elif args.input_dir_path is not None:
+  file_paths = islice(directory_file_paths(args.input_dir_path), processed, None)
+else:
+  file_paths = islice(
+      manifest_file_paths(args.input_csv_path, args.file_path_column), processed, None)
+
+Writer = ParquetResultWriter if args.output_format == 'parquet' else CSVResultWriter
+writer = Writer(args.output_path, columns, writer_state)
+if processed:
+  print('resuming after {} images'.format(processed), file=sys.stderr, flush=True)
+
+started = time.perf_counter()
+scored = 0
+failed = 0
+since_checkpoint = 0
+try:
+  for rows in score_batches(
+      batched(file_paths, args.batch_size),
+      lung_segmenter,
+      classifier,
+      args.prefetch_batches):
+    writer.write(rows)
+    if rows:
+      last_file_path = rows[-1]['file_path']
+    scored += len(rows)
+    failed += sum(1 for row in rows if row['error'])
+    since_checkpoint += len(rows)
+    if since_checkpoint >= args.checkpoint_interval:
+      save_checkpoint(
+          checkpoint_path, run, processed + scored, writer.checkpoint(), last_file_path)
+      since_checkpoint = 0
+      print('scored {} images, {:.1f} images/s'.format(
+          processed + scored, scored / (time.perf_counter() - started)),
+          file=sys.stderr, flush=True)
+  save_checkpoint(
+      checkpoint_path, run, processed + scored, writer.checkpoint(), last_file_path)
+finally:
+  writer.close()
+
+print(json.dumps({
+  'scored': processed + scored,
+  'failed_in_this_run': failed,
+  'seconds': time.perf_counter() - started,
+  'output_path': args.output_path,
+  'checkpoint_path': checkpoint_path
+}, indent=2))
@@ -0,0 +1,263 @@
+"""Streaming bulk scoring of X-Ray images, see score.py.
+
+Images flow through generators in batches: file paths are read lazily
+from a directory or a CSV manifest, the next batches are decoded and
+segmented while the current one is classified, and the rows are
+written as soon as they are classified. At most a fixed number of
+batches is held in memory, independent of the number of images.
+"""
+
+import csv
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def directory_order_key(dir_path, file_path):
+    """Return the position of file_path in the order of directory_file_paths.
+
+    The files of a directory come before the files of its subdirectories,
+    both ordered by name.
+    """
+    parts = os.path.relpath(file_path, dir_path).split(os.sep)
+    return tuple((1, part) for part in parts[:-1]) + ((0, parts[-1]),)
+
+
+def directory_file_paths(dir_path, extensions=IMAGE_EXTENSIONS, after=None):
+    """Yield the paths of the X-Ray images below dir_path in a stable order.
+
+    Masks and masked images written by LungSegmenter are skipped. With
+    after, only the images following the path after are yielded, also if
+    it has been removed since, e.g. to resume a run after its last image.
+    """
+    after_key = directory_order_key(dir_path, after) if after is not None else None
+    for directory, directories, file_names in os.walk(dir_path):
+        directories.sort()
+        if after_key is not None:
+            # directories whose images all precede after are not walked
+            prefix = tuple(
+                (1, part) for part in os.path.relpath(directory, dir_path).split(os.sep)
+                if part != '.'
+            )
+            directories[:] = [
+                name for name in directories
+                if prefix + ((1, name),) >= after_key[:len(prefix) + 1]
+            ]
+        for file_name in sorted(file_names):
+            name, extension = os.path.splitext(file_name)
+            if extension.lower() not in extensions \
+                    or name.endswith(('_mask', '_masked')):
+                continue
+            file_path = os.path.join(directory, file_name)
+            if after_key is not None \
+                    and directory_order_key(dir_path, file_path) <= after_key:
+                continue
+            yield file_path
+
+
+def manifest_file_paths(csv_path, file_path_column='filename'):
+    """Yield the paths in file_path_column of a CSV manifest row by row."""
+    with open(csv_path, newline='') as csv_file:
+        reader = csv.DictReader(csv_file)
+        if file_path_column not in (reader.fieldnames or []):
+            raise ValueError('{} has no column {}'.format(csv_path, file_path_column))
+        for row in reader:
+            yield row[file_path_column]
+
+
+def batched(iterable, batch_size):
+    """Yield lists of batch_size consecutive items, the last one may be shorter."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def segment_batch(lung_segmenter, file_paths):
+    """Return the masked image or the error of each file path.
+
+    The batch is segmented at once. If that fails, its images are
+    segmented one by one, so a single unreadable image only fails itself.
+    """
+    try:
+        return [
+            (segmentation.masked_image, None)
+            for segmentation in lung_segmenter.segment_list(file_paths, save_masks=False)
+        ]
+    except Exception:
+        if len(file_paths) == 1:
+            raise
+    results = []
+    for file_path in file_paths:
+        try:
+            results.append(
+                (lung_segmenter.segment(file_path, save_masks=False).masked_image, None))
+        except Exception as exception:
+            results.append((None, '{}: {}'.format(type(exception).__name__, exception)))
+    return results
+
+
+def score_batches(file_path_batches, lung_segmenter, classifier, prefetch=2):
+    """Yield the result rows of each batch of file paths.
+
+    A row holds the file path, the probability of each class, the
+    predicted class and the error of the image, which is empty unless
+    it could not be scored. Up to prefetch batches are segmented
+    ahead while the current batch is classified.
+    """
+    def segment(file_paths):
+        try:
+            return file_paths, segment_batch(lung_segmenter, file_paths)
+        except Exception as exception:
+            error = '{}: {}'.format(type(exception).__name__, exception)
+            return file_paths, [(None, error)] * len(file_paths)
+
+    with ThreadPoolExecutor(1) as executor:
+        pending = deque()
+        file_path_batches = iter(file_path_batches)
+        for file_paths in islice(file_path_batches, prefetch + 1):
+            pending.append(executor.submit(segment, file_paths))
+        while pending:
+            file_paths, segmentations = pending.popleft().result()
+            for next_file_paths in islice(file_path_batches, 1):
+                pending.append(executor.submit(segment, next_file_paths))
+            masked_images = [
+                masked_image for masked_image, _ in segmentations
+                if masked_image is not None
+            ]
+            classifications = iter(classifier.classify_arrays(masked_images)
+                                   if masked_images else [])
+            rows = []
+            for file_path, (masked_image, error) in zip(file_paths, segmentations):
+                row = {'file_path': file_path}
+                if masked_image is not None:
+                    classification = next(classifications)
+                    row.update(classification)
+                    row['prediction'] = max(classification, key=classification.get)
+                row['error'] = error or ''
+                rows.append(row)
+            yield rows
+
+
+class CSVResultWriter():
+    """
+    Appends result rows to a CSV file.
+
+    Attributes
+    ----------
+    file_path: string
+        path of the CSV file
+    columns: list
+        columns of the CSV file
+    state: dict
+        checkpoint of a previous run to continue, see checkpoint,
+        rows written after it are removed
+    """
+
+    def __init__(self, file_path, columns, state=None):
+        self.file_path = file_path
+        self.columns = columns
+        if state is None:
+            self.__file = open(file_path, 'w', newline='')
+        else:
+            self.__file = open(file_path, 'r+', newline='')
+            self.__file.truncate(state['bytes'])
+            self.__file.seek(state['bytes'])
+        self.__writer = csv.DictWriter(self.__file, columns)
+        if state is None:
+            self.__writer.writeheader()
+
+    def write(self, rows):
+        """Append rows."""
+        self.__writer.writerows(rows)
+
+    def checkpoint(self):
+        """Persist all written rows and return the state to resume from."""
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        return {'bytes': self.__file.tell()}
+
+    def close(self):
+        """Close the file."""
+        self.__file.close()
+
+
+class ParquetResultWriter():
+    """
+    Writes result rows to a directory of Parquet files,
+    one file per checkpoint. Needs pandas and pyarrow.
+
+    Attributes
+    ----------
+    dir_path: string
+        path of the directory of Parquet files
+    columns: list
+        columns of the Parquet files
+    state: dict
+        checkpoint of a previous run to continue, see checkpoint,
+        files written after it are removed
+    """
+
+    def __init__(self, dir_path, columns, state=None):
+        self.dir_path = dir_path
+        self.columns = columns
+        self.__num_parts = 0 if state is None else state['parts']
+        self.__rows = []
+        os.makedirs(dir_path, exist_ok=True)
+        for file_name in os.listdir(dir_path):
+            if file_name.startswith('part-') and file_name.endswith('.parquet') \
+                    and int(file_name[len('part-'):-len('.parquet')]) >= self.__num_parts:
+                os.remove(os.path.join(dir_path, file_name))
+
+    def write(self, rows):
+        """Buffer rows until the next checkpoint."""
+        self.__rows.extend(rows)
+
+    def checkpoint(self):
+        """Write the buffered rows and return the state to resume from."""
+        import pandas as pd
+
+        if self.__rows:
+            part_path = os.path.join(
+                self.dir_path, 'part-{:05d}.parquet'.format(self.__num_parts))
+            pd.DataFrame(self.__rows, columns=self.columns) \
+                .to_parquet(part_path + '.tmp', index=False)
+            os.replace(part_path + '.tmp', part_path)
+            self.__num_parts += 1
+            self.__rows = []
+        return {'parts': self.__num_parts}
+
+    def close(self):
+        """Drop rows written after the last checkpoint."""
+        self.__rows = []
+
+
+def load_checkpoint(checkpoint_path, run):
+    """Return the number of scored images, the last scored path and the writer state of a run.
+
+    Returns (0, None, None) if there is no checkpoint. Raises ValueError
+    if the checkpoint belongs to a different run, e.g. another input
+    or other models, which has to be scored from the start.
+    """
+    if not os.path.exists(checkpoint_path):
+        return 0, None, None
+    with open(checkpoint_path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint['run'] != run:
+        raise ValueError(
+            '{} belongs to a different run: {}'.format(checkpoint_path, checkpoint['run']))
+    return checkpoint['processed'], checkpoint.get('last_file_path'), checkpoint['writer']
+
+
+def save_checkpoint(checkpoint_path, run, processed, writer_state, last_file_path=None):
+    """Atomically save the progress of a run, up to and including last_file_path."""
+    temporary_path = checkpoint_path + '.tmp'
+    with open(temporary_path, 'w') as checkpoint_file:
+        json.dump({'run': run, 'processed': processed, 'last_file_path': last_file_path,
+                   'writer': writer_state}, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary_path, checkpoint_path)
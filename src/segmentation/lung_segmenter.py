@@ -1,13 +1,52 @@
 """LungSegmenter, which creates masks for lungs from X-Ray Images."""
 
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from os import path
 
-from cv2 import (INTER_CUBIC, MORPH_CLOSE, MORPH_OPEN, dilate, imread, imwrite,
-                 morphologyEx, resize)
-from numpy import expand_dims, float32, ones, squeeze, uint8
-from numpy.ma import masked_where
+from numpy import asarray, expand_dims, rint, stack, uint8
 from tensorflow.image import per_image_standardization
-from tensorflow.keras.models import load_model
+
+from inference.backends import load_backend
+from monitoring.metrics import stage_timer, timed
+from segmentation.mask_processing import (downsize_image, init_worker,
+                                          mask_image, read_and_downsize_image,
+                                          read_and_save_mask, read_image,
+                                          save_masked_image, upsize_mask)
+
+
+class Segmentation(namedtuple(
+        'Segmentation',
+        ['original_image', 'mask', 'masked_image', 'masked_image_file_path'])):
+    """
+    Result of the lung segmentation of a single X-Ray image.
+
+    Attributes
+    ----------
+    original_image: numpy.ndarray
+        grayscale X-Ray image with values in [0, 1]
+    mask: numpy.ndarray
+        lung mask in the size of the original X-Ray image
+    masked_image: numpy.ndarray
+        masked X-Ray image as uint8 array, holding the pixels
+        of the masked image file
+    masked_image_file_path: string
+        file path of the saved masked X-Ray image,
+        None if the masked image has not been saved
+    """
+    __slots__ = ()
+
+    @property
+    def nbytes(self):
+        """Return the number of bytes occupied by the image arrays."""
+        return self.original_image.nbytes + self.mask.nbytes + \
+            self.masked_image.nbytes
+
+    @property
+    def display_image(self):
+        """Return the original X-Ray image as uint8 array."""
+        return rint(self.original_image*255).astype(uint8)
 
 
 class LungSegmenter():
@@ -17,21 +56,33 @@ class LungSegmenter():
     Attributes
     ----------
     model_file_path : string
-        file_path of the model to load
+        file_path of the model to load, either a Keras model or an export
+        of it, see inference.backends.load_backend
     mask_binarization_treshold: float
         threshold which is used to convert the prediction of the model to binary mask
     morphology_kernel_size: tuple(int, int)
         size of the kernel for posterior morphology operations on the mask
-        see __remove_small_regions_and_dilate
+        see mask_processing.remove_small_regions_and_dilate
     dilation_kernel_size: tuple(int, int)
         size of the kernel for posterior dilation operations on the mask
-        see __remove_small_regions_and_dilate
+        see mask_processing.remove_small_regions_and_dilate
     dilation_iterations: int
         number of iterations of dilation applied on the mask
-        see __remove_small_regions_and_dilate
+        see mask_processing.remove_small_regions_and_dilate
     input_dimension: tuple(int, int):
         input shape of the model to which all the images are resized to
         it is derived from the loaded model
+    num_workers: int
+        number of threads used to decode and resize images,
+        defaults to the ThreadPoolExecutor default
+    executor: concurrent.futures.ThreadPoolExecutor
+        threads used instead of num_workers new ones, e.g. to share
+        them between model versions, optional
+    inference_threads: int
+        number of threads of TFLite models,
+        defaults to the TFLite default
+    metrics: monitoring.metrics.Metrics
+        receives the duration of each segmentation stage, optional
     """
 
     def __init__(self,
@@ -39,7 +90,11 @@ class LungSegmenter():
                  mask_binarization_treshold=0.5,
                  morphology_kernel_size=(5, 5),
                  dilation_kernel_size=(2, 2),
-                 dilation_iterations=3
+                 dilation_iterations=3,
+                 num_workers=None,
+                 executor=None,
+                 inference_threads=None,
+                 metrics=None
                  ):
         if model_file_path is None:
             raise FileNotFoundError('model_file_path cannot be None!')
@@ -49,13 +104,15 @@ class LungSegmenter():
         if not path.exists(model_file_path):
             raise FileNotFoundError(
                 '{} cannot be found!'.format(model_file_path))
-        self.u_net = load_model(model_file_path)
+        self.model_file_path = model_file_path
+        self.u_net = load_backend(model_file_path, inference_threads)
         self.mask_binarization_treshold = mask_binarization_treshold
         self.morphology_kernel_size = morphology_kernel_size
         self.dilation_kernel_size = dilation_kernel_size
         self.dilation_iterations = dilation_iterations
-        self.input_dimension = tuple(
-            squeeze(self.u_net.layers[0].input_shape, axis=0)[1:3])
+        self.input_dimension = tuple(self.u_net.input_shape[1:3])
+        self.executor = executor if executor is not None else ThreadPoolExecutor(num_workers)
+        self.metrics = metrics
 
     def mask(self, file_path):
         """Return the file path of the masked X-Ray image.
@@ -64,45 +121,90 @@ class LungSegmenter():
         saves the mask and the masked image in the same
         folder as the original X-Ray image
         """
-        if file_path is None:
-            raise FileNotFoundError('file_path cannot be None!')
-        if file_path == '':
-            raise FileNotFoundError('file_path cannot be an empty String!')
-        if not path.exists(file_path):
-            raise FileNotFoundError(
-                '{} cannot be found!'.format(file_path))
+        return self.mask_list([file_path])[0]
+
+    def mask_list(self, file_paths):
+        """Return the file paths of the masked X-Ray images.
+
+        Same as mask, but decodes the X-Ray images in parallel
+        and predicts all masks in a single U-Net pass.
+        """
+        return [
+            segmentation.masked_image_file_path
+            for segmentation in self.segment_list(file_paths)
+        ]
+
+    def segment(self, file_path, save_masks=True):
+        """Return the Segmentation of the X-Ray image.
+
+        Same as mask, but also returns the decoded X-Ray image,
+        the upsized mask and the masked image. If save_masks is False,
+        nothing is written to disk.
+        """
+        return self.segment_list([file_path], save_masks)[0]
 
-        dot_index = file_path.rfind('.')
-        masked_image_file_path = '{}{}{}'.format(
-            file_path[:dot_index], '_masked', file_path[dot_index:])
-        mask_file_path = '{}{}{}'.format(
-            file_path[:dot_index], '_mask', file_path[dot_index:])
-        original_image = imread(file_path, 0).astype(float32)/255.0
-        original_image_size = original_image.shape[::-1]
-
-        downsized_image = resize(
-            original_image, dsize=self.input_dimension, interpolation=INTER_CUBIC)
-        downsized_image = expand_dims(downsized_image, axis=0)
-        downsized_image = per_image_standardization(downsized_image)
-
-        mask_prediction = self.u_net.predict(downsized_image)
-
-        mask = mask_prediction > self.mask_binarization_treshold
-        mask = self.__remove_small_regions_and_dilate(mask)
-        upsized_mask = resize(squeeze(mask).astype(
-            float32), dsize=original_image_size, interpolation=INTER_CUBIC)
-        masked_image = self.__mask_image(original_image, upsized_mask)
-        if not path.exists(masked_image_file_path):
-            imwrite(mask_file_path, upsized_mask*255)
-            imwrite(masked_image_file_path, masked_image*255)
-        return masked_image_file_path
-
-    def mask_batch(self, dataframe, file_path_column_name='file_path'):
+    def segment_list(self, file_paths, save_masks=True):
+        """Return the Segmentations of the X-Ray images.
+
+        Same as mask_list, but also returns the decoded X-Ray images,
+        the upsized masks and the masked images. If save_masks is False,
+        nothing is written to disk, see mask_processing.save_masked_image
+        to save them later on.
+        """
+        for file_path in file_paths:
+            self.__validate_file_path(file_path)
+
+        original_images = list(self.executor.map(
+            timed(self.metrics, 'segmentation_decode', read_image), file_paths))
+        downsized_images = stack(list(self.executor.map(
+            timed(self.metrics, 'segmentation_resize',
+                  lambda original_image: downsize_image(
+                      original_image, self.input_dimension)),
+            original_images
+        )))
+        with stage_timer(self.metrics, 'segmentation_model'):
+            mask_predictions = self.__predict(downsized_images)
+
+        segmentations = []
+        for file_path, original_image, mask_prediction in zip(
+                file_paths, original_images, mask_predictions):
+            with stage_timer(self.metrics, 'segmentation_morphology'):
+                upsized_mask = upsize_mask(
+                    mask_prediction,
+                    original_image.shape[::-1],
+                    *self.__post_processing_parameters()
+                )
+            with stage_timer(self.metrics, 'segmentation_masking'):
+                masked_image = mask_image(original_image, upsized_mask)
+            masked_image_file_path = None
+            if save_masks:
+                with stage_timer(self.metrics, 'segmentation_mask_write'):
+                    masked_image_file_path = save_masked_image(
+                        file_path, original_image, upsized_mask, masked_image)
+            segmentations.append(Segmentation(
+                original_image,
+                upsized_mask,
+                masked_image,
+                masked_image_file_path
+            ))
+        return segmentations
+
+    def mask_batch(self,
+                   dataframe,
+                   file_path_column_name='file_path',
+                   batch_size=32,
+                   num_processes=None,
+                   max_in_flight=None):
         """Return a new dataframe with paths to masked files.
 
         Masks all X-Ray images in the given dataframe and returns
         a new dataframe with a new column (masked_{file_path_column_name})
         which holds file_paths to the masked lung images.
+
+        The U-Net predicts batch_size images at once, while decoding,
+        resizing, post-processing and saving run in num_processes worker
+        processes. At most max_in_flight masks (default: 4 * batch_size)
+        wait for post-processing at any time, which bounds the memory used.
         """
         if dataframe is None:
             raise AttributeError('dataframe cannot be None!')
@@ -111,28 +213,112 @@ class LungSegmenter():
                 'file_path_column_name cannot be an empty String!')
         if file_path_column_name is None:
             raise AttributeError('file_path_column_name cannot be None!')
-        masked_file_paths = []
-        for file_path in dataframe[file_path_column_name]:
-            masked_file_paths.append(self.mask(file_path))
+        masked_file_paths = self.mask_files(
+            list(dataframe[file_path_column_name]),
+            batch_size,
+            num_processes,
+            max_in_flight
+        )
         dataframe.insert(1, 'masked_{}'.format(
             file_path_column_name), masked_file_paths)
         return dataframe
 
-    def __mask_image(self, image, mask):
-        """Return masked X-Ray image."""
-        return masked_where(mask == 0, image)
+    def mask_files(self,
+                   file_paths,
+                   batch_size=32,
+                   num_processes=None,
+                   max_in_flight=None,
+                   executor=None):
+        """Return the file paths of the masked X-Ray images.
+
+        Same as mask_list for any number of images, which are processed
+        like in mask_batch: the U-Net predicts batch_size images at once,
+        while the CPU-only steps run in num_processes worker processes.
+        A ProcessPoolExecutor whose workers were initialized with
+        mask_processing.init_worker may be passed as executor to run
+        them instead, it is not shut down.
+        """
+        if max_in_flight is None:
+            max_in_flight = 4 * batch_size
+        for file_path in file_paths:
+            self.__validate_file_path(file_path)
+        chunks = [
+            file_paths[start:start + batch_size]
+            for start in range(0, len(file_paths), batch_size)
+        ]
+
+        masked_file_paths = []
+        pending_masks = deque()
+        if executor is None:
+            pool = ProcessPoolExecutor(num_processes, initializer=init_worker)
+        else:
+            pool = nullcontext(executor)
+        with pool as executor:
+            def downsize(chunk):
+                return [
+                    executor.submit(read_and_downsize_image,
+                                    file_path, self.input_dimension)
+                    for file_path in chunk
+                ]
+
+            pending_images = downsize(chunks[0]) if chunks else []
+            for chunk_index, chunk in enumerate(chunks):
+                downsized_images = stack([
+                    pending_image.result()
+                    for pending_image in pending_images
+                ])
+                # preprocess the next chunk while the U-Net is busy
+                if chunk_index + 1 < len(chunks):
+                    pending_images = downsize(chunks[chunk_index + 1])
+                mask_predictions = self.__predict(downsized_images)
+                for file_path, mask_prediction in zip(chunk, mask_predictions):
+                    pending_masks.append(executor.submit(
+                        read_and_save_mask,
+                        file_path,
+                        mask_prediction,
+                        *self.__post_processing_parameters()
+                    ))
+                while len(pending_masks) > max_in_flight:
+                    masked_file_paths.append(pending_masks.popleft().result())
+            while pending_masks:
+                masked_file_paths.append(pending_masks.popleft().result())
+        return masked_file_paths
 
-    def __remove_small_regions_and_dilate(self, image):
-        """Return dilated and and morphologically improved mask.
+    def config(self):
+        """Return the parameters which determine the masks as JSON serializable dict.
 
-        Morphologically removes small (< morphology_kernel_size) connected regions of 0s or 1s
-        and dilates mask with dilation_kernel_size for dilation_iterations.
+        Together with the model, they identify the masks of an image,
+        e.g. to detect masks created with other parameters.
         """
-        morphology_kernel = ones(self.morphology_kernel_size, uint8)
-        dilation_kernel = ones(self.dilation_kernel_size, uint8)
-        image = squeeze(image).astype(float32)
-        image = morphologyEx(image, MORPH_CLOSE, morphology_kernel)
-        image = morphologyEx(image, MORPH_OPEN, morphology_kernel)
-        image = dilate(image, dilation_kernel,
-                       iterations=self.dilation_iterations)
-        return image
+        return {
+            'input_dimension': list(self.input_dimension),
+            'mask_binarization_treshold': self.mask_binarization_treshold,
+            'morphology_kernel_size': list(self.morphology_kernel_size),
+            'dilation_kernel_size': list(self.dilation_kernel_size),
+            'dilation_iterations': self.dilation_iterations
+        }
+
+    def __predict(self, downsized_images):
+        """Return the U-Net mask predictions for a stack of downsized images."""
+        downsized_images = expand_dims(downsized_images, axis=-1)
+        downsized_images = per_image_standardization(downsized_images)
+        return asarray(self.u_net.predict_on_batch(downsized_images))
+
+    def __post_processing_parameters(self):
+        """Return the parameters of mask_processing.upsize_mask."""
+        return (
+            self.mask_binarization_treshold,
+            self.morphology_kernel_size,
+            self.dilation_kernel_size,
+            self.dilation_iterations
+        )
+
+    def __validate_file_path(self, file_path):
+        """Raise FileNotFoundError if file_path does not point to a file."""
+        if file_path is None:
+            raise FileNotFoundError('file_path cannot be None!')
+        if file_path == '':
+            raise FileNotFoundError('file_path cannot be an empty String!')
+        if not path.exists(file_path):
+            raise FileNotFoundError(
+                '{} cannot be found!'.format(file_path))
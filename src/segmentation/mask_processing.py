@@ -0,0 +1,132 @@
+"""CPU-only pre- and post-processing steps of the lung segmentation.
+
+The functions in this module do not depend on tensorflow, so that
+they can be run in worker processes without loading the U-Net.
+"""
+
+from os import path
+
+from cv2 import (INTER_CUBIC, MORPH_CLOSE, MORPH_OPEN, dilate, imread, imwrite,
+                 morphologyEx, resize, setNumThreads)
+from numpy import asarray, clip, float32, ones, rint, squeeze, uint8
+from numpy.ma import masked_where
+
+
+def init_worker():
+    """Limit OpenCV to a single thread inside of worker processes."""
+    setNumThreads(1)
+
+
+def read_image(file_path):
+    """Return the X-Ray image as grayscale float32 array in [0, 1]."""
+    return imread(file_path, 0).astype(float32)/255.0
+
+
+def downsize_image(image, input_dimension):
+    """Return the X-Ray image resized to the input dimension of the U-Net."""
+    return resize(image, dsize=input_dimension, interpolation=INTER_CUBIC)
+
+
+def read_and_downsize_image(file_path, input_dimension):
+    """Return the X-Ray image resized to the input dimension of the U-Net."""
+    return downsize_image(read_image(file_path), input_dimension)
+
+
+def masked_file_paths(file_path):
+    """Return the file paths of the masked image and the mask."""
+    dot_index = file_path.rfind('.')
+    masked_image_file_path = '{}{}{}'.format(
+        file_path[:dot_index], '_masked', file_path[dot_index:])
+    mask_file_path = '{}{}{}'.format(
+        file_path[:dot_index], '_mask', file_path[dot_index:])
+    return masked_image_file_path, mask_file_path
+
+
+def remove_small_regions_and_dilate(image,
+                                    morphology_kernel_size,
+                                    dilation_kernel_size,
+                                    dilation_iterations):
+    """Return dilated and and morphologically improved mask.
+
+    Morphologically removes small (< morphology_kernel_size) connected regions of 0s or 1s
+    and dilates mask with dilation_kernel_size for dilation_iterations.
+    """
+    morphology_kernel = ones(morphology_kernel_size, uint8)
+    dilation_kernel = ones(dilation_kernel_size, uint8)
+    image = squeeze(image).astype(float32)
+    image = morphologyEx(image, MORPH_CLOSE, morphology_kernel)
+    image = morphologyEx(image, MORPH_OPEN, morphology_kernel)
+    image = dilate(image, dilation_kernel,
+                   iterations=dilation_iterations)
+    return image
+
+
+def upsize_mask(mask_prediction,
+                original_image_size,
+                mask_binarization_treshold,
+                morphology_kernel_size,
+                dilation_kernel_size,
+                dilation_iterations):
+    """Return the post-processed mask in the size of the original X-Ray image.
+
+    Binarizes the predicted mask, removes small regions, dilates it
+    and upsizes it to original_image_size.
+    """
+    mask = mask_prediction > mask_binarization_treshold
+    mask = remove_small_regions_and_dilate(
+        mask, morphology_kernel_size, dilation_kernel_size, dilation_iterations)
+    return resize(squeeze(mask).astype(
+        float32), dsize=original_image_size, interpolation=INTER_CUBIC)
+
+
+def mask_image(original_image, upsized_mask):
+    """Return the masked X-Ray image as uint8 array.
+
+    The pixels are the ones of the saved masked image file, so the
+    array can be classified without saving and decoding the file.
+    """
+    masked_image = masked_where(upsized_mask == 0, original_image)*255
+    # masked pixels keep their original value in [0, 1],
+    # rounded and saturated like OpenCV does when saving
+    return clip(rint(asarray(masked_image.data)), 0, 255).astype(uint8)
+
+
+def save_masked_image(file_path, original_image, upsized_mask, masked_image=None):
+    """Return the file path of the masked X-Ray image.
+
+    Saves the mask and the masked image in the same folder
+    as the original X-Ray image. The masked image is computed
+    from the mask unless it is passed already.
+    """
+    masked_image_file_path, mask_file_path = masked_file_paths(file_path)
+    if not path.exists(masked_image_file_path):
+        if masked_image is None:
+            masked_image = mask_image(original_image, upsized_mask)
+        imwrite(mask_file_path, upsized_mask*255)
+        imwrite(masked_image_file_path, masked_image)
+    return masked_image_file_path
+
+
+def save_mask(file_path,
+              original_image,
+              mask_prediction,
+              *post_processing_parameters):
+    """Return the file path of the masked X-Ray image.
+
+    Post-processes the predicted mask, upsizes it to the size of
+    the original X-Ray image and saves the mask and the masked image
+    in the same folder as the original X-Ray image.
+    """
+    upsized_mask = upsize_mask(
+        mask_prediction, original_image.shape[::-1], *post_processing_parameters)
+    return save_masked_image(file_path, original_image, upsized_mask)
+
+
+def read_and_save_mask(file_path, mask_prediction, *post_processing_parameters):
+    """Return the file path of the masked X-Ray image.
+
+    Same as save_mask, but decodes the original X-Ray image itself,
+    which is cheaper than sending it to a worker process.
+    """
+    return save_mask(file_path, read_image(file_path), mask_prediction,
+                     *post_processing_parameters)
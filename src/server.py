@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import time
+started = time.perf_counter()
 import argparse
 parser = argparse.ArgumentParser(description=
 '''Covid-19-Classification Server
@@ -10,6 +12,24 @@ replies with the same message on stdout,
 followed by optional response parameters.
 Allowed message types are: "classify", 
 "explain_lime" and "explain_gradcam". 
+"classify_and_explain" segments the image once
+and replies with both the classification and
+the Grad-CAM explanation of a single pass.
+"stats ID" replies with the stage timings,
+queue depths and cache hit ratios as JSON.
+"profile COMMAND IMAGE_ID" runs a command
+without caches under cProfile and the tensorflow
+profiler and replies with its result and the
+paths of the profiles in CACHE_DIR_PATH/profiles.
+"reload ID" loads the latest models in the
+background and switches to them once they are
+warmed up. Replies to commands are followed by a
+tab and the version of the models they used.
+If a command fails or is rejected, the reply
+parameter is a JSON object with an "error" key.
+Once the models are loaded and warmed up, the
+server writes "ready" followed by a JSON object
+with the duration of each startup phase.
 
 The images have to be located in
 "CACHE_DIR_PATH/IMAGE_ID.png".
@@ -28,7 +48,24 @@ parser.add_argument(
     '--segmentation-model-path',
     required=True,
     dest='segmentation_model_path',
-    help='path to segmentation model'
+    help='path to segmentation model, either a Keras model\nor an export of it, see export_model.py'
+)
+parser.add_argument(
+    '--inference-model-path',
+    dest='inference_model_path',
+    help='export of the classification model used for\nclassifications and LIME, see export_model.py.\nGrad-CAM always uses the model of --model-path'
+)
+parser.add_argument(
+    '--models-dir-path',
+    dest='models_dir_path',
+    help='directory of versioned classification models, see\ntrain.py. Its latest version is served instead of\n--model-path and watched for new versions'
+)
+parser.add_argument(
+    '--model-watch-interval',
+    type=float,
+    default=10,
+    dest='model_watch_interval',
+    help='time in seconds between two checks for a new version\nin --models-dir-path, 0 only reloads on "reload"'
 )
 parser.add_argument(
     '--cache-dir-path',
@@ -36,20 +73,258 @@ parser.add_argument(
     dest='cache_dir_path',
     help='path to cache dir'
 )
+parser.add_argument(
+    '--max-batch-size',
+    type=int,
+    default=16,
+    dest='max_batch_size',
+    help='maximum number of images classified in one batch'
+)
+parser.add_argument(
+    '--max-batch-wait',
+    type=float,
+    default=20,
+    dest='max_batch_wait',
+    help='maximum time in milliseconds a classification waits\nfor further images to fill its batch'
+)
+parser.add_argument(
+    '--classify-workers',
+    type=int,
+    default=16,
+    dest='classify_workers',
+    help='maximum number of concurrent classifications'
+)
+parser.add_argument(
+    '--gradcam-workers',
+    type=int,
+    default=2,
+    dest='gradcam_workers',
+    help='maximum number of concurrent Grad-CAM explanations'
+)
+parser.add_argument(
+    '--lime-workers',
+    type=int,
+    default=1,
+    dest='lime_workers',
+    help='maximum number of concurrent LIME explanations'
+)
+parser.add_argument(
+    '--max-queue-size',
+    type=int,
+    default=64,
+    dest='max_queue_size',
+    help='maximum number of queued requests, further\nrequests are rejected with an error reply'
+)
+parser.add_argument(
+    '--segmentation-cache-size',
+    type=int,
+    default=512,
+    dest='segmentation_cache_size',
+    help='memory budget in megabytes for segmentations\nshared between classifications and explanations'
+)
+parser.add_argument(
+    '--lime-segmentation-algorithm',
+    choices=['quickshift', 'slic', 'felzenszwalb', 'grid'],
+    default='quickshift',
+    dest='lime_segmentation_algorithm',
+    help='superpixel algorithm of the LIME explainer'
+)
+parser.add_argument(
+    '--save-masks',
+    action='store_true',
+    dest='save_masks',
+    help='save the masks and masked images next to the\nimages in the background, for auditing'
+)
+parser.add_argument(
+    '--disable-result-store',
+    action='store_true',
+    dest='disable_result_store',
+    help='do not reuse results of previous requests\nfor identical images'
+)
+parser.add_argument(
+    '--replicas',
+    type=int,
+    default=0,
+    dest='replicas',
+    help='number of worker processes, each with its own\nmodels. By default, requests are served in-process'
+)
+parser.add_argument(
+    '--intra-op-threads',
+    type=int,
+    default=0,
+    dest='intra_op_threads',
+    help='tensorflow intra-op threads, 0 lets tensorflow decide.\nWith --replicas, defaults to the cores per replica'
+)
+parser.add_argument(
+    '--inter-op-threads',
+    type=int,
+    default=0,
+    dest='inter_op_threads',
+    help='tensorflow inter-op threads, 0 lets tensorflow decide'
+)
+parser.add_argument(
+    '--opencv-threads',
+    type=int,
+    default=0,
+    dest='opencv_threads',
+    help='OpenCV threads, 0 lets OpenCV decide.\nWith --replicas, defaults to the cores per replica'
+)
+parser.add_argument(
+    '--auto-tune-threads',
+    action='store_true',
+    dest='auto_tune_threads',
+    help='measure the throughput of a few thread budgets in\ntrial processes before startup and use the best one.\nThe result is cached in CACHE_DIR_PATH/thread_budget.json\nand replaces the thread arguments'
+)
+parser.add_argument(
+    '--tuning-concurrency',
+    type=int,
+    default=0,
+    dest='tuning_concurrency',
+    help='concurrent classifications of the auto-tuning trials,\n0 uses --classify-workers'
+)
+parser.add_argument(
+    '--thread-budget-trial',
+    action='store_true',
+    dest='thread_budget_trial',
+    help=argparse.SUPPRESS
+)
+parser.add_argument(
+    '--metrics-file-path',
+    dest='metrics_file_path',
+    help='periodically write the metrics to this file in the\nPrometheus text format, e.g. for the node exporter'
+)
+parser.add_argument(
+    '--metrics-interval',
+    type=float,
+    default=15,
+    dest='metrics_interval',
+    help='time in seconds between two writes of the metrics file'
+)
+parser.add_argument(
+    '--profile-sample-rate',
+    type=float,
+    default=0,
+    dest='profile_sample_rate',
+    help='share of requests run under cProfile and the\ntensorflow profiler, the paths of their profiles\nare written to stderr'
+)
+parser.add_argument(
+    '--warm-up',
+    nargs='*',
+    choices=['classify', 'explain_gradcam', 'explain_lime'],
+    default=['classify', 'explain_gradcam'],
+    dest='warm_up',
+    help='commands run on a synthetic image before the server\nis ready, pass no command to skip the warm-up.\nThe LIME explainer is only loaded once it is needed'
+)
+parser.add_argument(
+    '--warm-up-batch-size',
+    type=int,
+    default=1,
+    dest='warm_up_batch_size',
+    help='number of synthetic images of each warm-up command'
+)
+parser.add_argument(
+    '--listen',
+    dest='listen',
+    help='serve newline-delimited JSON requests on a socket\ninstead of stdin, either "unix:PATH" or "HOST:PORT"'
+)
 args = parser.parse_args()
-
-# supress tqdm progess bar for lime explainer
-# until changes from 
-# https://github.com/marcotcr/lime/commit/26f2590da45aa402fc94f046e5d8e6f6cf32b32b 
-# are shipped
-import tqdm.auto as tqdm
-def nop(it, *a, **k):
-    return it
-tqdm.tqdm = nop
+if args.listen is not None and args.replicas > 0:
+  parser.error('--listen cannot be combined with --replicas')
+if args.auto_tune_threads and args.replicas > 0:
+  # concurrent trials of the replicas would measure each other
+  parser.error('--auto-tune-threads cannot be combined with --replicas')
 
 import json
 import os
 import logging
+import sys
+
+if args.replicas > 0:
+  # dispatch requests to worker processes, which are
+  # started with the same arguments except --replicas
+  from serving.replica_pool import ReplicaPool
+
+  worker_args = []
+  skip = False
+  for arg in sys.argv[1:]:
+    if skip:
+      skip = False
+    elif arg == '--replicas':
+      skip = True
+    elif not arg.startswith('--replicas='):
+      worker_args.append(arg)
+  intra_op_threads = args.intra_op_threads
+  if intra_op_threads == 0:
+    intra_op_threads = max(1, os.cpu_count() // args.replicas)
+    worker_args += ['--intra-op-threads', str(intra_op_threads)]
+  if args.opencv_threads == 0:
+    worker_args += ['--opencv-threads', str(intra_op_threads)]
+  worker_env = dict(os.environ, OMP_NUM_THREADS=str(intra_op_threads))
+
+  replica_pool = ReplicaPool(
+      [sys.executable, os.path.abspath(__file__)] + worker_args,
+      args.replicas,
+      commands=['classify', 'explain_lime', 'explain_gradcam', 'classify_and_explain',
+                'stats', 'profile', 'reload'],
+      broadcast_commands=['reload'],
+      aggregate_commands=['stats'],
+      env=worker_env
+  )
+  while len(data := sys.stdin.readline()):
+    replica_pool.submit(data)
+  replica_pool.close()
+  sys.exit(0)
+
+startup_timings = {}
+
+# threads of tensorflow, OpenMP and OpenCV, see tuning.thread_budget
+from tuning.thread_budget import ThreadBudget
+thread_budget = ThreadBudget(args.intra_op_threads, args.inter_op_threads, args.opencv_threads)
+startup_timings['thread_budget'] = dict(thread_budget._asdict(), source='arguments')
+if args.auto_tune_threads and not args.thread_budget_trial:
+  from tuning.thread_budget import candidate_budgets, tune_thread_budget
+
+  phase_started = time.perf_counter()
+  tuning_concurrency = args.tuning_concurrency or args.classify_workers
+  # trials are started with the same arguments and measure the
+  # classification pipeline with one of the candidate budgets
+  trial_args = [arg for arg in sys.argv[1:] if arg != '--auto-tune-threads']
+  def trial_command(budget):
+    return [sys.executable, os.path.abspath(__file__)] + trial_args + budget.as_args() + [
+      '--thread-budget-trial', '--warm-up', 'classify', '--model-watch-interval', '0'
+    ]
+  candidates = candidate_budgets(os.cpu_count(), tuning_concurrency)
+  # the cached budget is reused until the models or the machine change
+  model_file_paths = [
+    args.model_path,
+    args.segmentation_model_path,
+    args.inference_model_path,
+    os.path.join(args.models_dir_path, 'LATEST') if args.models_dir_path is not None else None
+  ]
+  cache_key = {
+    'cpu_count': os.cpu_count(),
+    'concurrency': tuning_concurrency,
+    'warm_up_batch_size': args.warm_up_batch_size,
+    'candidates': [list(candidate) for candidate in candidates],
+    'models': [
+      [path, os.stat(path).st_size, os.stat(path).st_mtime]
+      for path in model_file_paths if path is not None and os.path.exists(path)
+    ]
+  }
+  thread_budget, trials, cached = tune_thread_budget(
+      trial_command,
+      candidates,
+      os.path.join(args.cache_dir_path, 'thread_budget.json'),
+      cache_key
+  )
+  startup_timings['thread_budget'] = dict(
+      thread_budget._asdict(), source='cached' if cached else 'auto_tuned', trials=trials)
+  startup_timings['thread_tuning'] = time.perf_counter() - phase_started
+if thread_budget.intra_op_threads > 0:
+  # read by OpenMP once tensorflow is imported
+  os.environ['OMP_NUM_THREADS'] = str(thread_budget.intra_op_threads)
+
+phase_started = time.perf_counter()
 
 # silence tensorflow
 logging.getLogger('tensorflow').setLevel(logging.ERROR)
@@ -60,19 +335,42 @@ tf.get_logger().setLevel('ERROR')
 tf.autograph.set_verbosity(3)
 
 tf.executing_eagerly()
+if thread_budget.intra_op_threads > 0:
+  tf.config.threading.set_intra_op_parallelism_threads(thread_budget.intra_op_threads)
+if thread_budget.inter_op_threads > 0:
+  tf.config.threading.set_inter_op_parallelism_threads(thread_budget.inter_op_threads)
 
 # import metrics. Models can not be loaded without this
 from tensorflow.keras.metrics import CategoricalAccuracy, Precision, Recall, AUC
 from tensorflow_addons.metrics import F1Score
 from tensorflow.keras.models import load_model
 
+from inference.backends import load_backend
+import random
+import tempfile
 import threading
-import sys
-from explanation.lime_explainer import LimeExplainer
-from explanation.grad_cam_explainer import GradCAMExplainer
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+import cv2
+import numpy as np
 from classification.classifier import Classfier
 from segmentation.lung_segmenter import LungSegmenter
-from classification.segmentation_classifier import SegmentationClassifier
+from caching.artifact_cache import ArtifactCache
+from caching.result_store import ResultStore, file_digest, model_fingerprint
+from segmentation.mask_processing import masked_file_paths, save_masked_image
+from serving.background_writer import BackgroundWriter
+from monitoring.metrics import Metrics, PrometheusFileWriter, stage_timer, timed
+from monitoring.profiling import RequestProfiler
+from serving.micro_batcher import MicroBatcher
+from serving.model_versions import ModelSwitch, ModelVersion
+from serving.worker_pool import PriorityWorkerPool, QueueFullError
+from training.model_registry import ModelRegistry
+
+if thread_budget.opencv_threads > 0:
+  cv2.setNumThreads(thread_budget.opencv_threads)
+
+startup_timings['imports'] = time.perf_counter() - phase_started
+phase_started = time.perf_counter()
 
 config = {
   'DATA': {
@@ -86,108 +384,545 @@ config = {
     'FEATURE_SELECTION': 'lasso_path',
     'NUM_FEATURES': 1000,
     'NUM_SAMPLES': 20,
+    'BATCH_SIZE': 32,
+    'MAX_PERTURBATION_MEGABYTES': 256,
+    'SEGMENTATION_ALGORITHM': args.lime_segmentation_algorithm,
+    'SEGMENTATION_CACHE_MEGABYTES': 64,
     'COVID_ONLY': False
   }
 }
 
-model = load_model(args.model_path)
+# stage timings, queue depths and cache hit ratios, see the stats command
+replica_index = os.environ.get('REPLICA_INDEX')
+metrics = Metrics(labels={'replica': replica_index} if replica_index is not None else None)
+
+# Grad-CAM needs the gradients of the Keras model, all
+# other stages may run an optimized export of it
+inference_threads = thread_budget.intra_op_threads if thread_budget.intra_op_threads > 0 else None
+
+# versions published by train.py replace the initial models
+registry = ModelRegistry(args.models_dir_path) if args.models_dir_path is not None else None
+
+def latest_model_paths():
+  """Return the version, classification, segmentation and inference model paths to serve."""
+  if registry is not None:
+    version, model_path = registry.latest()
+    if version is not None:
+      # a version may come with its own segmentation model
+      segmentation_model_path = os.path.join(os.path.dirname(model_path), 'segmentation_model.hdf5')
+      if not os.path.exists(segmentation_model_path):
+        segmentation_model_path = args.segmentation_model_path
+      # --inference-model-path is an export of -c, versions
+      # are published with their own export by train.py
+      inference_model_path = registry.inference_model_path(version)
+      if inference_model_path is None and args.inference_model_path is not None:
+        print('model version {} has no inference export, classifying with the Keras model, '
+              'see --inference-format of train.py'.format(version), file=sys.stderr, flush=True)
+      return version, model_path, segmentation_model_path, inference_model_path
+  return None, args.model_path, args.segmentation_model_path, args.inference_model_path
+
+def lazy(create):
+  """Return a function which creates an object on its first call."""
+  instances = []
+  lock = threading.Lock()
+  def get():
+    with lock:
+      if not instances:
+        instances.append(create())
+    return instances[0]
+  get.created = lambda: bool(instances)
+  return get
 
 # create instances of classification, segementation
-# and explanation classes
-lime_explainer = LimeExplainer(
-  model,
-  config['LIME']['KERNEL_WIDTH'],
-  config['LIME']['FEATURE_SELECTION'],
-  config['LIME']['NUM_FEATURES'],
-  config['LIME']['NUM_SAMPLES'],
-  explanation_prefix='explanation_lime_'
-  )
-gradcam_explainer = GradCAMExplainer(model, inner_model=model.get_layer("NASNet"), layer_name=None, explanation_prefix='explanation_gradcam_')
-classifier = Classfier(model, config['DATA']['CLASSES'])
-lung_segmenter = LungSegmenter(model_file_path=args.segmentation_model_path)
-segmentation_classifier = SegmentationClassifier(lung_segmenter, classifier)
-
-def explain_lime(message_prefix, image_path, image_id):
-  print(
-      message_prefix,
-      lime_explainer.explain(
-        lung_segmenter.mask(image_path),
-        image_path
-      ),
-      flush=True
-  )
+# and explanation classes. The explainers and their
+# imports (lime, skimage) are loaded on first use
+def create_lime_explainer(inference_model):
+  from explanation.lime_explainer import LimeExplainer
+  return LimeExplainer(
+    inference_model,
+    config['LIME']['KERNEL_WIDTH'],
+    config['LIME']['FEATURE_SELECTION'],
+    config['LIME']['NUM_FEATURES'],
+    config['LIME']['NUM_SAMPLES'],
+    explanation_prefix='explanation_lime_',
+    batch_size=config['LIME']['BATCH_SIZE'],
+    max_perturbation_bytes=config['LIME']['MAX_PERTURBATION_MEGABYTES'] * 1024 * 1024,
+    segmentation_algorithm=config['LIME']['SEGMENTATION_ALGORITHM'],
+    segmentation_cache_bytes=config['LIME']['SEGMENTATION_CACHE_MEGABYTES'] * 1024 * 1024,
+    metrics=metrics
+    )
+
+def create_gradcam_explainer(model):
+  from explanation.grad_cam_explainer import GradCAMExplainer
+  return GradCAMExplainer(model, inner_model=model.get_layer("NASNet"), layer_name=None, explanation_prefix='explanation_gradcam_', executor=gradcam_executor, metrics=metrics)
 
-def explain_gradcam(message_prefix, image_path, image_id):
-  print(
-      message_prefix,
-      gradcam_explainer.explain(
-        lung_segmenter.mask(image_path),
-        image_path
-      ),
-      flush=True
+# decoding threads are shared by all model versions, so
+# that versions replaced by a reload do not leak them
+classifier_executor = ThreadPoolExecutor()
+lung_segmenter_executor = ThreadPoolExecutor()
+gradcam_executor = ThreadPoolExecutor()
+
+def load_models():
+  """Return the ModelVersion of the latest models."""
+  version, model_path, segmentation_model_path, inference_model_path = latest_model_paths()
+  fingerprint = model_fingerprint(*filter(None, [
+    model_path,
+    segmentation_model_path,
+    inference_model_path
+  ]))
+  model = load_model(model_path)
+  inference_model = model
+  if inference_model_path is not None:
+    inference_model = load_backend(inference_model_path, inference_threads)
+  return ModelVersion(
+    version=version or fingerprint[:12],
+    fingerprint=fingerprint,
+    classifier=Classfier(
+      inference_model,
+      config['DATA']['CLASSES'],
+      executor=classifier_executor,
+      metrics=metrics
+    ),
+    lung_segmenter=LungSegmenter(
+      model_file_path=segmentation_model_path,
+      executor=lung_segmenter_executor,
+      inference_threads=inference_threads,
+      metrics=metrics
+    ),
+    gradcam_explainer=lazy(lambda: create_gradcam_explainer(model)),
+    lime_explainer=lazy(lambda: create_lime_explainer(inference_model)),
+    # segmentations are computed once per image and shared
+    # between classifications and explanations
+    segmentation_cache=ArtifactCache(args.segmentation_cache_size * 1024 * 1024)
   )
 
-def classify(message_prefix, image_path, image_id):
-  print(
-      message_prefix, 
-      json.dumps(segmentation_classifier.classify(image_path)),
-      flush=True
+models = load_models()
+startup_timings['models'] = time.perf_counter() - phase_started
+# segmentations are passed between the stages in memory,
+# masks are only saved for auditing
+mask_writer = BackgroundWriter() if args.save_masks else None
+
+# results are persisted by the content of the image, so
+# that identical images are only processed once per model
+result_store = None
+if not args.disable_result_store:
+  result_store = ResultStore(
+      os.path.join(args.cache_dir_path, 'results.sqlite'),
+      models.fingerprint
   )
 
+timed_file_digest = timed(metrics, 'file_digest', file_digest)
+
+def digest(image_path):
+  # the image is hashed before any model reads it, so
+  # missing images are reported like the models do
+  if not os.path.exists(image_path):
+    raise FileNotFoundError('{} cannot be found!'.format(image_path))
+  return timed_file_digest(image_path)
+
+# profiles of single requests, see the profile command
+profiler = RequestProfiler(os.path.join(args.cache_dir_path, 'profiles'))
 
-def start_thread(fnc, message_prefix, image_path, image_id):
-  thread = threading.Thread(
-      target=fnc, 
-      args=(
-          message_prefix,
-          image_path,image_id,
+def stored_result(models, command, content_hash):
+  if result_store is None:
+    return None
+  with stage_timer(metrics, 'result_store_lookup'):
+    result = result_store.get(content_hash, command, models.fingerprint)
+  if command.startswith('explain') and result is not None and not os.path.exists(result):
+    # the explanation has been removed from the cache dir
+    return None
+  return result
+
+def store_result(models, command, content_hash, result):
+  if result_store is not None:
+    result_store.put(content_hash, command, result, models.fingerprint)
+
+def segment_list(models, image_paths):
+  segmentations = models.lung_segmenter.segment_list(image_paths, save_masks=False)
+  if mask_writer is not None:
+    for image_path, segmentation in zip(image_paths, segmentations):
+      mask_writer.submit(
+          timed(metrics, 'mask_write', save_masked_image),
+          image_path,
+          segmentation.original_image,
+          segmentation.mask,
+          segmentation.masked_image
       )
+  return segmentations
+
+def segment(models, image_ids, image_paths):
+  image_paths = dict(zip(image_ids, image_paths))
+  return models.segmentation_cache.get_or_compute_many(
+      image_ids,
+      lambda missing_image_ids: segment_list(models, [
+        image_paths[image_id] for image_id in missing_image_ids
+      ])
   )
-  thread.start()
-  return thread
 
+def classify_batch(requests, cached=True):
+  # during a model switch, a batch may hold requests of two versions
+  versions = {}
+  for index, (models, image_id, image_path) in enumerate(requests):
+    versions.setdefault(id(models), (models, []))[1].append(index)
+  classifications = [None] * len(requests)
+  for models, indices in versions.values():
+    image_ids = [requests[index][1] for index in indices]
+    image_paths = [requests[index][2] for index in indices]
+    segmentations = segment(models, image_ids, image_paths) if cached \
+        else segment_list(models, image_paths)
+    for index, classification in zip(indices, models.classifier.classify_arrays([
+        segmentation.masked_image
+        for segmentation in segmentations
+    ])):
+      classifications[index] = classification
+  return classifications
 
-active_treads = []
+# classifications arriving within a short period of time
+# are segmented and classified in a single batch
+classify_batcher = MicroBatcher(
+  classify_batch,
+  max_batch_size=args.max_batch_size,
+  max_wait=args.max_batch_wait / 1000
+)
 
-while len(data := sys.stdin.readline()):
-  sys.stdout.flush()
+# LIME explanations also depend on the explainer's settings, e.g. the
+# superpixel algorithm, so they are stored under a command per settings
+lime_command = 'explain_lime:' + json.dumps({
+  key: config['LIME'][key]
+  for key in ['KERNEL_WIDTH', 'FEATURE_SELECTION', 'NUM_FEATURES', 'NUM_SAMPLES',
+              'SEGMENTATION_ALGORITHM', 'COVID_ONLY']
+}, sort_keys=True)
 
-  # parse user input
-  user_input = str(data).strip().split(' ', 1)
-  if len(user_input) > 1:
-    image_path = os.path.join(
-        args.cache_dir_path,
-        user_input[1] + '.png'
+# cached=False runs the whole pipeline, e.g. to profile it
+def explain_lime(models, image_path, image_id, cached=True):
+  content_hash = digest(image_path)
+  explanation = stored_result(models, lime_command, content_hash) if cached else None
+  if explanation is None:
+    segmentation, = segment(models, [image_id], [image_path]) if cached \
+        else segment_list(models, [image_path])
+    # named after the masked image, like explanations of saved masks
+    explanation = models.lime_explainer().explain_array(
+        segmentation.masked_image,
+        masked_file_paths(image_path)[0],
+        segmentation.display_image
     )
+    store_result(models, lime_command, content_hash, explanation)
+  return explanation
 
-    if user_input[0] == "explain_lime":
-      active_treads.append(
-        start_thread(
-            explain_lime,
-            user_input[0] + " " + user_input[1],
-            image_path,
-            user_input[1]
-        )
-      )
-    elif user_input[0] == "explain_gradcam":
-      active_treads.append(
-        start_thread(
-            explain_gradcam,
-            user_input[0] + " " + user_input[1],
-            image_path,
-            user_input[1]
-        )
+def explain_gradcam(models, image_path, image_id, cached=True):
+  content_hash = digest(image_path)
+  explanation = stored_result(models, 'explain_gradcam', content_hash) if cached else None
+  if explanation is None:
+    segmentation, = segment(models, [image_id], [image_path]) if cached \
+        else segment_list(models, [image_path])
+    explanation, = models.gradcam_explainer().explain_arrays(
+        [segmentation.masked_image],
+        [masked_file_paths(image_path)[0]],
+        [segmentation.display_image]
+    )
+    store_result(models, 'explain_gradcam', content_hash, explanation)
+  return explanation
+
+def classify(models, image_path, image_id, cached=True):
+  content_hash = digest(image_path)
+  classification = stored_result(models, 'classify', content_hash) if cached else None
+  if classification is not None:
+    return json.loads(classification)
+  if cached:
+    # wait for the batch of concurrent classifications
+    classification = classify_batcher.submit((models, image_id, image_path)).result()
+  else:
+    classification = classify_batch([(models, image_id, image_path)], cached=False)[0]
+  store_result(models, 'classify', content_hash, json.dumps(classification))
+  return classification
+
+def classify_and_explain(models, image_path, image_id, cached=True):
+  if models.classifier.model is not models.gradcam_explainer().model:
+    # classify runs an inference export, whose results may differ
+    # from the ones of the Keras model Grad-CAM runs on
+    return {
+      'classification': classify(models, image_path, image_id, cached),
+      'explanation': explain_gradcam(models, image_path, image_id, cached)
+    }
+  # the classification is taken from the forward pass of Grad-CAM,
+  # the results are stored for classify and explain_gradcam as well
+  content_hash = digest(image_path)
+  classification = stored_result(models, 'classify', content_hash) if cached else None
+  explanation = stored_result(models, 'explain_gradcam', content_hash) if cached else None
+  if classification is not None and explanation is not None:
+    return {'classification': json.loads(classification), 'explanation': explanation}
+  segmentation, = segment(models, [image_id], [image_path]) if cached \
+      else segment_list(models, [image_path])
+  (explanation,), (prediction,) = models.gradcam_explainer().explain_and_predict_arrays(
+      [segmentation.masked_image],
+      [masked_file_paths(image_path)[0]],
+      [segmentation.display_image]
+  )
+  classification = models.classifier.to_class_probabilities(prediction)
+  store_result(models, 'classify', content_hash, json.dumps(classification))
+  store_result(models, 'explain_gradcam', content_hash, explanation)
+  return {'classification': classification, 'explanation': explanation}
+
+commands = {
+  'classify': classify,
+  'explain_lime': explain_lime,
+  'explain_gradcam': explain_gradcam,
+  'classify_and_explain': classify_and_explain
+}
+
+# requests are run on a bounded number of threads, queued
+# classifications are run before queued explanations
+worker_pool = PriorityWorkerPool(
+  max_workers={
+    'classify': args.classify_workers,
+    'explain_gradcam': args.gradcam_workers,
+    'classify_and_explain': args.gradcam_workers,
+    'explain_lime': args.lime_workers
+  },
+  priorities={
+    'classify': 0,
+    'explain_gradcam': 1,
+    'classify_and_explain': 1,
+    'explain_lime': 2
+  },
+  max_queue_size=args.max_queue_size
+)
+
+for command in commands:
+  metrics.gauge('queue_depth', lambda command=command: worker_pool.queue_depth(command), command=command)
+  metrics.gauge('in_flight', lambda command=command: worker_pool.in_flight(command), command=command)
+
+def cache_lookups(cache):
+  # caches which have not been created yet had no lookups
+  return (cache.hits, cache.misses) if cache is not None else (0, 0)
+
+def hit_ratio(cache):
+  hits, misses = cache_lookups(cache)
+  return hits / (hits + misses) if hits + misses else 0.0
+
+caches = {
+  'segmentation': lambda: model_switch.current.segmentation_cache,
+  'superpixels': lambda: model_switch.current.lime_explainer().segmentation_fn.cache
+      if model_switch.current.lime_explainer.created() else None,
+  'result_store': lambda: result_store
+}
+for cache_name, cache in caches.items():
+  metrics.gauge('cache_hits', lambda cache=cache: cache_lookups(cache())[0], cache=cache_name)
+  metrics.gauge('cache_misses', lambda cache=cache: cache_lookups(cache())[1], cache=cache_name)
+  metrics.gauge('cache_hit_ratio', lambda cache=cache: hit_ratio(cache()), cache=cache_name)
+
+def run_command(models, command, image_path, image_id, profile):
+  if profile:
+    # profile the whole pipeline instead of a cache hit
+    result, profile_paths = profiler.profile(
+        '{}_{}'.format(command, image_id),
+        commands[command], models, image_path, image_id, False)
+    return {'result': result, 'profile': profile_paths}
+  if random.random() < args.profile_sample_rate:
+    result, profile_paths = profiler.profile(
+        '{}_{}'.format(command, image_id),
+        commands[command], models, image_path, image_id)
+    print('profiled {} {}: {}'.format(command, image_id, json.dumps(profile_paths)),
+          file=sys.stderr, flush=True)
+    return result
+  return commands[command](models, image_path, image_id)
+
+def run(future, command, image_path, image_id, submitted, profile):
+  if not future.set_running_or_notify_cancel():
+    return
+  started = time.perf_counter()
+  metrics.observe('queue_wait_' + command, started - submitted)
+  # the request finishes on this version, even if the models are switched
+  models = model_switch.current
+  future.model_version = models.version
+  try:
+    future.set_result(run_command(models, command, image_path, image_id, profile))
+    metrics.increment('requests_total', command=command, outcome='success')
+  except Exception as exception:
+    traceback.print_exc()
+    metrics.increment('requests_total', command=command, outcome='error')
+    future.set_exception(exception)
+  metrics.observe('request_' + command, time.perf_counter() - submitted)
+
+def submit(command, image_id, profile=False):
+  """Queue a request and return a Future of its result.
+
+  If profile is True, the result is returned together with
+  the paths of the profiles of the request. Futures of commands
+  have a model_version attribute once the command is running.
+  """
+  if command == 'stats':
+    # answered right away, also while the queue is full
+    future = Future()
+    future.set_result(metrics.snapshot())
+    return future
+  if command == 'reload':
+    version = Future()
+    model_switch.reload().add_done_callback(
+        lambda reload: version.set_exception(reload.exception())
+        if reload.exception() is not None
+        else version.set_result({'model_version': reload.result()}))
+    return version
+  if command not in commands:
+    raise ValueError('unknown command {}'.format(command))
+  if not isinstance(image_id, str) or not image_id \
+      or os.path.basename(image_id) != image_id:
+    raise ValueError('invalid image id {}'.format(image_id))
+  image_path = os.path.join(
+      args.cache_dir_path,
+      image_id + '.png'
+  )
+  future = Future()
+  try:
+    worker_pool.submit(command, run, future, command, image_path, image_id,
+                       time.perf_counter(), bool(profile))
+  except QueueFullError:
+    metrics.increment('requests_total', command=command, outcome='rejected')
+    raise
+  return future
+
+def warm_up(models, command, image_paths):
+  # runs the pipeline of command without the caches, so that
+  # tracing and memory allocation happen before the first request
+  segmentations = models.lung_segmenter.segment_list(image_paths, save_masks=False)
+  masked_images = [segmentation.masked_image for segmentation in segmentations]
+  explanation_paths = [masked_file_paths(image_path)[0] for image_path in image_paths]
+  if command == 'classify':
+    models.classifier.classify_arrays(masked_images)
+  elif command == 'explain_gradcam':
+    models.gradcam_explainer().explain_arrays(
+        masked_images,
+        explanation_paths,
+        [segmentation.display_image for segmentation in segmentations]
+    )
+  else:
+    for segmentation, explanation_path in zip(segmentations, explanation_paths):
+      models.lime_explainer().explain_array(
+          segmentation.masked_image,
+          explanation_path,
+          segmentation.display_image
       )
-    elif user_input[0] == "classify":
-      active_treads.append(
-        start_thread(
-            classify,
-            user_input[0] + " " + user_input[1],
-            image_path,
-            user_input[1]
+
+def write_warm_up_images(warm_up_dir_path):
+  """Write --warm-up-batch-size synthetic images and return their paths."""
+  warm_up_image = np.random.RandomState(0).randint(0, 256, (1024, 1024), dtype=np.uint8)
+  warm_up_image_paths = []
+  for index in range(args.warm_up_batch_size):
+    warm_up_image_paths.append(os.path.join(warm_up_dir_path, 'warm_up_{}.png'.format(index)))
+    cv2.imwrite(warm_up_image_paths[-1], warm_up_image)
+  return warm_up_image_paths
+
+def warm_up_models(models):
+  """Return the duration of each warm-up command."""
+  timings = {}
+  with tempfile.TemporaryDirectory() as warm_up_dir_path:
+    warm_up_image_paths = write_warm_up_images(warm_up_dir_path)
+    for command in args.warm_up:
+      phase_started = time.perf_counter()
+      warm_up(models, command, warm_up_image_paths)
+      timings[command] = time.perf_counter() - phase_started
+  return timings
+
+if args.warm_up:
+  startup_timings['warm_up'] = warm_up_models(models)
+
+if args.thread_budget_trial:
+  # a trial of --auto-tune-threads, measures the warmed up
+  # classification pipeline at the tuning concurrency and exits
+  from tuning.thread_budget import measure_throughput
+
+  with tempfile.TemporaryDirectory() as warm_up_dir_path:
+    warm_up_image_paths = write_warm_up_images(warm_up_dir_path)
+    throughput = measure_throughput(
+        lambda: warm_up(models, 'classify', warm_up_image_paths),
+        len(warm_up_image_paths),
+        args.tuning_concurrency or args.classify_workers
+    )
+  print('throughput', throughput, flush=True)
+  sys.exit(0)
+
+def load_and_warm_up_models():
+  # runs in the background, the current version keeps serving
+  models = load_models()
+  warm_up_models(models)
+  return models
+
+model_switch = ModelSwitch(models, load_and_warm_up_models)
+# requests take their models from the switch
+del models
+if registry is not None and args.model_watch_interval > 0:
+  model_switch.watch(lambda: registry.latest()[0], args.model_watch_interval)
+
+def ready():
+  # machine-readable readiness signal for the node.js API
+  startup_timings['total'] = time.perf_counter() - started
+  startup_timings['model_version'] = model_switch.current.version
+  print('ready', json.dumps(startup_timings), flush=True)
+
+metrics_file_writer = None
+if args.metrics_file_path is not None:
+  metrics_file_path = args.metrics_file_path
+  if replica_index is not None:
+    # each replica writes its own file
+    root, extension = os.path.splitext(metrics_file_path)
+    metrics_file_path = '{}_replica{}{}'.format(root, replica_index, extension)
+  metrics_file_writer = PrometheusFileWriter(metrics, metrics_file_path, args.metrics_interval)
+
+if args.listen is not None:
+  # serve newline-delimited JSON requests of many clients on a socket
+  from serving.socket_server import SocketServer
+  SocketServer(submit, args.listen, ready=ready).serve_forever()
+else:
+  ready()
+  output_lock = threading.Lock()
+
+  def reply(message_prefix, result):
+    if not isinstance(result, str):
+      result = json.dumps(result)
+    with output_lock:
+      print(message_prefix, result, flush=True)
+
+  def reply_error(message_prefix, message):
+    reply(message_prefix, {'error': message})
+
+  def reply_future(message_prefix, future):
+    if future.exception() is not None:
+      reply_error(message_prefix, str(future.exception()))
+    elif hasattr(future, 'model_version'):
+      result = future.result()
+      if not isinstance(result, str):
+        result = json.dumps(result)
+      reply(message_prefix, '{}\t{}'.format(result, future.model_version))
+    else:
+      reply(message_prefix, future.result())
+
+  while len(data := sys.stdin.readline()):
+    sys.stdout.flush()
+
+    # parse user input
+    message_prefix = str(data).strip()
+    user_input = message_prefix.split(' ', 1)
+    profile = user_input[0] == 'profile' and len(user_input) > 1
+    if profile:
+      user_input = user_input[1].split(' ', 1)
+    if len(user_input) > 1 and (user_input[0] in commands or user_input[0] in ('stats', 'reload')):
+      try:
+        future = submit(user_input[0], user_input[1], profile)
+      except (QueueFullError, ValueError) as exception:
+        reply_error(message_prefix, str(exception))
+      else:
+        future.add_done_callback(
+            lambda future, message_prefix=message_prefix:
+              reply_future(message_prefix, future)
         )
-      )
 
-# Wait for each remaining active thread to stop
-for thread in active_treads:
-  thread.join()
\ No newline at end of file
+# Wait for all remaining requests to finish
+model_switch.close()
+worker_pool.shutdown()
+classify_batcher.close()
+if mask_writer is not None:
+  mask_writer.close()
+if result_store is not None:
+  result_store.close()
+if metrics_file_writer is not None:
+  metrics_file_writer.close()
@@ -0,0 +1,55 @@
+"""BackgroundWriter, which saves files off the request path."""
+
+import queue
+import sys
+import threading
+import traceback
+
+
+class BackgroundWriter():
+    """
+    Runs functions which save files on a background thread, so that
+    requests do not wait for files which are not part of their reply,
+    e.g. masks which are only kept for auditing.
+
+    Writing is best effort: while max_pending writes are waiting,
+    further writes are dropped instead of piling up images in memory.
+
+    Attributes
+    ----------
+    max_pending: int
+        maximum number of writes waiting for the background thread
+    """
+
+    def __init__(self, max_pending=32):
+        if max_pending < 1:
+            raise ValueError('max_pending must be at least 1!')
+        self.max_pending = max_pending
+        self.__queue = queue.Queue(max_pending)
+        self.__closed = object()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def submit(self, fn, *args):
+        """Queue fn(*args), return False if it has been dropped."""
+        try:
+            self.__queue.put_nowait((fn, args))
+        except queue.Full:
+            print('dropped background write, {} writes are pending'.format(
+                self.max_pending), file=sys.stderr, flush=True)
+            return False
+        return True
+
+    def close(self):
+        """Run all pending writes and stop the background thread."""
+        self.__queue.put(self.__closed)
+        self.__thread.join()
+
+    def __run(self):
+        """Run queued writes until the writer is closed."""
+        while (entry := self.__queue.get()) is not self.__closed:
+            fn, args = entry
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,103 @@
+"""MicroBatcher, which groups concurrent requests into batches."""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher():
+    """
+    Collects items submitted from multiple threads and processes
+    them in batches.
+
+    A batch is processed as soon as max_batch_size items are pending
+    or max_wait seconds have passed since the first pending item
+    arrived, whichever comes first.
+
+    Attributes
+    ----------
+    process_batch: callable
+        function which maps a list of items to a list of results
+        of the same length and order, otherwise the futures of
+        the items fail with ValueError
+    max_batch_size: int
+        maximum number of items per batch
+    max_wait: float
+        maximum time in seconds an item waits for other items
+        before its batch is processed
+    """
+
+    def __init__(self, process_batch, max_batch_size=16, max_wait=0.02):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1!')
+        if max_wait < 0:
+            raise ValueError('max_wait cannot be negative!')
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.__queue = queue.Queue()
+        self.__closed = object()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def submit(self, item):
+        """Queue item for processing.
+
+        Returns a concurrent.futures.Future, which holds the result
+        of item once the batch containing item has been processed.
+        """
+        future = Future()
+        self.__queue.put((item, future))
+        return future
+
+    def close(self):
+        """Process all pending items and stop the batcher."""
+        self.__queue.put(self.__closed)
+        self.__thread.join()
+
+    def __run(self):
+        """Collect pending items into batches until the batcher is closed."""
+        closed = False
+        while not closed:
+            entry = self.__queue.get()
+            if entry is self.__closed:
+                break
+            batch = [entry]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self.__queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if entry is self.__closed:
+                    closed = True
+                    break
+                batch.append(entry)
+            self.__process(batch)
+
+    def __process(self, batch):
+        """Process batch and pass each result to its future."""
+        try:
+            results = list(self.process_batch([item for item, _ in batch]))
+        except Exception as exception:
+            if len(batch) == 1:
+                batch[0][1].set_exception(exception)
+                return
+            # process the items one by one, so that a single
+            # faulty item does not fail the whole batch
+            for entry in batch:
+                self.__process([entry])
+            return
+        if len(results) != len(batch):
+            # the results cannot be mapped to the items
+            exception = ValueError('process_batch returned {} results for {} items!'.format(
+                len(results), len(batch)))
+            for _, future in batch:
+                future.set_exception(exception)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
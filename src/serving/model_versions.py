@@ -0,0 +1,117 @@
+"""ModelSwitch, which replaces the served models without downtime."""
+
+import sys
+import threading
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ModelVersion(namedtuple(
+        'ModelVersion',
+        ['version', 'fingerprint', 'classifier', 'lung_segmenter',
+         'gradcam_explainer', 'lime_explainer', 'segmentation_cache'])):
+    """
+    Models of a single version and the components using them.
+
+    Attributes
+    ----------
+    version: string
+        name of the version, which is included in replies
+    fingerprint: string
+        fingerprint of the model files, see caching.result_store
+    classifier: classification.classifier.Classfier
+        classifier running the classification model
+    lung_segmenter: segmentation.lung_segmenter.LungSegmenter
+        segmenter running the segmentation model
+    gradcam_explainer: callable
+        function returning the GradCAMExplainer of the version
+    lime_explainer: callable
+        function returning the LimeExplainer of the version
+    segmentation_cache: caching.artifact_cache.ArtifactCache
+        segmentations computed by the segmentation model of the version
+    """
+    __slots__ = ()
+
+
+class ModelSwitch():
+    """
+    Holds the served ModelVersion and switches to new versions.
+
+    New versions are loaded and warmed up on a background thread while
+    the current version keeps serving. The switch itself replaces a single
+    reference, so requests which took the current version before the switch
+    finish on it, and it is released once they are done.
+
+    Attributes
+    ----------
+    load: callable
+        function which loads, warms up and returns the latest ModelVersion
+    """
+
+    def __init__(self, current, load):
+        self.load = load
+        self.__current = current
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(1)
+        self.__pending = None
+        self.__stopped = threading.Event()
+        self.__watcher = None
+
+    @property
+    def current(self):
+        """Return the ModelVersion which serves new requests."""
+        return self.__current
+
+    def reload(self):
+        """Load the latest models and switch to them.
+
+        Returns a concurrent.futures.Future of the version served afterwards.
+        Reloads requested while a reload is running share its result.
+        """
+        with self.__lock:
+            if self.__pending is None or self.__pending.done():
+                self.__pending = self.__executor.submit(self.__reload)
+            return self.__pending
+
+    def watch(self, latest_version, interval):
+        """Reload whenever latest_version() returns another version.
+
+        latest_version is called every interval seconds, None means
+        that there is no version to switch to.
+        """
+        self.__watcher = threading.Thread(
+            target=self.__watch, args=(latest_version, interval), daemon=True)
+        self.__watcher.start()
+
+    def close(self):
+        """Stop watching and wait for a running reload."""
+        self.__stopped.set()
+        if self.__watcher is not None:
+            self.__watcher.join()
+        self.__executor.shutdown()
+
+    def __reload(self):
+        """Load the latest models and make them the current version."""
+        self.__current = self.load()
+        return self.__current.version
+
+    def __watch(self, latest_version, interval):
+        """Reload on new versions until the switch is closed.
+
+        A version which failed to load is not loaded again,
+        until latest_version() returns another version.
+        """
+        failed_version = None
+        while not self.__stopped.wait(interval):
+            try:
+                version = latest_version()
+                if version is None or version in (self.__current.version, failed_version):
+                    continue
+                print('switching to model version {}'.format(version),
+                      file=sys.stderr, flush=True)
+                failed_version = version
+                self.reload().result()
+                failed_version = None
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,269 @@
+"""ReplicaPool, which distributes requests over several server processes."""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+
+class _Replica():
+    """Worker process and the requests it has not answered yet."""
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.pending = []
+        self.stopped = False
+        self.ready = False
+        self.startup_timings = None
+
+
+class ReplicaPool():
+    """
+    Runs requests of the line protocol of server.py on several
+    worker processes, each with its own model replicas.
+
+    Each request is sent to the ready worker with the fewest unanswered
+    requests, or to the least loaded worker while none is ready, e.g.
+    at startup. Replies are forwarded to output in the order the workers
+    send them. A worker which exits unexpectedly is restarted and its
+    unanswered requests are sent to the workers again. A request which
+    was unanswered by max_attempts crashed workers, e.g. an image which
+    crashes OpenCV, is answered with a "worker crashed" error instead.
+
+    Each worker finds its index in the REPLICA_INDEX environment variable.
+    The "ready" lines of the workers are not forwarded. Once all
+    workers are ready, a single "ready" line with the startup
+    timings of each worker is written to output instead.
+
+    Attributes
+    ----------
+    command: list
+        command line which starts a worker process
+    num_replicas: int
+        number of worker processes
+    commands: list
+        request commands which are forwarded to the workers,
+        other requests are ignored
+    broadcast_commands: list
+        request commands which are forwarded to every worker,
+        e.g. to reload the models, each worker replies to them
+    aggregate_commands: list
+        request commands which are forwarded to every worker, e.g. to
+        collect their stats. The replies of the workers are combined into
+        a single reply {"replicas": [reply of each worker]}
+    env: dict
+        environment of the worker processes
+    output: file
+        file to which the replies are written
+    restart_delay: float
+        time in seconds to wait before restarting a crashed worker
+    max_attempts: int
+        number of workers a request may crash before it is answered
+        with an error
+    """
+
+    def __init__(self,
+                 command,
+                 num_replicas,
+                 commands,
+                 broadcast_commands=(),
+                 aggregate_commands=(),
+                 env=None,
+                 output=sys.stdout,
+                 restart_delay=1.0,
+                 max_attempts=2):
+        if num_replicas < 1:
+            raise ValueError('num_replicas must be at least 1!')
+        self.command = command
+        self.num_replicas = num_replicas
+        self.commands = set(commands)
+        self.broadcast_commands = set(broadcast_commands)
+        self.aggregate_commands = set(aggregate_commands)
+        self.env = env
+        self.output = output
+        self.restart_delay = restart_delay
+        self.max_attempts = max_attempts
+        self.__lock = threading.RLock()
+        self.__output_lock = threading.Lock()
+        self.__closing = False
+        self.__started = time.perf_counter()
+        self.__ready = False
+        # number of crashed workers per unanswered request
+        self.__crashes = {}
+        # replies per worker of unanswered aggregate requests
+        self.__aggregates = {}
+        self.__replicas = [_Replica(index) for index in range(num_replicas)]
+        self.__readers = []
+        for replica in self.__replicas:
+            self.__start(replica)
+            reader = threading.Thread(
+                target=self.__read, args=(replica,), daemon=True)
+            reader.start()
+            self.__readers.append(reader)
+
+    def submit(self, line):
+        """Send a request line to the least loaded worker."""
+        message = line.strip().split(' ', 1)
+        if len(message) < 2 or message[0] not in self.commands:
+            return
+        with self.__lock:
+            replicas = [replica for replica in self.__replicas if not replica.stopped]
+            if message[0] in self.broadcast_commands or message[0] in self.aggregate_commands:
+                if message[0] in self.aggregate_commands:
+                    self.__aggregates[' '.join(message)] = (len(replicas), {})
+                for replica in replicas:
+                    self.__send(replica, ' '.join(message))
+                return
+            # a restarted worker only gets requests once it is ready
+            replica = min(
+                [replica for replica in replicas if replica.ready] or replicas,
+                key=lambda replica: len(replica.pending)
+            )
+            self.__send(replica, ' '.join(message))
+
+    def load(self):
+        """Return the number of unanswered requests per worker."""
+        with self.__lock:
+            return [len(replica.pending) for replica in self.__replicas]
+
+    def close(self):
+        """Wait for all unanswered requests and stop the workers."""
+        with self.__lock:
+            self.__closing = True
+            for replica in self.__replicas:
+                try:
+                    replica.process.stdin.close()
+                except OSError:
+                    pass
+        for reader in self.__readers:
+            reader.join()
+
+    def __start(self, replica):
+        """Start the worker process of replica."""
+        env = dict(os.environ if self.env is None else self.env)
+        env['REPLICA_INDEX'] = str(replica.index)
+        replica.ready = False
+        replica.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+            text=True,
+            bufsize=1
+        )
+
+    def __send(self, replica, message):
+        """Send a request line to the worker, a broken pipe is handled by its reader."""
+        replica.pending.append(message)
+        try:
+            replica.process.stdin.write(message + '\n')
+            replica.process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    def __set_ready(self, replica, line):
+        """Write the ready line once every worker is ready."""
+        with self.__lock:
+            replica.ready = True
+            replica.startup_timings = json.loads(line[len('ready '):])
+            if self.__ready or any(
+                    other.startup_timings is None for other in self.__replicas):
+                return
+            self.__ready = True
+            startup_timings = {
+                'replicas': [other.startup_timings for other in self.__replicas],
+                'total': time.perf_counter() - self.__started
+            }
+        with self.__output_lock:
+            self.output.write('ready {}\n'.format(json.dumps(startup_timings)))
+            self.output.flush()
+
+    def __read(self, replica):
+        """Forward replies of the worker and restart it once it exits."""
+        while True:
+            process = replica.process
+            for line in process.stdout:
+                if line.startswith('ready '):
+                    self.__set_ready(replica, line)
+                    continue
+                with self.__lock:
+                    # replies start with their request line
+                    for message in replica.pending:
+                        if line.startswith(message + ' '):
+                            replica.pending.remove(message)
+                            self.__crashes.pop(message, None)
+                            if message in self.__aggregates:
+                                line = self.__aggregate(
+                                    message, replica, line[len(message) + 1:].strip())
+                            break
+                if line is None:
+                    continue
+                with self.__output_lock:
+                    self.output.write(line)
+                    self.output.flush()
+            process.wait()
+            with self.__lock:
+                if self.__closing and not replica.pending:
+                    replica.stopped = True
+                    return
+            print(
+                'replica {} exited with code {}, restarting'.format(
+                    replica.index, process.returncode),
+                file=sys.stderr,
+                flush=True
+            )
+            time.sleep(self.restart_delay)
+            with self.__lock:
+                pending, replica.pending = replica.pending, []
+                pending = self.__retried(replica, pending)
+                self.__start(replica)
+                if self.__closing:
+                    # the other workers do not accept requests anymore
+                    for message in pending:
+                        self.__send(replica, message)
+                    replica.process.stdin.close()
+                else:
+                    for message in pending:
+                        if message.split(' ', 1)[0] in self.broadcast_commands or \
+                                message in self.__aggregates:
+                            # the other workers have got it already
+                            self.__send(replica, message)
+                        else:
+                            self.submit(message)
+
+    def __aggregate(self, message, replica, reply):
+        """Collect the reply of replica, return the combined reply once every worker replied."""
+        num_replies, replies = self.__aggregates[message]
+        try:
+            replies[replica.index] = json.loads(reply)
+        except ValueError:
+            replies[replica.index] = reply
+        if len(replies) < num_replies:
+            return None
+        del self.__aggregates[message]
+        return '{} {}\n'.format(message, json.dumps(
+            {'replicas': [replies[index] for index in sorted(replies)]}))
+
+    def __retried(self, replica, messages):
+        """Return the messages to send again, the others are answered with an error."""
+        retried = []
+        for message in messages:
+            self.__crashes[message] = self.__crashes.get(message, 0) + 1
+            if self.__crashes[message] < self.max_attempts:
+                retried.append(message)
+                continue
+            del self.__crashes[message]
+            print('request {} crashed {} workers, giving up'.format(
+                message, self.max_attempts), file=sys.stderr, flush=True)
+            line = '{} {}\n'.format(message, json.dumps({'error': 'worker crashed'}))
+            if message in self.__aggregates:
+                line = self.__aggregate(message, replica, json.dumps({'error': 'worker crashed'}))
+                if line is None:
+                    continue
+            with self.__output_lock:
+                self.output.write(line)
+                self.output.flush()
+        return retried
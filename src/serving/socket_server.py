@@ -0,0 +1,128 @@
+"""SocketServer, which serves requests of many clients over a socket."""
+
+import asyncio
+import json
+import os
+import signal
+
+from serving.worker_pool import QueueFullError
+
+
+def error_code(exception):
+    """Return the protocol error code of an exception."""
+    if isinstance(exception, QueueFullError):
+        return 'queue_full'
+    if isinstance(exception, FileNotFoundError):
+        return 'not_found'
+    if isinstance(exception, ValueError):
+        return 'invalid_request'
+    return 'internal'
+
+
+class SocketServer():
+    """
+    Serves requests over a Unix or TCP socket using
+    newline-delimited JSON.
+
+    A request is a JSON object on a single line, e.g.
+    {"id": 1, "command": "classify", "image_id": "f00091ff-cb7a"}.
+    With "profile": true, the request is profiled and its result
+    contains the paths of the profiles. Replies to requests which ran
+    on the models contain their version as "model_version".
+    Each request is answered with a JSON object on a single line which
+    contains the id of the request and either its "result" or an "error"
+    object with "code" and "message". Clients may send further requests
+    before previous ones are answered, replies are sent as soon as their
+    request is done and thus possibly out of order.
+
+    Attributes
+    ----------
+    submit: callable
+        function which maps a command, an image id and whether
+        to profile to a concurrent.futures.Future of the result,
+        which may have a model_version attribute
+    address: string
+        "unix:PATH" for a Unix socket or "HOST:PORT" for a TCP socket
+    ready: callable
+        function called once the socket accepts connections
+    """
+
+    def __init__(self, submit, address, ready=None):
+        self.submit = submit
+        self.address = address
+        self.ready = ready
+
+    def serve_forever(self):
+        """Serve requests until SIGINT or SIGTERM is received."""
+        asyncio.run(self.__serve())
+
+    async def __serve(self):
+        """Start the server and wait for a stop signal."""
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, stopped.set)
+
+        if self.address.startswith('unix:'):
+            socket_path = self.address[len('unix:'):]
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.__handle, path=socket_path)
+        else:
+            host, _, port = self.address.rpartition(':')
+            server = await asyncio.start_server(self.__handle, host or None, int(port))
+
+        async with server:
+            if self.ready is not None:
+                self.ready()
+            await stopped.wait()
+
+    async def __handle(self, reader, writer):
+        """Answer all requests of a single client connection."""
+        write_lock = asyncio.Lock()
+        pending = set()
+        try:
+            while line := await reader.readline():
+                if not line.strip():
+                    continue
+                task = asyncio.create_task(self.__answer(line, writer, write_lock))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            # the client went away or sent an oversized line
+            for task in pending:
+                task.cancel()
+        finally:
+            writer.close()
+
+    async def __answer(self, line, writer, write_lock):
+        """Run a single request and write its reply."""
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+            request_id = request.get('id')
+            future = self.submit(
+                request.get('command'),
+                request.get('image_id'),
+                bool(request.get('profile'))
+            )
+            reply = {'id': request_id, 'result': await asyncio.wrap_future(future)}
+            if hasattr(future, 'model_version'):
+                reply['model_version'] = future.model_version
+        except asyncio.CancelledError:
+            raise
+        except Exception as exception:
+            reply = {
+                'id': request_id,
+                'error': {
+                    'code': error_code(exception),
+                    'message': str(exception)
+                }
+            }
+        async with write_lock:
+            writer.write((json.dumps(reply) + '\n').encode('utf-8'))
+            await writer.drain()
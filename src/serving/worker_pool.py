@@ -0,0 +1,112 @@
+"""PriorityWorkerPool, which runs requests on a bounded number of threads."""
+
+import threading
+import traceback
+from collections import deque
+
+
+class QueueFullError(Exception):
+    """Raised when a task is submitted to a pool whose queue is full."""
+
+
+class PriorityWorkerPool():
+    """
+    Runs tasks of different types on a bounded number of threads.
+
+    Each task type has its own limit of concurrently running tasks.
+    Whenever a thread becomes idle, it picks the queued task with
+    the highest priority whose type has not reached its limit.
+
+    Attributes
+    ----------
+    max_workers: dict
+        maximum number of concurrently running tasks per task type
+    priorities: dict
+        priority per task type, lower values are run first
+    max_queue_size: int
+        maximum number of queued tasks, further tasks are rejected
+    """
+
+    def __init__(self, max_workers, priorities, max_queue_size=64):
+        if set(max_workers) != set(priorities):
+            raise ValueError('max_workers and priorities must have the same task types!')
+        if any(workers < 1 for workers in max_workers.values()):
+            raise ValueError('max_workers must be at least 1 per task type!')
+        self.max_workers = dict(max_workers)
+        self.priorities = dict(priorities)
+        self.max_queue_size = max_queue_size
+        self.__task_types = sorted(self.priorities, key=self.priorities.get)
+        self.__queues = {task_type: deque() for task_type in self.__task_types}
+        self.__running = {task_type: 0 for task_type in self.__task_types}
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__threads = [
+            threading.Thread(target=self.__work, daemon=True)
+            for _ in range(sum(self.max_workers.values()))
+        ]
+        for thread in self.__threads:
+            thread.start()
+
+    def submit(self, task_type, fn, *args):
+        """Queue fn(*args) as a task of task_type.
+
+        Raises QueueFullError if max_queue_size tasks are queued already.
+        """
+        with self.__condition:
+            if self.__closed:
+                raise RuntimeError('cannot submit to a pool which has been shut down!')
+            if self.queue_depth() >= self.max_queue_size:
+                raise QueueFullError(
+                    'queue is full ({} tasks)'.format(self.max_queue_size))
+            self.__queues[task_type].append((fn, args))
+            self.__condition.notify()
+
+    def queue_depth(self, task_type=None):
+        """Return the number of queued tasks, optionally of one task type."""
+        with self.__condition:
+            if task_type is not None:
+                return len(self.__queues[task_type])
+            return sum(len(tasks) for tasks in self.__queues.values())
+
+    def in_flight(self, task_type=None):
+        """Return the number of running tasks, optionally of one task type."""
+        with self.__condition:
+            if task_type is not None:
+                return self.__running[task_type]
+            return sum(self.__running.values())
+
+    def shutdown(self):
+        """Run all queued tasks and stop the threads."""
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        for thread in self.__threads:
+            thread.join()
+
+    def __next_task(self):
+        """Return the next runnable task or None."""
+        for task_type in self.__task_types:
+            if self.__queues[task_type] and \
+                    self.__running[task_type] < self.max_workers[task_type]:
+                return task_type, self.__queues[task_type].popleft()
+        return None
+
+    def __work(self):
+        """Run tasks until the pool is shut down and all tasks are done."""
+        while True:
+            with self.__condition:
+                while (task := self.__next_task()) is None:
+                    if self.__closed and self.queue_depth() == 0:
+                        return
+                    self.__condition.wait()
+                task_type, (fn, args) = task
+                self.__running[task_type] += 1
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.__condition:
+                    self.__running[task_type] -= 1
+                    # a task of this type may be runnable now
+                    self.__condition.notify_all()
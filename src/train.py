@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+import argparse
+parser = argparse.ArgumentParser(description=
+'''Covid-19-Classification Fine-Tuning Worker
+
+Fine-tunes the served classification model on the labeled
+X-Ray images which were added to the training queue of the
+API (TRAINING_DIR_PATH/queue.json) since the last run.
+
+New images are masked with the segmentation model like the
+server does, the model is fine-tuned with the fine-tuning
+settings of the training notebook and evaluated on the
+held-out test CSV. Only if no metric regresses, the model is
+published as new version in MODELS_DIR_PATH.
+
+The served model is the latest version in MODELS_DIR_PATH,
+or MODEL_PATH as long as no version has been published.
+''',
+formatter_class=argparse.RawTextHelpFormatter
+)
+parser.add_argument(
+    '-c',
+    '--model-path',
+    required=True,
+    dest='model_path',
+    help='path to the initial classification model'
+)
+parser.add_argument(
+    '-s',
+    '--segmentation-model-path',
+    required=True,
+    dest='segmentation_model_path',
+    help='path to segmentation model'
+)
+parser.add_argument(
+    '--training-dir-path',
+    required=True,
+    dest='training_dir_path',
+    help='path to training queue dir'
+)
+parser.add_argument(
+    '--models-dir-path',
+    required=True,
+    dest='models_dir_path',
+    help='directory of the published model versions'
+)
+parser.add_argument(
+    '--test-csv-path',
+    required=True,
+    dest='test_csv_path',
+    help='held-out CSV, e.g. test_set.csv of the training notebook'
+)
+parser.add_argument(
+    '--file-path-column',
+    default='masked_filename',
+    dest='file_path_column',
+    help='column of the masked X-Ray images in the test CSV'
+)
+parser.add_argument(
+    '--label-column',
+    default='label',
+    dest='label_column',
+    help='column of the true classes in the test CSV'
+)
+parser.add_argument(
+    '--learning-rate',
+    type=float,
+    default=1e-6,
+    dest='learning_rate',
+    help='learning rate, FT_LR of the training notebook'
+)
+parser.add_argument(
+    '--batch-size',
+    type=int,
+    default=10,
+    dest='batch_size',
+    help='batch size, FT_BATCH_SIZE of the training notebook'
+)
+parser.add_argument(
+    '--epochs',
+    type=int,
+    default=3,
+    dest='epochs',
+    help='epochs over the new images'
+)
+parser.add_argument(
+    '--min-new-items',
+    type=int,
+    default=1,
+    dest='min_new_items',
+    help='minimum number of new queue items to fine-tune on'
+)
+parser.add_argument(
+    '--max-metric-drop',
+    type=float,
+    default=0.0,
+    dest='max_metric_drop',
+    help='drop of accuracy, AUC-ROC or AUC-PR on the test CSV\nwhich counts as regression'
+)
+parser.add_argument(
+    '--inference-format',
+    choices=['none', 'tflite', 'saved_model'],
+    default='none',
+    dest='inference_format',
+    help='also publish an export of the model to this inference\nbackend, which server.py uses like --inference-model-path'
+)
+parser.add_argument(
+    '--quantization',
+    choices=['none', 'float16', 'int8'],
+    default='float16',
+    dest='quantization',
+    help='quantization of TFLite exports, int8 is calibrated\nwith the images of the test CSV'
+)
+parser.add_argument(
+    '--watch-interval',
+    type=float,
+    default=0,
+    dest='watch_interval',
+    help='seconds between two checks of the queue,\n0 fine-tunes once and exits'
+)
+args = parser.parse_args()
+
+import json
+import os
+import logging
+import sys
+import time
+
+# silence tensorflow
+logging.getLogger('tensorflow').setLevel(logging.ERROR)
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import pandas as pd
+import tensorflow as tf
+tf.get_logger().setLevel('ERROR')
+
+from inference.exporting import classifier_inputs, export_saved_model, export_tflite
+from segmentation.lung_segmenter import LungSegmenter
+from training.fine_tuning import (fine_tune, load_state, new_queue_items,
+                                  regressions, save_state, split_readable_items)
+from training.model_registry import ModelRegistry
+
+lung_segmenter = LungSegmenter(args.segmentation_model_path)
+registry = ModelRegistry(args.models_dir_path)
+test_dataframe = pd.read_csv(args.test_csv_path)
+
+def export_inference_model(model, version_dir_path):
+  # the same exports as export_model.py
+  export_path = os.path.join(
+      version_dir_path, registry.INFERENCE_MODEL_FILE_NAMES[args.inference_format])
+  if args.inference_format == 'saved_model':
+    return export_saved_model(model, export_path)
+  representative_images = None
+  if args.quantization == 'int8':
+    representative_images = list(classifier_inputs(
+        test_dataframe[args.file_path_column].head(200), model.input_shape[1:3]))
+  return export_tflite(model, export_path, args.quantization, representative_images)
+
+def run_once():
+  state = load_state(args.training_dir_path)
+  items, unreadable = split_readable_items(
+      args.training_dir_path, new_queue_items(args.training_dir_path, state))
+  if unreadable:
+    # bad uploads are skipped for good instead of failing every run
+    skipped = [item['id'] for item in unreadable]
+    print('skipping unreadable queue items {}'.format(skipped), file=sys.stderr, flush=True)
+    state['consumed'].extend(skipped)
+    state['skipped'].extend(skipped)
+    save_state(args.training_dir_path, state)
+  if len(items) < args.min_new_items:
+    return None
+  version, model_path = registry.latest()
+  if model_path is None:
+    model_path = args.model_path
+  model = tf.keras.models.load_model(model_path, compile=False)
+  candidate, metrics = fine_tune(
+      model,
+      items,
+      args.training_dir_path,
+      lung_segmenter,
+      test_dataframe,
+      args.file_path_column,
+      args.label_column,
+      learning_rate=args.learning_rate,
+      batch_size=args.batch_size,
+      epochs=args.epochs
+  )
+  regressed = regressions(metrics['candidate'], metrics['reference'], args.max_metric_drop)
+  run = {
+    'started_from': version or os.path.abspath(args.model_path),
+    'items': [item['id'] for item in items],
+    'metrics': metrics,
+    'regressions': regressed,
+    'published': None
+  }
+  if not regressed:
+    run['published'] = registry.publish(
+        candidate,
+        {key: run[key] for key in ('started_from', 'items', 'metrics')},
+        export_inference_model if args.inference_format != 'none' else None
+    )
+  # the items are consumed either way, a rejected model is not retrained on them
+  state['consumed'].extend(run['items'])
+  state['runs'].append(dict(run, finished=time.strftime('%Y-%m-%d %H:%M:%S')))
+  save_state(args.training_dir_path, state)
+  return run
+
+while True:
+  try:
+    run = run_once()
+  except Exception as error:
+    # e.g. queue.json is being rewritten by the API,
+    # the worker keeps watching and retries the items
+    if args.watch_interval <= 0:
+      raise
+    print('fine-tuning failed: {}'.format(error), file=sys.stderr, flush=True)
+    run = None
+  if run is not None:
+    print(json.dumps(run), flush=True)
+  if args.watch_interval <= 0:
+    break
+  time.sleep(args.watch_interval)
+sys.exit(0 if run is None or run['published'] else 1)
@@ -0,0 +1,163 @@
+"""Incremental fine-tuning on the items of the training queue.
+
+The API appends labeled X-Ray images to queue.json in the training
+directory. A fine-tuning run takes the items which were added since the
+last run, masks them like the server does, fine-tunes the served model
+on them with the fine-tuning settings of training.ipynb and evaluates
+it on the held-out test CSV. See train.py.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from PIL import Image
+
+from preprocessing.dataset_preprocessing import preprocess
+from training.input_pipeline import class_indices, make_dataset
+
+# FT_LR and FT_BATCH_SIZE of training.ipynb
+FINE_TUNING_LEARNING_RATE = 1e-6
+FINE_TUNING_BATCH_SIZE = 10
+CLASSES = ['COVID-19', 'NO FINDING']
+STATE_FILE_NAME = 'fine_tuning_state.json'
+
+
+def load_state(training_dir_path):
+    """Return the fine-tuning state, i.e. the consumed and skipped queue items and past runs."""
+    state_path = os.path.join(training_dir_path, STATE_FILE_NAME)
+    if not os.path.exists(state_path):
+        return {'consumed': [], 'skipped': [], 'runs': []}
+    with open(state_path) as state_file:
+        return dict({'skipped': []}, **json.load(state_file))
+
+
+def save_state(training_dir_path, state):
+    """Atomically save the fine-tuning state."""
+    state_path = os.path.join(training_dir_path, STATE_FILE_NAME)
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def new_queue_items(training_dir_path, state):
+    """Return the queue items which have not been consumed yet.
+
+    Items whose image has not been uploaded yet and items with unknown
+    classes are left for a later run.
+    """
+    with open(os.path.join(training_dir_path, 'queue.json')) as queue_file:
+        queue = json.load(queue_file)
+    consumed = set(state['consumed'])
+    return [
+        item for item in queue
+        if item.get('id') not in consumed
+        and item.get('class') in CLASSES
+        and os.path.exists(queue_image_path(training_dir_path, item))
+    ]
+
+
+def queue_image_path(training_dir_path, item):
+    """Return the path of the image of a queue item."""
+    return os.path.join(training_dir_path, item['id'] + '.png')
+
+
+def split_readable_items(training_dir_path, items):
+    """Return the items whose image can be decoded and the other items.
+
+    The API stores any uploaded body as image, so that an item may hold
+    e.g. a truncated file, which would fail every run it is part of.
+    """
+    readable = []
+    unreadable = []
+    for item in items:
+        try:
+            with Image.open(queue_image_path(training_dir_path, item)) as img:
+                img.load()
+        except Exception:
+            unreadable.append(item)
+        else:
+            readable.append(item)
+    return readable, unreadable
+
+
+def evaluate(model, dataset):
+    """Return accuracy, AUC-ROC and AUC-PR of model on dataset.
+
+    Predictions are probabilities of the class with index 1, like the
+    sigmoid output of the classification model.
+    """
+    labels = np.concatenate([batch_labels.numpy() for _, batch_labels in dataset])
+    predictions = np.asarray(model.predict(dataset)).reshape(-1)
+    metrics = {}
+    for name, curve in (('auc_roc', 'ROC'), ('auc_pr', 'PR')):
+        auc = tf.keras.metrics.AUC(curve=curve)
+        auc.update_state(labels, predictions)
+        metrics[name] = float(auc.result().numpy())
+    metrics['accuracy'] = float(np.mean((predictions > 0.5) == (labels > 0.5)))
+    return metrics
+
+
+def regressions(candidate_metrics, reference_metrics, tolerance=0.0):
+    """Return the names of the metrics which dropped by more than tolerance."""
+    return [
+        name for name, reference in reference_metrics.items()
+        if candidate_metrics[name] < reference - tolerance
+    ]
+
+
+def fine_tune(model,
+              items,
+              training_dir_path,
+              lung_segmenter,
+              test_dataframe,
+              file_path_column='masked_filename',
+              label_column='label',
+              learning_rate=FINE_TUNING_LEARNING_RATE,
+              batch_size=FINE_TUNING_BATCH_SIZE,
+              epochs=3,
+              image_size=331,
+              seed=42):
+    """Return the fine-tuned copy of model and the metrics of both models.
+
+    The images of the queue items are preprocessed incrementally into
+    training_dir_path/preprocessed, see preprocessing.dataset_preprocessing,
+    so every image is masked only once. Like the fine-tuning in
+    training.ipynb, the whole model including NASNet is trained.
+    """
+    classes = class_indices(CLASSES)
+    output_file_paths = preprocess(
+        [queue_image_path(training_dir_path, item) for item in items],
+        os.path.join(training_dir_path, 'preprocessed'),
+        lung_segmenter,
+        image_size=image_size
+    )
+    train_dataframe = pd.DataFrame({
+        'masked_filename': [masked_file_path for _, masked_file_path in output_file_paths],
+        'label': [item['class'] for item in items]
+    })
+    train_dataset = make_dataset(
+        train_dataframe, classes, batch_size=batch_size, training=True, seed=seed)
+    test_dataset = make_dataset(
+        test_dataframe, classes, file_path_column, label_column, batch_size=batch_size)
+
+    reference_metrics = evaluate(model, test_dataset)
+    candidate = tf.keras.models.clone_model(model)
+    candidate.set_weights(model.get_weights())
+    for layer in candidate.layers:
+        layer.trainable = True
+    candidate.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+        loss='binary_crossentropy'
+    )
+    started = time.perf_counter()
+    candidate.fit(train_dataset, epochs=epochs, verbose=0)
+    training_seconds = time.perf_counter() - started
+    return candidate, {
+        'reference': reference_metrics,
+        'candidate': evaluate(candidate, test_dataset),
+        'training_seconds': training_seconds
+    }
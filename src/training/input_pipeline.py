@@ -0,0 +1,173 @@
+"""tf.data input pipeline for training the classification model.
+
+Replaces ImageDataGenerator.flow_from_dataframe of training.ipynb with
+the same semantics: images are decoded as RGB, resized to image_size
+with nearest neighbour interpolation, training images are rotated by
+up to 10 degrees and every image is standardized samplewise to zero
+mean and unit standard deviation. Labels are the indices of the
+classes in alphabetical order, like class_mode='binary' creates them.
+
+Unlike the generators, images are decoded in parallel, decoded images
+are cached in memory or on disk as uint8 tensors, so that they are
+decoded only once, and batches are prefetched while the model trains.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+# the defaults of ImageDataGenerator
+ROTATION_RANGE = 10
+EPSILON = 1e-6
+
+
+def class_indices(labels):
+    """Return the index of each class, in alphabetical order like flow_from_dataframe."""
+    return {label: index for index, label in enumerate(sorted(set(labels)))}
+
+
+def decode_image(file_path, image_size):
+    """Return the image file as uint8 RGB tensor of shape image_size + (3,).
+
+    Resizes like load_image of classification.image_loading, i.e.
+    with the nearest neighbour interpolation of PIL.
+    """
+    img = tf.io.decode_image(
+        tf.io.read_file(file_path), channels=3, expand_animations=False)
+    img = tf.image.resize(img, image_size, method='nearest')
+    return tf.cast(img, tf.uint8)
+
+
+def standardize(images):
+    """Return the images standardized samplewise.
+
+    Same as samplewise_center and samplewise_std_normalization of
+    ImageDataGenerator: each image is centered to zero mean and divided
+    by its standard deviation plus a small epsilon, over all channels.
+    """
+    images = tf.cast(images, tf.float32)
+    axes = [-3, -2, -1]
+    mean, variance = tf.nn.moments(images, axes=axes, keepdims=True)
+    return (images - mean) / (tf.sqrt(variance) + EPSILON)
+
+
+def random_rotation(rotation_range=ROTATION_RANGE, seed=None):
+    """Return a layer rotating each image of a batch by up to rotation_range degrees.
+
+    Like the rotation of ImageDataGenerator, the image is rotated around
+    its center with bilinear interpolation and the corners are filled
+    with the nearest pixels.
+    """
+    # the layer moved out of experimental.preprocessing in tensorflow 2.6
+    random_rotation_layer = getattr(tf.keras.layers, 'RandomRotation', None)
+    if random_rotation_layer is None:
+        random_rotation_layer = tf.keras.layers.experimental.preprocessing.RandomRotation
+    return random_rotation_layer(
+        rotation_range / 360,
+        fill_mode='nearest',
+        interpolation='bilinear',
+        seed=seed
+    )
+
+
+def cache_file_path(cache_dir_path, file_paths, labels, image_size, num_shards, shard_index):
+    """Return the path of the on-disk cache of a dataset.
+
+    The path depends on the images, the labels and the image size,
+    so a changed CSV never reads a stale cache.
+    """
+    key = json.dumps([list(file_paths), list(labels), list(image_size),
+                      num_shards, shard_index])
+    return os.path.join(
+        cache_dir_path, hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+
+
+def make_dataset(dataframe,
+                 classes,
+                 file_path_column='masked_filename',
+                 label_column='label',
+                 image_size=(331, 331),
+                 batch_size=32,
+                 training=False,
+                 cache='memory',
+                 cache_dir_path=None,
+                 num_shards=1,
+                 shard_index=0,
+                 seed=42):
+    """Return a tf.data.Dataset of batches of standardized images and labels.
+
+    classes maps each label to its index, see class_indices. Training
+    datasets are shuffled and rotated, the order of other datasets is the
+    one of the dataframe. Decoded images are cached in memory (cache='memory'),
+    in files in cache_dir_path (cache='disk') or not at all (cache=None).
+    With num_shards > 1, the dataset holds every num_shards-th image starting
+    at shard_index, e.g. for one of several training workers. The shuffle
+    and the rotations use seed, the rotations are drawn serially, so
+    that repeated runs rotate each batch by the same angles.
+    """
+    file_paths = list(dataframe[file_path_column].astype(str))
+    labels = [classes[label] for label in dataframe[label_column].astype(str)]
+    dataset = tf.data.Dataset.from_tensor_slices(
+        (file_paths, np.asarray(labels, dtype=np.float32)))
+    if num_shards > 1:
+        # before decoding, so that each worker only decodes its own images
+        dataset = dataset.shard(num_shards, shard_index)
+    dataset = dataset.map(
+        lambda file_path, label: (decode_image(file_path, image_size), label),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=True
+    )
+    if cache == 'memory':
+        dataset = dataset.cache()
+    elif cache == 'disk':
+        if cache_dir_path is None:
+            raise ValueError('cache_dir_path is required to cache on disk')
+        os.makedirs(cache_dir_path, exist_ok=True)
+        dataset = dataset.cache(cache_file_path(
+            cache_dir_path, file_paths, labels, image_size, num_shards, shard_index))
+    elif cache is not None:
+        raise ValueError('unknown cache {}'.format(cache))
+
+    if training:
+        dataset = dataset.shuffle(
+            len(file_paths), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    if training:
+        rotation = random_rotation(seed=seed)
+        # not in parallel, the layer draws the angles from a stateful
+        # generator, so parallel calls would draw them in any order
+        dataset = dataset.map(
+            lambda images, labels: (rotation(images, training=True), labels))
+    dataset = dataset.map(
+        lambda images, labels: (standardize(images), labels),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=True
+    )
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_datasets(csv_paths, batch_size=32, **kwargs):
+    """Return the datasets and the class indices of the train, val and test CSVs.
+
+    csv_paths maps 'TRAIN', 'VAL' and 'TEST' to the CSVs of the training
+    notebook. The train dataset is shuffled and rotated. The classes are
+    indexed by the labels of the train CSV. See make_dataset for the kwargs.
+    """
+    dataframes = {name: pd.read_csv(csv_path) for name, csv_path in csv_paths.items()}
+    classes = class_indices(
+        dataframes['TRAIN'][kwargs.get('label_column', 'label')].astype(str))
+    datasets = {
+        name: make_dataset(
+            dataframe,
+            classes,
+            batch_size=batch_size,
+            training=name == 'TRAIN',
+            **kwargs
+        )
+        for name, dataframe in dataframes.items()
+    }
+    return datasets, classes
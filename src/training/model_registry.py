@@ -0,0 +1,92 @@
+"""ModelRegistry, which publishes versioned classification models."""
+
+import json
+import os
+import time
+
+
+class ModelRegistry():
+    """
+    Directory of versioned classification models.
+
+    Each version is a subdirectory named after its creation time, e.g.
+    20201012-143000, holding model.h5, metadata.json and optionally an
+    export of the model to an inference backend, inference_model.tflite
+    or the SavedModel inference_model, see export_model.py. The file LATEST
+    names the version to serve, it is replaced atomically once a version
+    is complete, so readers never see a partially written model.
+
+    Attributes
+    ----------
+    models_dir_path: string
+        directory of the versions
+    """
+
+    MODEL_FILE_NAME = 'model.h5'
+    METADATA_FILE_NAME = 'metadata.json'
+    LATEST_FILE_NAME = 'LATEST'
+    INFERENCE_MODEL_FILE_NAMES = {
+        'tflite': 'inference_model.tflite',
+        'saved_model': 'inference_model'
+    }
+
+    def __init__(self, models_dir_path):
+        self.models_dir_path = models_dir_path
+        os.makedirs(models_dir_path, exist_ok=True)
+
+    def latest(self):
+        """Return the latest version and the path of its model, or (None, None)."""
+        latest_path = os.path.join(self.models_dir_path, self.LATEST_FILE_NAME)
+        try:
+            with open(latest_path) as latest_file:
+                version = latest_file.read().strip()
+        except FileNotFoundError:
+            return None, None
+        return version, self.model_path(version)
+
+    def model_path(self, version):
+        """Return the path of the model of version."""
+        return os.path.join(self.models_dir_path, version, self.MODEL_FILE_NAME)
+
+    def inference_model_path(self, version):
+        """Return the path of the inference export of version, or None."""
+        for file_name in self.INFERENCE_MODEL_FILE_NAMES.values():
+            inference_model_path = os.path.join(self.models_dir_path, version, file_name)
+            if os.path.exists(inference_model_path):
+                return inference_model_path
+        return None
+
+    def metadata(self, version):
+        """Return the metadata published with version."""
+        with open(os.path.join(
+                self.models_dir_path, version, self.METADATA_FILE_NAME)) as metadata_file:
+            return json.load(metadata_file)
+
+    def publish(self, model, metadata, export=None):
+        """Save model as new latest version and return the version.
+
+        export is called with the model and the directory of the version
+        before the version becomes the latest one, e.g. to export the model
+        to an inference backend. It returns the path of the export.
+        """
+        version = time.strftime('%Y%m%d-%H%M%S')
+        version_dir_path = os.path.join(self.models_dir_path, version)
+        suffix = 1
+        while os.path.exists(version_dir_path):
+            suffix += 1
+            version_dir_path = os.path.join(
+                self.models_dir_path, '{}-{}'.format(version, suffix))
+        version = os.path.basename(version_dir_path)
+        os.makedirs(version_dir_path)
+        model.save(os.path.join(version_dir_path, self.MODEL_FILE_NAME))
+        if export is not None:
+            metadata = dict(
+                metadata, inference_model=os.path.basename(export(model, version_dir_path)))
+        with open(os.path.join(version_dir_path, self.METADATA_FILE_NAME), 'w') as metadata_file:
+            json.dump(dict(metadata, version=version), metadata_file, indent=2)
+
+        latest_path = os.path.join(self.models_dir_path, self.LATEST_FILE_NAME)
+        with open(latest_path + '.tmp', 'w') as latest_file:
+            latest_file.write(version + '\n')
+        os.replace(latest_path + '.tmp', latest_path)
+        return version
@@ -0,0 +1,121 @@
+"""Thread budgets of TensorFlow, OpenMP and OpenCV and their auto-tuning.
+
+By default, the thread pools of TensorFlow, OpenMP and OpenCV each use
+all cores. Concurrent requests then oversubscribe the CPU. A ThreadBudget
+limits the pools, and tune_thread_budget picks the budget with the best
+throughput out of a few candidates.
+
+TensorFlow's thread pools cannot be changed once TensorFlow is running,
+so each candidate is measured in a separate trial process. This module
+does not import tensorflow, so it can be used before the budget is applied.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+
+
+class ThreadBudget(namedtuple(
+        'ThreadBudget', ['intra_op_threads', 'inter_op_threads', 'opencv_threads'])):
+    """
+    Number of threads of each thread pool, 0 lets the library decide.
+
+    Attributes
+    ----------
+    intra_op_threads: int
+        threads of a single TensorFlow operation, and of OpenMP
+    inter_op_threads: int
+        TensorFlow operations run concurrently
+    opencv_threads: int
+        threads of a single OpenCV function, e.g. resize
+    """
+    __slots__ = ()
+
+    def as_args(self):
+        """Return the command line arguments of server.py which set the budget."""
+        return [
+            '--intra-op-threads', str(self.intra_op_threads),
+            '--inter-op-threads', str(self.inter_op_threads),
+            '--opencv-threads', str(self.opencv_threads)
+        ]
+
+
+def candidate_budgets(cpu_count, concurrency):
+    """Return the budgets tried by the auto-tuner.
+
+    The TensorFlow and OpenCV pools either use all cores or share them
+    among the concurrent requests, with one or two concurrent operations.
+    """
+    per_request = max(1, cpu_count // concurrency)
+    candidates = []
+    for intra_op_threads in sorted({cpu_count, per_request}, reverse=True):
+        for inter_op_threads in (1, 2):
+            for opencv_threads in sorted({1, per_request}):
+                candidates.append(
+                    ThreadBudget(intra_op_threads, inter_op_threads, opencv_threads))
+    return list(dict.fromkeys(candidates))
+
+
+def measure_throughput(run, images_per_run, concurrency, repeats=3):
+    """Return the images per second of concurrency threads each calling run repeats times."""
+    def work():
+        for _ in range(repeats):
+            run()
+
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return concurrency * repeats * images_per_run / (time.perf_counter() - started)
+
+
+def tune_thread_budget(trial_command, candidates, cache_path=None, cache_key=None):
+    """Return the budget with the best throughput, the trials and whether they were cached.
+
+    trial_command maps a budget to the command line of a trial process, which
+    writes "throughput IMAGES_PER_SECOND" as its last line. Trials which fail
+    are skipped. The result is cached in cache_path under cache_key, e.g. the
+    models and the number of cores, and reused while the key is the same.
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as cache_file:
+            cached = json.load(cache_file)
+        if cached['key'] == cache_key:
+            return ThreadBudget(**cached['budget']), cached['trials'], True
+
+    trials = []
+    for budget in candidates:
+        completed = subprocess.run(
+            trial_command(budget),
+            stdout=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
+            text=True
+        )
+        lines = completed.stdout.strip().splitlines()
+        throughput = None
+        if completed.returncode == 0 and lines and lines[-1].startswith('throughput '):
+            throughput = float(lines[-1][len('throughput '):])
+        else:
+            print('thread budget trial {} failed with code {}'.format(
+                budget, completed.returncode), file=sys.stderr, flush=True)
+        trials.append(dict(budget._asdict(), throughput=throughput))
+        print('thread budget trial {}: {} images/s'.format(budget, throughput),
+              file=sys.stderr, flush=True)
+
+    measured = [trial for trial in trials if trial['throughput'] is not None]
+    if not measured:
+        raise RuntimeError('all thread budget trials failed')
+    best = max(measured, key=lambda trial: trial['throughput'])
+    budget = ThreadBudget(*(best[field] for field in ThreadBudget._fields))
+    if cache_path is not None:
+        with open(cache_path + '.tmp', 'w') as cache_file:
+            json.dump({'key': cache_key, 'budget': budget._asdict(), 'trials': trials},
+                      cache_file, indent=2)
+        os.replace(cache_path + '.tmp', cache_path)
+    return budget, trials, False
@@ -0,0 +1,6 @@
+"""Makes the packages in src importable, like running the scripts from src does."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
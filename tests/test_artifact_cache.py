@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+from caching.artifact_cache import ArtifactCache
+
+
+def new_cache(max_bytes=100):
+    return ArtifactCache(max_bytes, sizeof=len)
+
+
+def test_values_are_computed_once_and_cached():
+    cache = new_cache()
+    calls = []
+
+    def compute_many(keys):
+        calls.append(list(keys))
+        return [key * 2 for key in keys]
+
+    assert cache.get_or_compute_many(['a', 'b', 'a'], compute_many) == ['aa', 'bb', 'aa']
+    assert cache.get_or_compute_many(['b', 'c'], compute_many) == ['bb', 'cc']
+    assert calls == [['a', 'b'], ['c']]
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert cache.get('a') == 'aa'
+
+
+def test_concurrent_requests_wait_for_a_single_computation():
+    cache = new_cache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute(key):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        return key * 2
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get_or_compute('a', compute)))
+        for _ in range(4)
+    ]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == ['a']
+    assert results == ['aa'] * 4
+
+
+def test_errors_are_passed_to_waiting_threads_and_not_cached():
+    cache = new_cache()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail(key):
+        started.set()
+        release.wait(5)
+        raise IOError('cannot read {}'.format(key))
+
+    errors = []
+
+    def request(compute):
+        try:
+            cache.get_or_compute('a', compute)
+        except IOError as error:
+            errors.append(error)
+
+    computing = threading.Thread(target=request, args=(fail,))
+    computing.start()
+    assert started.wait(5)
+    waiting = threading.Thread(target=request, args=(lambda key: 'unused',))
+    waiting.start()
+    release.set()
+    computing.join(5)
+    waiting.join(5)
+    assert len(errors) == 2 and errors[0] is errors[1]
+    assert len(cache) == 0
+    assert cache.get_or_compute('a', lambda key: 'aa') == 'aa'
+
+
+def test_a_faulty_key_only_fails_itself():
+    cache = new_cache()
+    calls = []
+
+    def compute_many(keys):
+        calls.append(list(keys))
+        if 'bad' in keys:
+            raise IOError('cannot read bad')
+        return [key * 2 for key in keys]
+
+    with pytest.raises(IOError):
+        cache.get_or_compute_many(['a', 'bad', 'b'], compute_many)
+    assert calls == [['a', 'bad', 'b'], ['a'], ['bad'], ['b']]
+    assert cache.get('a') == 'aa' and cache.get('b') == 'bb'
+    assert cache.get('bad') is None
+    assert cache.get_or_compute_many(['a', 'b'], compute_many) == ['aa', 'bb']
+    assert len(calls) == 4
+
+
+def test_too_few_values_fail_the_keys():
+    cache = new_cache()
+    with pytest.raises(ValueError):
+        cache.get_or_compute_many(['a', 'b'], lambda keys: [])
+    assert len(cache) == 0
+    assert cache.get_or_compute_many(['a', 'b'], lambda keys: [key for key in keys]) == ['a', 'b']
+
+
+def test_least_recently_used_values_are_evicted():
+    cache = new_cache(max_bytes=4)
+    cache.get_or_compute_many(['a', 'b'], lambda keys: [key * 2 for key in keys])
+    cache.get('a')
+    cache.get_or_compute('c', lambda key: key * 2)
+    assert cache.get('b') is None
+    assert cache.get('a') == 'aa' and cache.get('c') == 'cc'
+    assert cache.size == 4
+    cache.get_or_compute('d', lambda key: key * 5)
+    assert cache.get('d') is None and len(cache) == 2
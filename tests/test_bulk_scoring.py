@@ -0,0 +1,142 @@
+import csv
+import os
+from collections import namedtuple
+
+import pytest
+
+from scoring.bulk_scoring import (CSVResultWriter, batched,
+                                  directory_file_paths, load_checkpoint,
+                                  manifest_file_paths, save_checkpoint,
+                                  score_batches)
+
+Segmentation = namedtuple('Segmentation', ['masked_image'])
+
+TREE = [
+    'a.png',
+    'z.png',
+    'b/x.png',
+    'b/y.png',
+    'b/a2/f.png',
+    'b/a2/deep/h.png',
+    'b/z/g.png',
+    'b/z/g_mask.png',
+    'c/notes.txt',
+    'c/i.JPG'
+]
+
+
+def make_tree(root, relative_paths=TREE):
+    for relative_path in relative_paths:
+        file_path = os.path.join(str(root), *relative_path.split('/'))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as image_file:
+            image_file.write(relative_path)
+
+
+def relative(root, file_paths):
+    return [os.path.relpath(file_path, str(root)).replace(os.sep, '/') for file_path in file_paths]
+
+
+def test_directory_images_are_listed_files_before_subdirectories(tmp_path):
+    make_tree(tmp_path)
+    assert relative(tmp_path, directory_file_paths(str(tmp_path))) == [
+        'a.png', 'z.png', 'b/x.png', 'b/y.png', 'b/a2/f.png',
+        'b/a2/deep/h.png', 'b/z/g.png', 'c/i.JPG'
+    ]
+
+
+def test_resume_after_any_image_yields_the_rest(tmp_path):
+    make_tree(tmp_path)
+    file_paths = list(directory_file_paths(str(tmp_path)))
+    for index, file_path in enumerate(file_paths):
+        assert list(directory_file_paths(str(tmp_path), after=file_path)) \
+            == file_paths[index + 1:]
+
+
+def test_resume_across_nested_directories(tmp_path):
+    make_tree(tmp_path, ['a.png', 'b/x.png', 'b/y.png', 'b/a2/f.png', 'b/z/g.png'])
+    after = os.path.join(str(tmp_path), 'b', 'x.png')
+    assert relative(tmp_path, directory_file_paths(str(tmp_path), after=after)) \
+        == ['b/y.png', 'b/a2/f.png', 'b/z/g.png']
+
+
+def test_resume_after_removed_or_added_images(tmp_path):
+    make_tree(tmp_path)
+    after = os.path.join(str(tmp_path), 'b', 'a2', 'f.png')
+    os.remove(after)
+    make_tree(tmp_path, ['a0.png', 'b/a2/deep/g.png', 'b/zz/k.png'])
+    assert relative(tmp_path, directory_file_paths(str(tmp_path), after=after)) == [
+        'b/a2/deep/g.png', 'b/a2/deep/h.png', 'b/z/g.png', 'b/zz/k.png', 'c/i.JPG'
+    ]
+
+
+def test_manifest_paths_are_read_row_by_row(tmp_path):
+    csv_path = str(tmp_path / 'manifest.csv')
+    with open(csv_path, 'w', newline='') as csv_file:
+        csv_file.write('filename,label\na.png,COVID-19\nb.png,NO FINDING\n')
+    assert list(manifest_file_paths(csv_path)) == ['a.png', 'b.png']
+    with pytest.raises(ValueError):
+        list(manifest_file_paths(csv_path, 'path'))
+
+
+def test_batches_keep_the_order():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 2)) == []
+
+
+class FakeSegmenter():
+    """Segments file paths to themselves and fails on paths containing 'bad'."""
+
+    def segment_list(self, file_paths, save_masks=False):
+        return [self.segment(file_path) for file_path in file_paths]
+
+    def segment(self, file_path, save_masks=False):
+        if 'bad' in file_path:
+            raise IOError('cannot read {}'.format(file_path))
+        return Segmentation(file_path)
+
+
+class FakeClassifier():
+    def classify_arrays(self, images):
+        return [
+            {'COVID-19': 0.9, 'NO FINDING': 0.1} if 'covid' in image
+            else {'COVID-19': 0.2, 'NO FINDING': 0.8}
+            for image in images
+        ]
+
+
+def test_unreadable_images_only_fail_their_own_row():
+    batches = [['covid1.png', 'bad.png', 'normal.png'], ['covid2.png']]
+    rows = [row for batch_rows in score_batches(
+        batches, FakeSegmenter(), FakeClassifier(), prefetch=1) for row in batch_rows]
+    assert [row['file_path'] for row in rows] == ['covid1.png', 'bad.png', 'normal.png', 'covid2.png']
+    assert [row.get('prediction') for row in rows] == ['COVID-19', None, 'NO FINDING', 'COVID-19']
+    assert rows[1]['error'].startswith('OSError: cannot read bad.png')
+    assert [row['error'] for row in rows if row['file_path'] != 'bad.png'] == ['', '', '']
+
+
+def test_csv_writer_drops_rows_written_after_the_checkpoint(tmp_path):
+    file_path = str(tmp_path / 'scores.csv')
+    columns = ['file_path', 'error']
+    writer = CSVResultWriter(file_path, columns)
+    writer.write([{'file_path': 'a.png', 'error': ''}])
+    state = writer.checkpoint()
+    writer.write([{'file_path': 'b.png', 'error': ''}])
+    writer.close()
+
+    writer = CSVResultWriter(file_path, columns, state)
+    writer.write([{'file_path': 'c.png', 'error': ''}])
+    writer.close()
+    with open(file_path, newline='') as csv_file:
+        assert [row['file_path'] for row in csv.DictReader(csv_file)] == ['a.png', 'c.png']
+
+
+def test_checkpoints_only_resume_the_same_run(tmp_path):
+    checkpoint_path = str(tmp_path / 'scores.csv.checkpoint.json')
+    run = {'input': 'archive', 'models': 'fingerprint'}
+    assert load_checkpoint(checkpoint_path, run) == (0, None, None)
+    save_checkpoint(checkpoint_path, run, 2, {'bytes': 10}, 'archive/b.png')
+    assert load_checkpoint(checkpoint_path, run) == (2, 'archive/b.png', {'bytes': 10})
+    assert not os.path.exists(checkpoint_path + '.tmp')
+    with pytest.raises(ValueError):
+        load_checkpoint(checkpoint_path, dict(run, models='other'))
@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+from serving.micro_batcher import MicroBatcher
+
+
+def test_results_are_mapped_to_their_items():
+    batches = []
+
+    def process_batch(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(process_batch, max_batch_size=4, max_wait=0.2)
+    futures = [batcher.submit(item) for item in range(10)]
+    assert [future.result(timeout=5) for future in futures] == [item * 2 for item in range(10)]
+    batcher.close()
+    assert all(len(batch) <= 4 for batch in batches)
+    assert sorted(item for batch in batches for item in batch) == list(range(10))
+
+
+def test_concurrent_items_are_batched():
+    started = threading.Barrier(8)
+    batches = []
+
+    def process_batch(items):
+        batches.append(len(items))
+        return items
+
+    batcher = MicroBatcher(process_batch, max_batch_size=8, max_wait=1.0)
+    futures = []
+    lock = threading.Lock()
+
+    def submit(item):
+        started.wait()
+        future = batcher.submit(item)
+        with lock:
+            futures.append(future)
+
+    threads = [threading.Thread(target=submit, args=(item,)) for item in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for future in futures:
+        future.result(timeout=5)
+    batcher.close()
+    assert batches == [8]
+
+
+def test_faulty_item_only_fails_its_own_future():
+    def process_batch(items):
+        if 'bad' in items:
+            raise ValueError('bad item')
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(process_batch, max_batch_size=3, max_wait=0.5)
+    futures = [batcher.submit(item) for item in ('a', 'bad', 'c')]
+    assert futures[0].result(timeout=5) == 'A'
+    with pytest.raises(ValueError, match='bad item'):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5) == 'C'
+    batcher.close()
+
+
+def test_too_few_results_fail_every_future():
+    batcher = MicroBatcher(lambda items: items[:-1], max_batch_size=3, max_wait=0.5)
+    futures = [batcher.submit(item) for item in range(3)]
+    for future in futures:
+        with pytest.raises(ValueError, match='2 results for 3 items'):
+            future.result(timeout=5)
+    batcher.close()
+
+
+def test_close_processes_pending_items():
+    batcher = MicroBatcher(lambda items: items, max_batch_size=100, max_wait=10)
+    futures = [batcher.submit(item) for item in range(5)]
+    batcher.close()
+    assert [future.result(timeout=0) for future in futures] == list(range(5))
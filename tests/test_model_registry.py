@@ -0,0 +1,63 @@
+import json
+import os
+
+import pytest
+
+from training.model_registry import ModelRegistry
+
+
+class FakeModel():
+    """Saves its weights like a Keras model saves itself."""
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def save(self, file_path):
+        with open(file_path, 'w') as model_file:
+            model_file.write(self.weights)
+
+
+def test_latest_is_none_before_the_first_version(tmp_path):
+    assert ModelRegistry(str(tmp_path / 'models')).latest() == (None, None)
+
+
+def test_publish_makes_the_version_the_latest(tmp_path):
+    registry = ModelRegistry(str(tmp_path))
+    first = registry.publish(FakeModel('first'), {'items': ['a']})
+    second = registry.publish(FakeModel('second'), {'items': ['b']})
+    assert first != second
+    version, model_path = registry.latest()
+    assert version == second
+    with open(model_path) as model_file:
+        assert model_file.read() == 'second'
+    assert registry.metadata(second) == {'items': ['b'], 'version': second}
+
+
+def test_failed_publish_keeps_the_latest_version(tmp_path):
+    registry = ModelRegistry(str(tmp_path))
+    first = registry.publish(FakeModel('first'), {})
+
+    def export(model, version_dir_path):
+        raise RuntimeError('export failed')
+
+    with pytest.raises(RuntimeError):
+        registry.publish(FakeModel('second'), {}, export)
+    assert registry.latest()[0] == first
+    assert not os.path.exists(os.path.join(str(tmp_path), ModelRegistry.LATEST_FILE_NAME + '.tmp'))
+
+
+def test_inference_exports_are_published_with_the_version(tmp_path):
+    registry = ModelRegistry(str(tmp_path))
+
+    def export(model, version_dir_path):
+        export_path = os.path.join(
+            version_dir_path, ModelRegistry.INFERENCE_MODEL_FILE_NAMES['tflite'])
+        with open(export_path, 'w') as export_file:
+            export_file.write('tflite')
+        return export_path
+
+    version = registry.publish(FakeModel('weights'), {}, export)
+    assert registry.inference_model_path(version).endswith('inference_model.tflite')
+    assert registry.metadata(version)['inference_model'] == 'inference_model.tflite'
+    with open(os.path.join(str(tmp_path), ModelRegistry.LATEST_FILE_NAME)) as latest_file:
+        assert json.dumps(latest_file.read().strip()) == json.dumps(version)
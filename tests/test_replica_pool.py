@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+import threading
+import time
+
+from serving.replica_pool import ReplicaPool
+
+WORKER = '''
+import json, os, sys, time
+index = int(os.environ['REPLICA_INDEX'])
+hold = os.environ.get('HOLD_PATH_{}'.format(index))
+while hold is not None and not os.path.exists(hold):
+    time.sleep(0.01)
+print('ready', json.dumps({'replica': index}), flush=True)
+for line in sys.stdin:
+    message = line.strip()
+    if 'crash' in message:
+        sys.exit(1)
+    print(message, json.dumps({'replica': index}), flush=True)
+'''
+
+
+class Output():
+    """Collects the lines written by the pool."""
+
+    def __init__(self):
+        self.lines = []
+        self.condition = threading.Condition()
+
+    def write(self, text):
+        with self.condition:
+            self.lines += text.splitlines()
+            self.condition.notify_all()
+
+    def flush(self):
+        pass
+
+    def wait_for(self, prefix, timeout=10):
+        with self.condition:
+            assert self.condition.wait_for(
+                lambda: any(line.startswith(prefix) for line in self.lines), timeout)
+            return [line for line in self.lines if line.startswith(prefix)]
+
+
+def new_pool(tmp_path, num_replicas, env=None):
+    worker_path = tmp_path / 'worker.py'
+    worker_path.write_text(WORKER)
+    output = Output()
+    pool = ReplicaPool(
+        [sys.executable, str(worker_path)],
+        num_replicas,
+        commands=['classify', 'stats', 'reload'],
+        broadcast_commands=['reload'],
+        aggregate_commands=['stats'],
+        env=dict(os.environ, **(env or {})),
+        output=output,
+        restart_delay=0
+    )
+    return pool, output
+
+
+def reply_of(line):
+    return json.loads(line.split(' ', 2)[2])
+
+
+def test_requests_are_only_sent_to_ready_workers(tmp_path):
+    hold_path = tmp_path / 'hold'
+    pool, output = new_pool(tmp_path, 2, {'HOLD_PATH_0': str(hold_path)})
+    try:
+        replica = pool._ReplicaPool__replicas[1]
+        deadline = time.monotonic() + 10
+        while not replica.ready and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for image_id in range(3):
+            pool.submit('classify {}\n'.format(image_id))
+            assert reply_of(output.wait_for('classify {} '.format(image_id))[0]) \
+                == {'replica': 1}
+        hold_path.write_text('')
+        ready, = output.wait_for('ready ')
+        assert json.loads(ready[len('ready '):])['replicas'] == [{'replica': 0}, {'replica': 1}]
+    finally:
+        hold_path.write_text('')
+        pool.close()
+
+
+def test_requests_wait_for_the_first_ready_worker(tmp_path):
+    hold_path = tmp_path / 'hold'
+    pool, output = new_pool(tmp_path, 1, {'HOLD_PATH_0': str(hold_path)})
+    try:
+        pool.submit('classify a\n')
+        hold_path.write_text('')
+        assert reply_of(output.wait_for('classify a ')[0]) == {'replica': 0}
+    finally:
+        hold_path.write_text('')
+        pool.close()
+
+
+def test_stats_replies_of_all_workers_are_combined(tmp_path):
+    pool, output = new_pool(tmp_path, 3)
+    try:
+        pool.submit('stats 1\n')
+        pool.submit('reload 2\n')
+        stats = output.wait_for('stats 1 ')
+        assert len(stats) == 1
+        assert reply_of(stats[0]) == {'replicas': [{'replica': index} for index in range(3)]}
+        output.wait_for('reload 2 ')
+    finally:
+        pool.close()
+    assert sorted(reply_of(line)['replica'] for line in output.lines
+                  if line.startswith('reload 2 ')) == [0, 1, 2]
+
+
+def test_crashing_requests_are_retried_then_answered_with_an_error(tmp_path):
+    pool, output = new_pool(tmp_path, 2)
+    try:
+        output.wait_for('ready ')
+        pool.submit('classify crash\n')
+        assert reply_of(output.wait_for('classify crash ')[0]) == {'error': 'worker crashed'}
+        pool.submit('classify a\n')
+        output.wait_for('classify a ')
+        pool.submit('stats 1\n')
+        assert len(reply_of(output.wait_for('stats 1 ')[0])['replicas']) == 2
+    finally:
+        pool.close()
+    assert pool.load() == [0, 0]
@@ -0,0 +1,43 @@
+from caching.result_store import ResultStore, file_digest, model_fingerprint
+
+
+def test_results_are_stored_per_model_fingerprint(tmp_path):
+    store = ResultStore(str(tmp_path / 'results.sqlite'), 'first')
+    store.put('hash', 'classify', '{"COVID-19": 0.1}')
+    assert store.get('hash', 'classify') == '{"COVID-19": 0.1}'
+    assert store.get('hash', 'explain_lime') is None
+    assert store.get('hash', 'classify', 'second') is None
+    store.put('hash', 'classify', 'other', 'second')
+    assert store.get('hash', 'classify', 'second') == 'other'
+    assert (store.hits, store.misses) == (2, 2)
+    store.close()
+
+
+def test_results_of_other_models_are_removed_on_open(tmp_path):
+    database_path = str(tmp_path / 'results.sqlite')
+    store = ResultStore(database_path, 'first')
+    store.put('hash', 'classify', 'result')
+    store.close()
+
+    store = ResultStore(database_path, 'first')
+    assert store.get('hash', 'classify') == 'result'
+    store.close()
+    store = ResultStore(database_path, 'second')
+    store.close()
+    store = ResultStore(database_path, 'first')
+    assert store.get('hash', 'classify') is None
+    store.close()
+
+
+def test_fingerprints_follow_the_file_contents(tmp_path):
+    model_path = tmp_path / 'model.h5'
+    model_path.write_bytes(b'weights')
+    saved_model_path = tmp_path / 'saved_model'
+    (saved_model_path / 'variables').mkdir(parents=True)
+    (saved_model_path / 'variables' / 'variables.data').write_bytes(b'variables')
+    fingerprint = model_fingerprint(str(model_path), str(saved_model_path))
+    assert fingerprint == model_fingerprint(str(model_path), str(saved_model_path))
+    assert file_digest(str(model_path)) == file_digest(str(model_path))
+
+    (saved_model_path / 'variables' / 'variables.data').write_bytes(b'retrained')
+    assert model_fingerprint(str(model_path), str(saved_model_path)) != fingerprint
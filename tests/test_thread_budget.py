@@ -0,0 +1,64 @@
+import json
+import sys
+
+import pytest
+
+from tuning.thread_budget import (ThreadBudget, candidate_budgets,
+                                  measure_throughput, tune_thread_budget)
+
+
+def test_candidates_share_the_cores_among_the_requests():
+    candidates = candidate_budgets(8, 4)
+    assert len(candidates) == len(set(candidates))
+    assert {candidate.intra_op_threads for candidate in candidates} == {8, 2}
+    assert {candidate.inter_op_threads for candidate in candidates} == {1, 2}
+    assert {candidate.opencv_threads for candidate in candidates} == {1, 2}
+    assert all(candidate.intra_op_threads == 1 for candidate in candidate_budgets(1, 16))
+
+
+def test_budgets_are_passed_as_server_arguments():
+    assert ThreadBudget(4, 1, 2).as_args() == [
+        '--intra-op-threads', '4', '--inter-op-threads', '1', '--opencv-threads', '2']
+
+
+def test_throughput_counts_every_image():
+    assert measure_throughput(lambda: None, 2, 3, repeats=2) > 0
+
+
+def trial_command(throughputs):
+    """Return trial commands which print the throughput of each budget, None fails."""
+    def command(budget):
+        throughput = throughputs[budget]
+        if throughput is None:
+            return [sys.executable, '-c', 'import sys; sys.exit(1)']
+        return [sys.executable, '-c', 'print("warming up"); print("throughput {}")'.format(throughput)]
+    return command
+
+
+def test_best_budget_is_chosen_and_cached(tmp_path):
+    candidates = [ThreadBudget(8, 1, 1), ThreadBudget(2, 2, 2), ThreadBudget(2, 1, 1)]
+    throughputs = dict(zip(candidates, [3.0, None, 5.0]))
+    cache_path = str(tmp_path / 'thread_budget.json')
+    budget, trials, cached = tune_thread_budget(
+        trial_command(throughputs), candidates, cache_path, {'cpu_count': 8})
+    assert budget == ThreadBudget(2, 1, 1)
+    assert not cached
+    assert [trial['throughput'] for trial in trials] == [3.0, None, 5.0]
+
+    budget, _, cached = tune_thread_budget(
+        trial_command(throughputs), candidates, cache_path, {'cpu_count': 8})
+    assert (budget, cached) == (ThreadBudget(2, 1, 1), True)
+    with open(cache_path) as cache_file:
+        assert json.load(cache_file)['key'] == {'cpu_count': 8}
+
+    # another key tunes again
+    throughputs[candidates[0]] = 9.0
+    budget, _, cached = tune_thread_budget(
+        trial_command(throughputs), candidates, cache_path, {'cpu_count': 4})
+    assert (budget, cached) == (candidates[0], False)
+
+
+def test_tuning_fails_if_every_trial_fails():
+    candidates = [ThreadBudget(1, 1, 1)]
+    with pytest.raises(RuntimeError):
+        tune_thread_budget(trial_command({candidates[0]: None}), candidates)
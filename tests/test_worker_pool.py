@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+from serving.worker_pool import PriorityWorkerPool, QueueFullError
+
+
+def test_tasks_of_a_type_respect_its_limit():
+    pool = PriorityWorkerPool({'a': 2, 'b': 1}, {'a': 0, 'b': 1})
+    lock = threading.Lock()
+    running = {'a': 0, 'b': 0}
+    peaks = {'a': 0, 'b': 0}
+    release = threading.Event()
+
+    def task(task_type):
+        with lock:
+            running[task_type] += 1
+            peaks[task_type] = max(peaks[task_type], running[task_type])
+        release.wait(5)
+        with lock:
+            running[task_type] -= 1
+
+    for _ in range(4):
+        pool.submit('a', task, 'a')
+        pool.submit('b', task, 'b')
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with lock:
+            if running == {'a': 2, 'b': 1}:
+                break
+        time.sleep(0.01)
+    # the queued tasks wait for the running ones
+    time.sleep(0.05)
+    assert pool.in_flight() == 3
+    assert pool.queue_depth() == 5
+    release.set()
+    pool.shutdown()
+    assert peaks == {'a': 2, 'b': 1}
+
+
+def test_type_at_its_limit_does_not_block_other_types():
+    pool = PriorityWorkerPool({'explain': 1, 'classify': 1}, {'classify': 0, 'explain': 1})
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    pool.submit('explain', block)
+    assert started.wait(5)
+    pool.submit('explain', block)
+    classified = threading.Event()
+    pool.submit('classify', classified.set)
+    assert classified.wait(5)
+    assert pool.queue_depth('explain') == 1
+    release.set()
+    pool.shutdown()
+
+
+def test_full_queue_rejects_tasks():
+    pool = PriorityWorkerPool({'a': 1}, {'a': 0}, max_queue_size=1)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    pool.submit('a', block)
+    assert started.wait(5)
+    pool.submit('a', block)
+    with pytest.raises(QueueFullError):
+        pool.submit('a', block)
+    release.set()
+    pool.shutdown()
+
+
+def test_failing_task_does_not_stop_the_pool():
+    pool = PriorityWorkerPool({'a': 1}, {'a': 0})
+    done = []
+    pool.submit('a', lambda: 1 / 0)
+    pool.submit('a', done.append, True)
+    pool.shutdown()
+    assert done == [True]